@@ -69,7 +69,8 @@ class HTTPRelayApplication(ApplicationWorker):
         config = yield self.get_config(message)
         headers = self.get_auth_headers(config)
         response = yield http_request_full(config.url.geturl(),
-                            message.to_json(), headers, config.http_method)
+                            message.to_json(), headers, config.http_method,
+                            pool=self.get_http_pool())
         headers = response.headers
         if response.code == http.OK:
             if headers.hasHeader(self.reply_header):
@@ -86,7 +87,8 @@ class HTTPRelayApplication(ApplicationWorker):
         config = yield self.get_config(event)
         headers = self.get_auth_headers(config)
         yield http_request_full(config.event_url.geturl(),
-            event.to_json(), headers, config.http_method)
+            event.to_json(), headers, config.http_method,
+            pool=self.get_http_pool())
 
     @inlineCallbacks
     def consume_ack(self, event):
@@ -285,7 +285,8 @@ class RapidSMSRelay(ApplicationWorker):
         yield self._store_message(message, config.vumi_reply_timeout)
         response = http_request_full(config.rapidsms_url.geturl(),
                                      message.to_json(),
-                                     headers, config.rapidsms_http_method)
+                                     headers, config.rapidsms_http_method,
+                                     pool=self.get_http_pool())
         response.addCallback(lambda response: log.info(response.code))
         response.addErrback(lambda failure: log.err(failure))
         yield response
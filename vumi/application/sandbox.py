@@ -7,7 +7,6 @@ import resource
 import os
 import signal
 import json
-import pkg_resources
 from uuid import uuid4
 
 from twisted.internet import reactor
@@ -499,7 +498,8 @@ class HttpClientResource(SandboxResource):
             data = data.encode("utf-8")
         d = http_request_full(url, data=data, headers=headers,
                               method=method, timeout=self.timeout,
-                              data_limit=self.data_limit)
+                              data_limit=self.data_limit,
+                              pool=self.app_worker.get_http_pool())
         d.addCallback(self._make_success_reply, command)
         d.addErrback(self._make_failure_reply, command)
         return d
@@ -825,6 +825,7 @@ class JsSandbox(Sandbox):
 
     @classmethod
     def find_sandbox_js(cls):
+        import pkg_resources
         return pkg_resources.resource_filename('vumi.application',
                                                'sandboxer.js')
 
@@ -33,32 +33,54 @@ class SessionManager(object):
         self.r_server = r_server
         self.r_prefix = prefix
 
-        self.gc = task.LoopingCall(lambda: self.active_sessions())
+        self.gc = task.LoopingCall(self.gc_sessions)
         self.gc.start(gc_period)
 
     def stop(self):
         if self.gc.running:
             return self.gc.stop()
 
+    def _session_expiry(self, timeout=None):
+        if timeout is None:
+            timeout = self.max_session_length
+        if not timeout:
+            return float('inf')
+        return time.time() + timeout
+
+    def _index_session(self, user_id, timeout=None):
+        skey = self.r_key('session_index')
+        self.r_server.zadd(skey, **{user_id: self._session_expiry(timeout)})
+
+    def gc_sessions(self):
+        """
+        Remove expired sessions from the session index.
+        """
+        skey = self.r_key('session_index')
+        return self.r_server.zremrangebyscore(
+            skey, '-inf', '(%r' % (time.time(),))
+
     def active_sessions(self):
         """
         Return a list of active user_ids and associated sessions. Loops over
-        known active_sessions, some of which might have auto expired.
+        the session index in order of expiry, skipping expired entries.
         Implements lazy garbage collection, for each entry it checks if
-        the user's session still exists, if not it is removed from the set.
+        the user's session still exists, if not it is removed from the index.
         """
-        skey = self.r_key('active_sessions')
+        skey = self.r_key('session_index')
+        self.gc_sessions()
         sessions_to_expire = []
-        for user_id in self.r_server.smembers(skey):
-            ukey = self.r_key('session', user_id)
-            if self.r_server.exists(ukey):
-                yield user_id, self.load_session(user_id)
+        user_ids = self.r_server.zrangebyscore(
+            skey, '%r' % (time.time(),), '+inf')
+        for user_id in user_ids:
+            session = self.load_session(user_id)
+            if session:
+                yield user_id, session
             else:
                 sessions_to_expire.append(user_id)
 
         # clear empty ones
-        for user_ids in sessions_to_expire:
-            self.r_server.srem(skey, user_id)
+        for user_id in sessions_to_expire:
+            self.r_server.zrem(skey, user_id)
 
     def r_key(self, *args):
         """
@@ -88,6 +110,7 @@ class SessionManager(object):
         """
         ukey = self.r_key('session', user_id)
         self.r_server.expire(ukey, timeout)
+        self._index_session(user_id, timeout)
 
     def create_session(self, user_id, **kwargs):
         """
@@ -105,6 +128,7 @@ class SessionManager(object):
     def clear_session(self, user_id):
         ukey = self.r_key('session', user_id)
         self.r_server.delete(ukey)
+        self.r_server.zrem(self.r_key('session_index'), user_id)
 
     def save_session(self, user_id, session):
         """
@@ -120,8 +144,8 @@ class SessionManager(object):
 
         """
         ukey = self.r_key('session', user_id)
-        for s_key, s_value in session.items():
-            self.r_server.hset(ukey, s_key, s_value)
-        skey = self.r_key('active_sessions')
-        self.r_server.sadd(skey, user_id)
+        if session:
+            self.r_server.hmset(ukey, session)
+        if self.r_server.zscore(self.r_key('session_index'), user_id) is None:
+            self._index_session(user_id)
         return session
@@ -378,6 +378,10 @@ class DummyAppWorker(object):
 
     def __init__(self):
         self.mock_calls = defaultdict(list)
+        self.http_pool = object()
+
+    def get_http_pool(self):
+        return self.http_pool
 
     def create_sandbox_api(self):
         return self.sandbox_api_cls()
@@ -664,7 +668,8 @@ class TestHttpClientResource(ResourceTestCaseBase):
                       else self.resource.data_limit)
         args = (url,)
         kw = dict(method=method, headers=headers, data=data,
-                  timeout=timeout, data_limit=data_limit)
+                  timeout=timeout, data_limit=data_limit,
+                  pool=self.app_worker.http_pool)
         [(actual_args, actual_kw)] = self._http_requests
         self.assertEqual((actual_args, actual_kw), (args, kw))
 
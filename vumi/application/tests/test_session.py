@@ -57,3 +57,17 @@ class SessionManagerTestCase(TestCase):
     def test_lazy_clearing(self):
         self.sm.save_session('user_id', {})
         self.assertEqual(list(self.sm.active_sessions()), [])
+
+    def test_expired_sessions_not_active(self):
+        self.sm.create_session("u1")
+        self.sm.schedule_session_expiry("u1", -1)
+        self.assertEqual(list(self.sm.active_sessions()), [])
+        self.assertEqual(
+            self.fake_redis.zcard(self.sm.r_key('session_index')), 0)
+
+    def test_clear_session(self):
+        self.sm.create_session("u1")
+        self.sm.clear_session("u1")
+        self.assertEqual(list(self.sm.active_sessions()), [])
+        self.assertEqual(
+            self.fake_redis.zcard(self.sm.r_key('session_index')), 0)
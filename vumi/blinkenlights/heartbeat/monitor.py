@@ -1,6 +1,7 @@
 # -*- test-case-name: vumi.blinkenlights.tests.test_heartbeat -*-
 
 import time
+import heapq
 import collections
 
 from twisted.internet.defer import inlineCallbacks
@@ -28,28 +29,40 @@ class RPCServer(jsonrpc.JSONRPC):
     def __init__(self, state):
         jsonrpc.JSONRPC.__init__(self)
         self._state = state
+        # (system_id, worker_id) -> (version, serialized worker)
+        self._cache = {}
 
     def jsonrpc_get_state(self, ver):
         return self.serialize_state()
 
+    def serialize_worker(self, wkr):
+        return {
+            'worker_id': wkr['worker_id'],
+            'hostname': wkr['hostname'],
+            'pid': wkr['pid'],
+            'events': [{
+                'state': ev.state,
+                'timestamp': ev.timestamp,
+            } for ev in wkr['events']],
+        }
+
     def serialize_state(self):
         """
         Walk the tree and transform objects into JSON hashes
+
+        Workers are only reserialized when their version has changed since
+        the last call.
         """
         data = {}
         for system_id, workers in self._state.iteritems():
             data[system_id] = {}
             for worker_id, wkr in workers.iteritems():
-                wkr_js = data[system_id][worker_id] = {}
-                wkr_js['worker_id'] = wkr['worker_id']
-                wkr_js['hostname'] = wkr['hostname']
-                wkr_js['pid'] = wkr['pid']
-                wkr_js['events'] = []
-                for ev in wkr['events']:
-                    wkr_js['events'].append({
-                        'state': ev.state,
-                        'timestamp': ev.timestamp,
-                    })
+                cache_key = (system_id, worker_id)
+                cached = self._cache.get(cache_key)
+                if cached is None or cached[0] != wkr['version']:
+                    cached = (wkr['version'], self.serialize_worker(wkr))
+                    self._cache[cache_key] = cached
+                data[system_id][worker_id] = cached[1]
         return data
 
 
@@ -70,6 +83,7 @@ class HeartBeatMonitor(Worker):
 
     deadline = 30
     data_port = 7080
+    max_events = 100
 
     @inlineCallbacks
     def startWorker(self):
@@ -79,10 +93,16 @@ class HeartBeatMonitor(Worker):
                                     HeartBeatMonitor.data_port)
         self.deadline = self.config.get("deadline",
                                         HeartBeatMonitor.deadline)
+        self.max_events = self.config.get("max_events",
+                                          HeartBeatMonitor.max_events)
 
         log.msg("heartbeat-data-server running on port %s" % self.data_port)
 
         self._state = collections.defaultdict(dict)
+        # Heap of (timestamp, system_id, worker_id) entries, one per
+        # heartbeat. Entries superseded by a later heartbeat are discarded
+        # when they reach the top of the heap.
+        self._deadlines = []
 
         # Start consuming heartbeats
         yield self.consume("heartbeat.inbound", self.consume_message,
@@ -113,8 +133,9 @@ class HeartBeatMonitor(Worker):
         """
         if worker_id not in self._state[system_id]:
             wkr = {
-                    'events': [],
-                  }
+                'events': collections.deque(maxlen=self.max_events),
+                'version': 0,
+            }
             self._state[system_id][worker_id] = wkr
         return self._state[system_id][worker_id]
 
@@ -133,24 +154,41 @@ class HeartBeatMonitor(Worker):
         wkr = self._ensure(system_id, worker_id)
 
         # update the worker's known state
+        if (wkr.get('hostname'), wkr.get('pid')) != (msg['hostname'],
+                                                     msg['pid']):
+            wkr['version'] += 1
         wkr['system_id'] = msg['system_id']
         wkr['worker_id'] = msg['worker_id']
         wkr['hostname'] = msg['hostname']
         wkr['pid'] = msg['pid']
         wkr['timestamp'] = msg['timestamp']
+        heapq.heappush(self._deadlines,
+                       (msg['timestamp'], system_id, worker_id))
 
         # Add an event if necessary
         if (not wkr['events']) or wkr['events'][-1].state == Event.MISSING:
             ev = Event(msg['timestamp'], Event.ALIVE)
             wkr['events'].append(ev)
+            wkr['version'] += 1
 
     def _find_missing_workers(self, deadline):
+        """
+        Pop heartbeats older than the deadline off the heap and return the
+        workers that haven't sent a heartbeat since.
+        """
         lst = []
-        for system_id, workers in self._state.iteritems():
-            for wkr in [wkr for wkr in workers.values()
-                        if wkr['timestamp'] < deadline]:
-                if wkr['events'][-1].state == Event.ALIVE:
-                    lst.append(wkr)
+        seen = set()
+        while self._deadlines and self._deadlines[0][0] < deadline:
+            timestamp, system_id, worker_id = heapq.heappop(self._deadlines)
+            wkr = self._state[system_id][worker_id]
+            if wkr['timestamp'] != timestamp:
+                # superseded by a later heartbeat
+                continue
+            if (system_id, worker_id) in seen:
+                continue
+            seen.add((system_id, worker_id))
+            if wkr['events'][-1].state == Event.ALIVE:
+                lst.append(wkr)
         return lst
 
     def _process_missing(self, workers):
@@ -158,6 +196,7 @@ class HeartBeatMonitor(Worker):
             log.msg("worker is now missing: %s" % wkr['worker_id'])
             ev = Event(wkr['timestamp'], Event.MISSING)
             wkr['events'].append(ev)
+            wkr['version'] += 1
 
     def _check_missing(self):
         """
@@ -137,3 +137,61 @@ class TestHeartBeatMonitor(TestCase):
         missing = self.worker._find_missing_workers(deadline)
         self.assertEqual(len(missing), 1)
         self.assertEqual(missing[0]['worker_id'], msg['worker_id'])
+
+    @inlineCallbacks
+    def test_find_missing_workers_ignores_superseded_heartbeats(self):
+        yield self.worker.startWorker()
+        self.worker.update(self.gen_fake_attrs(90))
+        self.worker.update(self.gen_fake_attrs(110))
+
+        # the heartbeat at 90 has been superseded by the one at 110
+        self.assertEqual(self.worker._find_missing_workers(100), [])
+        self.assertEqual(len(self.worker._deadlines), 1)
+
+        missing = self.worker._find_missing_workers(120)
+        self.assertEqual([wkr['worker_id'] for wkr in missing], ["worker-1"])
+        self.assertEqual(self.worker._deadlines, [])
+
+    @inlineCallbacks
+    def test_check_missing(self):
+        yield self.worker.startWorker()
+        self.worker.update(self.gen_fake_attrs(time.time() - 100))
+        self.worker._check_missing()
+        wkr = self.worker._ensure("system-1", "worker-1")
+        self.assertEqual([ev.state for ev in wkr['events']],
+                         [monitor.Event.ALIVE, monitor.Event.MISSING])
+        # a missing worker isn't reported again
+        self.assertEqual(self.worker._find_missing_workers(time.time()), [])
+
+    @inlineCallbacks
+    def test_events_bounded(self):
+        self.worker.config['max_events'] = 4
+        yield self.worker.startWorker()
+        for timestamp in range(10):
+            self.worker.update(self.gen_fake_attrs(timestamp))
+            self.worker._process_missing(
+                self.worker._find_missing_workers(timestamp + 1))
+        wkr = self.worker._ensure("system-1", "worker-1")
+        self.assertEqual([ev.timestamp for ev in wkr['events']],
+                         [8, 8, 9, 9])
+
+    @inlineCallbacks
+    def test_serialize_state(self):
+        yield self.worker.startWorker()
+        rpc = monitor.RPCServer(self.worker._state)
+        self.worker.update(self.gen_fake_attrs(100))
+        state = rpc.serialize_state()
+        wkr_js = state["system-1"]["worker-1"]
+        self.assertEqual(wkr_js['events'],
+                         [{'state': monitor.Event.ALIVE, 'timestamp': 100}])
+
+        # unchanged workers are served from the cache
+        self.worker.update(self.gen_fake_attrs(101))
+        self.assertTrue(
+            rpc.serialize_state()["system-1"]["worker-1"] is wkr_js)
+
+        self.worker._process_missing(
+            self.worker._find_missing_workers(200))
+        wkr_js = rpc.serialize_state()["system-1"]["worker-1"]
+        self.assertEqual([ev['state'] for ev in wkr_js['events']],
+                         [monitor.Event.ALIVE, monitor.Event.MISSING])
@@ -3,17 +3,23 @@
 
 """Message store."""
 
+import csv
 from uuid import uuid4
+from collections import OrderedDict
+from StringIO import StringIO
 
+from twisted.internet import reactor
 from twisted.internet.defer import returnValue, inlineCallbacks
 
-from vumi.message import TransportEvent, TransportUserMessage
+from vumi.message import (TransportEvent, TransportUserMessage,
+                          VUMI_DATE_FORMAT)
 from vumi.persist.model import Model, Manager
 from vumi.persist.fields import (VumiMessage, ForeignKey, ListOf, Tag, Dynamic,
                                  Unicode)
-from vumi.persist.txriak_manager import TxRiakManager
 from vumi import log
 from vumi.components.message_store_cache import MessageStoreCache
+from vumi.components.message_store_migrators import (
+    OutboundMessageMigrator, EventMigrator, InboundMessageMigrator)
 
 
 class Batch(Model):
@@ -59,23 +65,81 @@ class CurrentTag(Model):
 
 
 class OutboundMessage(Model):
+    VERSION = 1
+    MIGRATOR = OutboundMessageMigrator
+
     # key is message_id
-    msg = VumiMessage(TransportUserMessage)
+    msg = VumiMessage(TransportUserMessage, flatten=False)
     batch = ForeignKey(Batch, null=True)
 
 
 class Event(Model):
+    VERSION = 1
+    MIGRATOR = EventMigrator
+
     # key is message_id
-    event = VumiMessage(TransportEvent)
+    event = VumiMessage(TransportEvent, flatten=False)
     message = ForeignKey(OutboundMessage)
 
 
 class InboundMessage(Model):
+    VERSION = 1
+    MIGRATOR = InboundMessageMigrator
+
     # key is message_id
-    msg = VumiMessage(TransportUserMessage)
+    msg = VumiMessage(TransportUserMessage, flatten=False)
     batch = ForeignKey(Batch, null=True)
 
 
+class JsonLinesMessageFormatter(object):
+    """Formats exported messages as newline-delimited JSON."""
+
+    content_type = 'application/x-json-stream; charset=utf-8'
+
+    def header(self):
+        return ''
+
+    def format(self, msg):
+        return msg.to_json() + '\n'
+
+
+class CsvMessageFormatter(object):
+    """Formats exported messages as CSV with one row per message."""
+
+    content_type = 'text/csv; charset=utf-8'
+
+    FIELDS = ['message_id', 'timestamp', 'from_addr', 'to_addr', 'content',
+              'transport_name', 'transport_type', 'session_event',
+              'in_reply_to', 'group']
+
+    def _row(self, values):
+        buf = StringIO()
+        csv.writer(buf).writerow(values)
+        return buf.getvalue()
+
+    def _encode(self, value):
+        if value is None:
+            return ''
+        if hasattr(value, 'strftime'):
+            return value.strftime(VUMI_DATE_FORMAT)
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def header(self):
+        return self._row(self.FIELDS)
+
+    def format(self, msg):
+        return self._row([self._encode(msg.get(field))
+                          for field in self.FIELDS])
+
+
+EXPORT_FORMATTERS = {
+    'json': JsonLinesMessageFormatter,
+    'csv': CsvMessageFormatter,
+}
+
+
 class MessageStore(object):
     """Vumi message store.
 
@@ -86,9 +150,36 @@ class MessageStore(object):
     A small amount of information about the state of a batch (i.e. number
     of messages in the batch, messages sent, acknowledgements and delivery
     reports received) is stored in Redis.
+
+    The batch a tag is currently associated with and the batches of recently
+    stored outbound messages may optionally be cached in process, which saves
+    a Riak lookup for most messages and events. Batches started or finished
+    through this store update the cache immediately, but changes made through
+    other stores are only seen once cached tags expire, so `lookup_cache_ttl`
+    should be kept short unless this is the only store starting and finishing
+    batches.
+
+    A message or event may also carry its batch id in its `helper_metadata`
+    (see :meth:`add_batch_id_to_msg`), in which case no lookup is needed.
+
+    :param Manager manager:
+        Riak manager object.
+    :param redis:
+        Redis manager object.
+    :param int lookup_cache_size:
+        Maximum number of tags and of outbound messages to cache the batch of.
+        The least recently used entries are evicted first. Default is None (no
+        caching).
+    :param float lookup_cache_ttl:
+        Maximum time in seconds the batch of a tag or message is cached for.
+        Default is None (until evicted).
     """
 
-    def __init__(self, manager, redis):
+    # Number of keys to fetch at a time when walking large indexes.
+    DEFAULT_KEYS_PAGE_SIZE = 1000
+
+    def __init__(self, manager, redis, lookup_cache_size=None,
+                 lookup_cache_ttl=None):
         self.manager = manager
         self.batches = manager.proxy(Batch)
         self.outbound_messages = manager.proxy(OutboundMessage)
@@ -96,6 +187,106 @@ class MessageStore(object):
         self.inbound_messages = manager.proxy(InboundMessage)
         self.current_tags = manager.proxy(CurrentTag)
         self.cache = MessageStoreCache(redis)
+        self.clock = self.get_clock()
+        self.lookup_cache_size = lookup_cache_size
+        self.lookup_cache_ttl = lookup_cache_ttl
+        # tag -> (batch_id, expires_at), in LRU order.
+        self._tag_batches = OrderedDict()
+        # message_id -> (batch_id, expires_at), in LRU order.
+        self._message_batches = OrderedDict()
+
+    def get_clock(self):
+        return reactor
+
+    def get_clocktime(self):
+        return self.clock.seconds()
+
+    @staticmethod
+    def add_batch_id_to_msg(msg, batch_id):
+        """Convenience method for adding a batch id to a message."""
+        store_metadata = msg['helper_metadata'].setdefault(
+            'message_store', {})
+        store_metadata['batch_id'] = batch_id
+
+    @staticmethod
+    def map_msg_to_batch_id(msg):
+        """Convenience method for retrieving a batch id that was added to a
+        message by :meth:`add_batch_id_to_msg`.
+        """
+        helper_metadata = msg.get('helper_metadata', {})
+        return helper_metadata.get('message_store', {}).get('batch_id')
+
+    def _lookup_cache_put(self, cache, key, value):
+        if not self.lookup_cache_size:
+            return
+        cache.pop(key, None)
+        cache[key] = value
+        while len(cache) > self.lookup_cache_size:
+            cache.popitem(last=False)
+
+    def _lookup_cache_get(self, cache, key):
+        entry = cache.pop(key, None)
+        if entry is None or entry[1] <= self.get_clocktime():
+            return None
+        cache[key] = entry
+        return entry[:1]
+
+    def _lookup_cache_expiry(self):
+        if self.lookup_cache_ttl is None:
+            return float('inf')
+        return self.get_clocktime() + self.lookup_cache_ttl
+
+    def _cache_tag_batch(self, tag, batch_id):
+        self._lookup_cache_put(
+            self._tag_batches, tuple(tag),
+            (batch_id, self._lookup_cache_expiry()))
+
+    def _cached_tag_batch(self, tag):
+        """Return a `(batch_id,)` tuple if the tag is cached, else None."""
+        return self._lookup_cache_get(self._tag_batches, tuple(tag))
+
+    def _cache_message_batch(self, msg_id, batch_id):
+        self._lookup_cache_put(
+            self._message_batches, msg_id,
+            (batch_id, self._lookup_cache_expiry()))
+
+    def _cached_message_batch(self, msg_id):
+        """Return a `(batch_id,)` tuple if the message is cached, else None.
+        """
+        return self._lookup_cache_get(self._message_batches, msg_id)
+
+    def _uncache_batch(self, batch_id):
+        for tag, (cached_batch_id, _) in self._tag_batches.items():
+            if cached_batch_id == batch_id:
+                del self._tag_batches[tag]
+
+    @Manager.calls_manager
+    def get_tag_batch_id(self, tag):
+        """Return the id of the batch a tag is currently associated with.
+        """
+        cached = self._cached_tag_batch(tag)
+        if cached is not None:
+            returnValue(cached[0])
+        tag_record = yield self.current_tags.load(tag)
+        batch_id = None
+        if tag_record is not None:
+            batch_id = tag_record.current_batch.key
+        self._cache_tag_batch(tag, batch_id)
+        returnValue(batch_id)
+
+    @Manager.calls_manager
+    def get_outbound_message_batch_id(self, msg_id):
+        """Return the id of the batch an outbound message belongs to.
+        """
+        cached = self._cached_message_batch(msg_id)
+        if cached is not None:
+            returnValue(cached[0])
+        msg_record = yield self.outbound_messages.load(msg_id)
+        if msg_record is None:
+            returnValue(None)
+        batch_id = msg_record.batch.key
+        self._cache_message_batch(msg_id, batch_id)
+        returnValue(batch_id)
 
     @Manager.calls_manager
     def needs_reconciliation(self, batch_id, delta=0.01):
@@ -103,18 +294,21 @@ class MessageStore(object):
         Check if a batch_id's cache values need to be reconciled with
         what's stored in the MessageStore.
 
+        This counts the batch's messages in Riak, which is slow for large
+        batches, so it's best run periodically rather than on demand.
+
         :param float delta:
             What an acceptable delta is for the cached values. Defaults to 0.01
             If the cached values are off by the delta then this returns True.
         """
-        inbound = float((yield self.batch_inbound_count(batch_id)))
+        inbound = float((yield self.batch_inbound_stored_count(batch_id)))
         cached_inbound = yield self.cache.count_inbound_message_keys(
             batch_id)
 
         if inbound and (abs(cached_inbound - inbound) / inbound) > delta:
             returnValue(True)
 
-        outbound = float((yield self.batch_outbound_count(batch_id)))
+        outbound = float((yield self.batch_outbound_stored_count(batch_id)))
         cached_outbound = yield self.cache.count_outbound_message_keys(
             batch_id)
 
@@ -132,33 +326,41 @@ class MessageStore(object):
 
     @Manager.calls_manager
     def reconcile_inbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        inbound_keys = yield self.batch_inbound_keys(batch_id)
-        for key in inbound_keys:
-            try:
-                msg = yield self.get_inbound_message(key)
-                yield self.cache.add_inbound_message(batch_id, msg)
-            except Exception:
-                log.err()
+        keys_page = yield self.batch_inbound_keys_page(batch_id)
+        while keys_page is not None:
+            for bunch in self.inbound_messages.load_all_bunches(
+                    list(keys_page)):
+                for msg in (yield bunch):
+                    try:
+                        yield self.cache.add_inbound_message(
+                            batch_id, msg.msg)
+                    except Exception:
+                        log.err()
+            keys_page = yield keys_page.next_page()
 
     @Manager.calls_manager
     def reconcile_outbound_cache(self, batch_id):
-        # FIXME: We're loading messages one at a time here, which is stupid.
-        outbound_keys = yield self.batch_outbound_keys(batch_id)
-        for key in outbound_keys:
-            try:
-                msg = yield self.get_outbound_message(key)
-                yield self.cache.add_outbound_message(batch_id, msg)
-                yield self.reconcile_event_cache(batch_id, key)
-            except Exception:
-                log.err()
+        keys_page = yield self.batch_outbound_keys_page(batch_id)
+        while keys_page is not None:
+            for bunch in self.outbound_messages.load_all_bunches(
+                    list(keys_page)):
+                for msg in (yield bunch):
+                    try:
+                        yield self.cache.add_outbound_message(
+                            batch_id, msg.msg)
+                        yield self.reconcile_event_cache(batch_id, msg.key)
+                    except Exception:
+                        log.err()
+            keys_page = yield keys_page.next_page()
 
     @Manager.calls_manager
     def reconcile_event_cache(self, batch_id, message_id):
-        event_keys = yield self.message_event_keys(message_id)
-        for event_key in event_keys:
-            event = yield self.get_event(event_key)
-            yield self.cache.add_event(batch_id, event)
+        keys_page = yield self.message_event_keys_page(message_id)
+        while keys_page is not None:
+            for bunch in self.events.load_all_bunches(list(keys_page)):
+                for event in (yield bunch):
+                    yield self.cache.add_event(batch_id, event.event)
+            keys_page = yield keys_page.next_page()
 
     @Manager.calls_manager
     def batch_start(self, tags, **metadata):
@@ -175,29 +377,35 @@ class MessageStore(object):
                 tag_record = self.current_tags(tag)
             tag_record.current_batch.set(batch)
             yield tag_record.save()
+            self._cache_tag_batch(tag, batch_id)
 
         yield self.cache.batch_start(batch_id)
         returnValue(batch_id)
 
     @Manager.calls_manager
     def batch_done(self, batch_id):
+        self._uncache_batch(batch_id)
         batch = yield self.batches.load(batch_id)
         tag_keys = yield batch.backlinks.currenttags()
         for tags_bunch in self.manager.load_all_bunches(CurrentTag, tag_keys):
             for tag in (yield tags_bunch):
                 tag.current_batch.set(None)
                 yield tag.save()
+                self._cache_tag_batch(tag.tag, None)
 
     @Manager.calls_manager
     def add_outbound_message(self, msg, tag=None, batch_id=None):
         msg_id = msg['message_id']
         msg_record = self.outbound_messages(msg_id, msg=msg)
 
+        if batch_id is None:
+            batch_id = self.map_msg_to_batch_id(msg)
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self.get_tag_batch_id(tag)
 
+        # Cache this first, so events for the message can be attributed
+        # while it's being stored.
+        self._cache_message_batch(msg_id, batch_id)
         if batch_id is not None:
             msg_record.batch.key = batch_id
             yield self.cache.add_outbound_message(batch_id, msg)
@@ -216,11 +424,11 @@ class MessageStore(object):
         event_record = self.events(event_id, event=event, message=msg_id)
         yield event_record.save()
 
-        msg_record = yield self.outbound_messages.load(msg_id)
-        if msg_record is not None:
-            batch_id = msg_record.batch.key
-            if batch_id is not None:
-                yield self.cache.add_event(batch_id, event)
+        batch_id = self.map_msg_to_batch_id(event)
+        if batch_id is None:
+            batch_id = yield self.get_outbound_message_batch_id(msg_id)
+        if batch_id is not None:
+            yield self.cache.add_event(batch_id, event)
 
     @Manager.calls_manager
     def get_event(self, event_id):
@@ -232,14 +440,14 @@ class MessageStore(object):
         msg_id = msg['message_id']
         msg_record = self.inbound_messages(msg_id, msg=msg)
 
+        if batch_id is None:
+            batch_id = self.map_msg_to_batch_id(msg)
         if batch_id is None and tag is not None:
-            tag_record = yield self.current_tags.load(tag)
-            if tag_record is not None:
-                batch_id = tag_record.current_batch.key
+            batch_id = yield self.get_tag_batch_id(tag)
 
         if batch_id is not None:
             msg_record.batch.key = batch_id
-            self.cache.add_inbound_message(batch_id, msg)
+            yield self.cache.add_inbound_message(batch_id, msg)
 
         yield msg_record.save()
 
@@ -265,6 +473,17 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(OutboundMessage, 'batch', batch_id)
         return mr.get_keys()
 
+    def batch_outbound_keys_page(self, batch_id,
+                                 max_results=DEFAULT_KEYS_PAGE_SIZE):
+        """Return the first page of keys of the outbound messages in a batch.
+
+        :returns:
+            An :class:`vumi.persist.model.IndexPage`. Use its ``next_page()``
+            method to fetch the rest of the keys.
+        """
+        return self.outbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results)
+
     def batch_outbound_keys_matching(self, batch_id, query):
         mr = self.outbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
@@ -273,6 +492,17 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(InboundMessage, 'batch', batch_id)
         return mr.get_keys()
 
+    def batch_inbound_keys_page(self, batch_id,
+                                max_results=DEFAULT_KEYS_PAGE_SIZE):
+        """Return the first page of keys of the inbound messages in a batch.
+
+        :returns:
+            An :class:`vumi.persist.model.IndexPage`. Use its ``next_page()``
+            method to fetch the rest of the keys.
+        """
+        return self.inbound_messages.index_keys_page(
+            'batch', batch_id, max_results=max_results)
+
     def batch_inbound_keys_matching(self, batch_id, query):
         mr = self.inbound_messages.index_match(query, 'batch', batch_id)
         return mr.get_keys()
@@ -281,11 +511,48 @@ class MessageStore(object):
         mr = self.manager.mr_from_field(Event, 'message', msg_id)
         return mr.get_keys()
 
+    def message_event_keys_page(self, msg_id,
+                                max_results=DEFAULT_KEYS_PAGE_SIZE):
+        """Return the first page of keys of the events for a message.
+
+        :returns:
+            An :class:`vumi.persist.model.IndexPage`. Use its ``next_page()``
+            method to fetch the rest of the keys.
+        """
+        return self.events.index_keys_page(
+            'message', msg_id, max_results=max_results)
+
     def batch_inbound_count(self, batch_id):
+        """Return the number of inbound messages in a batch.
+
+        This is read from the counts the cache keeps up to date as messages
+        are added, so it's cheap enough to poll.
+        """
+        return self.cache.count_inbound_message_keys(batch_id)
+
+    def batch_outbound_count(self, batch_id):
+        """Return the number of outbound messages in a batch.
+
+        This is read from the counts the cache keeps up to date as messages
+        are added, so it's cheap enough to poll.
+        """
+        return self.cache.count_outbound_message_keys(batch_id)
+
+    def batch_inbound_stored_count(self, batch_id):
+        """Count the inbound messages in a batch in Riak.
+
+        This runs a map-reduce over the batch's index, so should only be used
+        to check the cached counts. See :meth:`needs_reconciliation`.
+        """
         return self.inbound_messages.index_lookup(
             'batch', batch_id).get_count()
 
-    def batch_outbound_count(self, batch_id):
+    def batch_outbound_stored_count(self, batch_id):
+        """Count the outbound messages in a batch in Riak.
+
+        This runs a map-reduce over the batch's index, so should only be used
+        to check the cached counts. See :meth:`needs_reconciliation`.
+        """
         return self.outbound_messages.index_lookup(
             'batch', batch_id).get_count()
 
@@ -313,6 +580,9 @@ class MessageStore(object):
                 it assumes that the result of `batch_inbound_keys_matching`
                 is a Deferred.
         """
+        # Imported here so that importing the message store doesn't import
+        # riakasaurus, which is slow to import.
+        from vumi.persist.txriak_manager import TxRiakManager
         assert isinstance(self.manager, TxRiakManager), (
             "manager is not an instance of TxRiakManager")
         token = yield self.cache.start_query(batch_id, 'inbound', query)
@@ -414,3 +684,73 @@ class MessageStore(object):
         """
         return self.cache.get_outbound_message_keys(batch_id, start, stop,
             with_timestamp=with_timestamp)
+
+    def export_inbound_messages(self, batch_id, writer, formatter, start=0,
+                                page_size=None):
+        """
+        Write a batch's inbound messages to `writer`, oldest first.
+
+        See :meth:`export_outbound_messages`.
+        """
+        return self._export_messages(
+            self.inbound_messages, self.cache.get_inbound_message_keys,
+            batch_id, writer, formatter, start, page_size)
+
+    def export_outbound_messages(self, batch_id, writer, formatter, start=0,
+                                 page_size=None):
+        """
+        Write a batch's outbound messages to `writer`, oldest first.
+
+        Message keys are read from the cache a page at a time and the messages
+        on each page are loaded in bunches and written before the next page is
+        read, so memory use doesn't grow with the size of the batch.
+
+        :param str batch_id:
+            The batch_id to export messages for.
+        :param writer:
+            An object with a `write(data)` method, such as a file or an HTTP
+            request. If `write` returns a Deferred the export waits for it to
+            fire before continuing.
+        :param formatter:
+            A formatter from :data:`EXPORT_FORMATTERS`.
+        :param int start:
+            The offset of the first message to export. The header is only
+            written if this is 0.
+        :param int page_size:
+            The number of message keys to read at a time. Defaults to
+            `DEFAULT_KEYS_PAGE_SIZE`.
+
+        Returns the offset after the last exported message, which may be
+        passed as `start` to resume the export. Messages stored since the
+        export started are included if their timestamps are newer than the
+        last exported message.
+        """
+        return self._export_messages(
+            self.outbound_messages, self.cache.get_outbound_message_keys,
+            batch_id, writer, formatter, start, page_size)
+
+    @Manager.calls_manager
+    def _export_messages(self, messages, keys_cb, batch_id, writer,
+                         formatter, start, page_size):
+        if page_size is None:
+            page_size = self.DEFAULT_KEYS_PAGE_SIZE
+        offset = start
+        if offset == 0:
+            header = formatter.header()
+            if header:
+                yield writer.write(header)
+        while True:
+            keys = yield keys_cb(
+                batch_id, offset, offset + page_size - 1, asc=True)
+            loaded = {}
+            for bunch in messages.load_all_bunches(keys):
+                for msg in (yield bunch):
+                    loaded[msg.key] = msg.msg
+            data = ''.join(formatter.format(loaded[key]) for key in keys
+                           if loaded.get(key) is not None)
+            if data:
+                yield writer.write(data)
+            offset += len(keys)
+            if len(keys) < page_size:
+                break
+        returnValue(offset)
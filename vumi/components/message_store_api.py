@@ -2,14 +2,17 @@
 import json
 import functools
 
-from twisted.web import resource
+from zope.interface import implements
+from twisted.web import resource, http
 from twisted.web.server import NOT_DONE_YET
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred
+from twisted.internet.interfaces import IPushProducer
 
 from vumi.service import Worker
 from vumi.message import JSONMessageEncoder
 from vumi.transports.httprpc import httprpc
-from vumi.components.message_store import MessageStore
+from vumi.components.message_store import MessageStore, EXPORT_FORMATTERS
+from vumi import log
 from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 
@@ -115,7 +118,8 @@ class MatchResource(resource.Resource):
                                     if msg.msg])
 
             # sort the results in the order that the keys specified
-            messages.sort(key=lambda msg: keys.index(msg['message_id']))
+            key_order = dict((key, i) for i, key in enumerate(keys))
+            messages.sort(key=lambda msg: key_order[msg['message_id']])
             request.write(json.dumps(messages, cls=JSONMessageEncoder))
         request.finish()
 
@@ -135,6 +139,107 @@ class MatchResource(resource.Resource):
         return self
 
 
+class ExportAborted(Exception):
+    """Raised when the client of an export disconnects."""
+
+
+class RequestWriter(object):
+    """
+    Writes export data to a request, pausing the export while the
+    connection's send buffer is full.
+    """
+    implements(IPushProducer)
+
+    def __init__(self, request):
+        self.request = request
+        self.paused = None
+        self.stopped = False
+        request.registerProducer(self, True)
+        request.notifyFinish().addErrback(lambda _: self.stopProducing())
+
+    def pauseProducing(self):
+        if self.paused is None:
+            self.paused = Deferred()
+
+    def resumeProducing(self):
+        if self.paused is not None:
+            paused, self.paused = self.paused, None
+            paused.callback(None)
+
+    def stopProducing(self):
+        self.stopped = True
+        self.resumeProducing()
+
+    def write(self, data):
+        if self.stopped:
+            raise ExportAborted()
+        self.request.write(data)
+        return self.paused
+
+    def finish(self):
+        self.request.unregisterProducer()
+        if not self.stopped:
+            self.request.finish()
+
+    def abort(self):
+        """
+        Drop the connection without finishing the response, so the client
+        can tell that the export is incomplete.
+        """
+        self.request.unregisterProducer()
+        if not self.stopped:
+            self.request.transport.loseConnection()
+
+
+class ExportResource(resource.Resource):
+    """
+    A Resource that streams all of a batch's messages in the format given
+    by the `format` query parameter (`json` for newline-delimited JSON, the
+    default, or `csv`).
+
+    A `start` query parameter gives the offset of the first message to
+    export, which allows an interrupted export to be resumed.
+    """
+
+    isLeaf = True
+
+    def __init__(self, direction, message_store, batch_id):
+        resource.Resource.__init__(self)
+        self.batch_id = batch_id
+        self._export_cb = {
+            'inbound': message_store.export_inbound_messages,
+            'outbound': message_store.export_outbound_messages,
+        }.get(direction)
+
+    @inlineCallbacks
+    def _render_export(self, request, formatter, start):
+        writer = RequestWriter(request)
+        try:
+            yield self._export_cb(self.batch_id, writer, formatter, start)
+        except ExportAborted:
+            pass
+        except Exception:
+            log.err()
+            writer.abort()
+            return
+        writer.finish()
+
+    def render_GET(self, request):
+        format_name = request.args.get('format', ['json'])[0]
+        if format_name not in EXPORT_FORMATTERS:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Unknown export format: %r' % (format_name,)
+        formatter = EXPORT_FORMATTERS[format_name]()
+        try:
+            start = int(request.args.get('start', [0])[0])
+        except ValueError:
+            request.setResponseCode(http.BAD_REQUEST)
+            return 'Invalid start: %r' % (request.args['start'][0],)
+        request.setHeader('Content-Type', formatter.content_type)
+        self._render_export(request, formatter, start)
+        return NOT_DONE_YET
+
+
 class BatchResource(resource.Resource):
 
     def __init__(self, message_store, batch_id):
@@ -145,11 +250,15 @@ class BatchResource(resource.Resource):
         inbound = resource.Resource()
         inbound.putChild('match',
             MatchResource('inbound', message_store, batch_id))
+        inbound.putChild('export',
+            ExportResource('inbound', message_store, batch_id))
         self.putChild('inbound', inbound)
 
         outbound = resource.Resource()
         outbound.putChild('match',
             MatchResource('outbound', message_store, batch_id))
+        outbound.putChild('export',
+            ExportResource('outbound', message_store, batch_id))
         self.putChild('outbound', outbound)
 
     def render_GET(self, request):
@@ -0,0 +1,53 @@
+# -*- test-case-name: vumi.components.tests.test_message_store_migrators -*-
+
+"""Migrators for the message store models."""
+
+from vumi.persist.model import ModelMigrator
+
+
+class MessageMigratorBase(ModelMigrator):
+    """Base class for message store model migrators.
+
+    Unversioned message models store each message payload key as a separate
+    top-level key with a ``<field>.`` prefix. Version 1 stores the payload as
+    a single nested value under the field name.
+    """
+
+    def _nest_message(self, mdata, field):
+        prefix = "%s." % (field,)
+        payload = {}
+        for key, value in mdata.old_data.iteritems():
+            if key.startswith(prefix):
+                payload[key[len(prefix):]] = value
+        mdata.set_value(field, payload or None)
+
+    def _copy_foreign_key(self, mdata, field):
+        # Old-style foreign keys may only be stored in the index, in which
+        # case the field's clean() method restores the value on load.
+        if field in mdata.old_data:
+            mdata.copy_values(field)
+        mdata.copy_indexes("%s_bin" % (field,))
+
+
+class OutboundMessageMigrator(MessageMigratorBase):
+    def migrate_from_unversioned(self, mdata):
+        mdata.set_value('$VERSION', 1)
+        self._nest_message(mdata, 'msg')
+        self._copy_foreign_key(mdata, 'batch')
+        return mdata
+
+
+class EventMigrator(MessageMigratorBase):
+    def migrate_from_unversioned(self, mdata):
+        mdata.set_value('$VERSION', 1)
+        self._nest_message(mdata, 'event')
+        self._copy_foreign_key(mdata, 'message')
+        return mdata
+
+
+class InboundMessageMigrator(MessageMigratorBase):
+    def migrate_from_unversioned(self, mdata):
+        mdata.set_value('$VERSION', 1)
+        self._nest_message(mdata, 'msg')
+        self._copy_foreign_key(mdata, 'batch')
+        return mdata
@@ -3,8 +3,11 @@
 """Session management utilities."""
 
 import time
+from collections import OrderedDict
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, succeed)
 
 from vumi import log
 
@@ -12,57 +15,233 @@ from vumi import log
 class SessionManager(object):
     """A manager for sessions.
 
+    Active sessions are tracked in a sorted set index scored by expiry
+    time, so listing, counting and garbage collecting sessions doesn't
+    require scanning the Redis keyspace.
+
+    Sessions may optionally be cached in process. The cache is only safe
+    when all messages for a given user are handled by the same worker
+    (e.g. a single application worker behind a session-aware transport).
+    Where that affinity doesn't hold, `cache_ttl` should be set so that
+    cached sessions are reloaded from Redis regularly.
+
     :param TxRedisManager redis:
         Redis manager object.
     :param int max_session_length:
         Time before a session expires. Default is None (never expire).
     :param float gc_period:
         Deprecated and ignored.
+    :param int cache_size:
+        Maximum number of sessions to cache in process. The least recently
+        used sessions are evicted first. Default is None (no caching).
+    :param float cache_ttl:
+        Maximum time in seconds a cached session is used before it is
+        reloaded from Redis. Default is None (until the session expires).
+    :param float write_behind_delay:
+        If set, updates to cached sessions are batched and written to Redis
+        after this many seconds instead of immediately. Pending updates are
+        flushed when the manager is stopped. Default is None (write
+        immediately).
     """
 
-    def __init__(self, redis, max_session_length=None, gc_period=None):
+    INDEX_KEY = 'session_index'
+
+    def __init__(self, redis, max_session_length=None, gc_period=None,
+                 cache_size=None, cache_ttl=None, write_behind_delay=None):
         self.max_session_length = max_session_length
         self.redis = redis
+        self.clock = self.get_clock()
         if gc_period is not None:
             log.warning("SessionManager 'gc_period' parameter is deprecated.")
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.write_behind_delay = write_behind_delay
+        # user_id -> [session, cached_at, expires_at], in LRU order.
+        self._cache = OrderedDict()
+        # user_id -> session fields not yet written to Redis.
+        self._dirty = {}
+        # user_id -> whether an in-flight load may populate the cache.
+        self._loading = {}
+        self._flush_call = None
 
     @inlineCallbacks
     def stop(self, stop_redis=True):
+        yield self.flush_sessions()
         if stop_redis:
             yield self.redis._close()
 
     @classmethod
     def from_redis_config(cls, config, key_prefix=None,
-                          max_session_length=None, gc_period=None):
+                          max_session_length=None, gc_period=None, **kw):
         """Create a `SessionManager` instance using `TxRedisManager`.
+
+        Extra keyword arguments are passed through to the constructor.
         """
         from vumi.persist.txredis_manager import TxRedisManager
         d = TxRedisManager.from_config(config)
         if key_prefix is not None:
             d.addCallback(lambda m: m.sub_manager(key_prefix))
-        return d.addCallback(lambda m: cls(m, max_session_length, gc_period))
+        return d.addCallback(
+            lambda m: cls(m, max_session_length, gc_period, **kw))
+
+    def get_clock(self):
+        return reactor
+
+    def get_clocktime(self):
+        return self.clock.seconds()
+
+    def session_key(self, user_id):
+        return "%s:%s" % ('session', user_id)
+
+    def _encode(self, value):
+        # Match what Redis gives us back for stored values.
+        if isinstance(value, unicode):
+            return value.encode('utf-8')
+        return str(value)
+
+    def _cache_get(self, user_id):
+        entry = self._cache.pop(user_id, None)
+        if entry is None:
+            return None
+        session, cached_at, expires_at = entry
+        now = self.get_clocktime()
+        if expires_at <= now:
+            # The session has expired, so any pending writes go with it.
+            self._dirty.pop(user_id, None)
+            return None
+        if self.cache_ttl is not None and cached_at + self.cache_ttl <= now:
+            if user_id in self._dirty:
+                self._flush_session(user_id).addErrback(log.err)
+            return None
+        self._cache[user_id] = entry
+        return session
+
+    def _cache_put(self, user_id, session):
+        if not self.cache_size:
+            return
+        self._cache.pop(user_id, None)
+        self._cache[user_id] = [
+            session, self.get_clocktime(), self._session_expiry()]
+        while len(self._cache) > self.cache_size:
+            evicted_id, _ = self._cache.popitem(last=False)
+            if evicted_id in self._dirty:
+                self._flush_session(evicted_id).addErrback(log.err)
+
+    def _invalidate_load(self, user_id):
+        if user_id in self._loading:
+            self._loading[user_id] = False
+
+    def _cache_touch(self, user_id, timeout=None):
+        if timeout is None and not self.max_session_length:
+            # Keep any expiry set by schedule_session_expiry().
+            return
+        entry = self._cache.get(user_id)
+        if entry is not None:
+            entry[2] = self._session_expiry(timeout)
+
+    def invalidate_session(self, user_id):
+        """Drop a session from the local cache.
+
+        Any pending writes for the session are flushed to Redis first.
+        """
+        self._invalidate_load(user_id)
+        self._cache.pop(user_id, None)
+        return self._flush_session(user_id)
+
+    def _session_expiry(self, timeout=None):
+        if timeout is None:
+            timeout = self.max_session_length
+        if not timeout:
+            return float('inf')
+        return self.get_clocktime() + timeout
 
     @inlineCallbacks
-    def active_sessions(self):
-        """Return a list of active user_ids and associated sessions.
+    def _index_session(self, user_id, timeout=None):
+        expiry = self._session_expiry(timeout)
+        if expiry == float('inf'):
+            # Without a timeout we must not replace an expiry set earlier by
+            # schedule_session_expiry(), so only new sessions are added.
+            score = yield self.redis.zscore(self.INDEX_KEY, user_id)
+            if score is not None:
+                expiry = None
+        # Expired entries are trimmed on every write so that the index
+        # doesn't grow without bound.
+        pipe = self.redis.pipeline()
+        if expiry is not None:
+            pipe.zadd(self.INDEX_KEY, **{user_id: expiry})
+        self._trim_index(pipe)
+        yield pipe.execute()
+
+    def _trim_index(self, redis):
+        return redis.zremrangebyscore(
+            self.INDEX_KEY, '-inf', '(%r' % (self.get_clocktime(),))
+
+    def gc_sessions(self):
+        """Remove expired sessions from the session index.
 
-        Queries redis for keys starting with the session key prefix. This is
-        O(n) over the total number of keys in redis, but this is still pretty
-        quick even for millions of keys. Try not to hit this too often, though.
+        Expired session data is removed by Redis itself, so this only
+        needs to trim the index, which is also done whenever a session is
+        saved. Returns the number of entries removed.
         """
-        keys = yield self.redis.keys('session:*')
-        sessions = []
-        for user_id in [key.split(':', 1)[1] for key in keys]:
-            sessions.append((user_id, (yield self.load_session(user_id))))
+        return self._trim_index(self.redis)
 
-        returnValue(sessions)
+    @inlineCallbacks
+    def count_active_sessions(self):
+        """Return the number of active sessions.
+        """
+        count = yield self.redis.zcount(
+            self.INDEX_KEY, '%r' % (self.get_clocktime(),), '+inf')
+        returnValue(int(count))
+
+    @inlineCallbacks
+    def active_sessions(self, start=0, num=None):
+        """Return a list of active user_ids and associated sessions.
+
+        Sessions are listed in order of expiry from the session index, which
+        makes this O(log(n) + k) in the number of sessions returned rather
+        than O(n) over the keys in Redis. Expired index entries are garbage
+        collected first and the sessions are loaded concurrently.
+
+        :param int start:
+            Offset of the first session to return.
+        :param int num:
+            Maximum number of sessions to return. Default is None (all
+            remaining sessions).
+        """
+        yield self.gc_sessions()
+        user_ids = yield self.redis.zrangebyscore(
+            self.INDEX_KEY, '%r' % (self.get_clocktime(),), '+inf',
+            start, -1 if num is None else num)
+        sessions = yield gatherResults(
+            [self._load_session(user_id, cache=False)
+             for user_id in user_ids])
+        # Sessions cleared or expired since we read the index are empty.
+        returnValue([(user_id, session) for user_id, session
+                     in zip(user_ids, sessions) if session])
 
     def load_session(self, user_id):
         """
-        Load session data from Redis
+        Load session data from the cache or Redis
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.hgetall(ukey)
+        return self._load_session(user_id)
+
+    def _load_session(self, user_id, cache=True):
+        session = self._cache_get(user_id)
+        if session is not None:
+            return succeed(dict(session))
+        d = self._flush_session(user_id)
+        d.addCallback(lambda _: self.redis.hgetall(self.session_key(user_id)))
+        if cache and self.cache_size:
+            self._loading[user_id] = True
+            d.addCallback(self._loaded_session, user_id)
+        return d
+
+    def _loaded_session(self, session, user_id):
+        # Only cache the result if the session wasn't modified while we were
+        # waiting for it.
+        if self._loading.pop(user_id, False) and session:
+            self._cache_put(user_id, dict(session))
+        return session
 
     def schedule_session_expiry(self, user_id, timeout):
         """
@@ -75,8 +254,13 @@ class SessionManager(object):
         timeout : int
             The number of seconds after which this session should expire
         """
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.expire(ukey, timeout)
+        self._cache_touch(user_id, timeout)
+        d = self._flush_session(user_id)
+        d.addCallback(lambda _: gatherResults([
+            self.redis.expire(self.session_key(user_id), timeout),
+            self._index_session(user_id, timeout),
+            ]))
+        return d
 
     @inlineCallbacks
     def create_session(self, user_id, **kwargs):
@@ -88,20 +272,27 @@ class SessionManager(object):
         }
         defaults.update(kwargs)
         yield self.save_session(user_id, defaults)
-        if self.max_session_length:
-            yield self.schedule_session_expiry(user_id,
-                                               int(self.max_session_length))
         returnValue((yield self.load_session(user_id)))
 
     def clear_session(self, user_id):
-        ukey = "%s:%s" % ('session', user_id)
-        return self.redis.delete(ukey)
+        self._invalidate_load(user_id)
+        self._cache.pop(user_id, None)
+        self._dirty.pop(user_id, None)
+        return gatherResults([
+            self.redis.delete(self.session_key(user_id)),
+            self.redis.zrem(self.INDEX_KEY, user_id),
+            ]).addCallback(lambda results: results[0])
 
-    @inlineCallbacks
     def save_session(self, user_id, session):
         """
         Save a session
 
+        The session fields are written with a single HMSET and, if
+        `max_session_length` is set, the session's expiry is refreshed. These
+        commands are sent together rather than waiting for each reply. If
+        the session is cached and `write_behind_delay` is set, the write is
+        deferred and batched with other pending writes.
+
         Parameters
         ----------
         user_id : str
@@ -111,7 +302,53 @@ class SessionManager(object):
             values that are dictionaries are converted to strings by Redis.
 
         """
-        ukey = "%s:%s" % ('session', user_id)
-        for s_key, s_value in session.items():
-            yield self.redis.hset(ukey, s_key, s_value)
-        returnValue(session)
+        if not session:
+            return succeed(session)
+        fields = dict((k, self._encode(v)) for k, v in session.iteritems())
+        cached = self._cache_get(user_id)
+        if cached is not None:
+            cached.update(fields)
+            self._cache_touch(user_id)
+            if self.write_behind_delay is not None:
+                self._dirty.setdefault(user_id, {}).update(fields)
+                self._schedule_flush()
+                return succeed(session)
+        self._invalidate_load(user_id)
+        d = self._write_session(user_id, fields)
+        return d.addCallback(lambda _: session)
+
+    def _schedule_flush(self):
+        if self._flush_call is None or not self._flush_call.active():
+            self._flush_call = self.clock.callLater(
+                self.write_behind_delay, self._flush_from_timer)
+
+    def _flush_from_timer(self):
+        self._flush_call = None
+        return self.flush_sessions().addErrback(log.err)
+
+    def _flush_session(self, user_id):
+        fields = self._dirty.pop(user_id, None)
+        if fields is None:
+            return succeed(None)
+        return self._write_session(user_id, fields)
+
+    def flush_sessions(self):
+        """Write all pending session updates to Redis.
+        """
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        dirty, self._dirty = self._dirty, {}
+        return gatherResults([self._write_session(user_id, fields)
+                              for user_id, fields in dirty.iteritems()])
+
+    @inlineCallbacks
+    def _write_session(self, user_id, session):
+        if session:
+            ukey = self.session_key(user_id)
+            deferreds = [self.redis.hmset(ukey, session)]
+            if self.max_session_length:
+                deferreds.append(self.redis.expire(
+                    ukey, int(self.max_session_length)))
+            deferreds.append(self._index_session(user_id))
+            yield gatherResults(deferreds)
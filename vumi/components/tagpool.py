@@ -19,12 +19,29 @@ class TagpoolError(VumiError):
 class TagpoolManager(object):
     """Manage a set of tag pools.
 
+    Each pool has a free set, an in-use set and a free list that determines
+    the order in which free tags are handed out. A tag is acquired or
+    released by moving it between the free and in-use sets, so the sets are
+    authoritative. The free list may contain stale entries for tags
+    acquired with :meth:`acquire_specific_tag`, which are skipped when they
+    reach the head of the list. A listed set tracks which tags are in the
+    free list so that releasing a tag never adds a second entry for it.
+
+    All of a pool's keys for a tag, including the reason it was acquired,
+    are updated in a single transaction so that a crash can't leave a tag
+    half acquired or released. The per-owner index used by
+    :meth:`owned_tags` may be on another Redis shard and is updated
+    afterwards.
+
     :param redis:
         An instance of :class:`vumi.persist.redis_base.Manager`.
     """
 
     encoding = "UTF-8"
 
+    # Maximum number of tags to declare per Redis command.
+    declare_chunk_size = 10000
+
     def __init__(self, redis):
         self.redis = redis
         self.manager = redis  # TODO: This is a bit of a hack to make the
@@ -62,6 +79,7 @@ class TagpoolManager(object):
             pools.setdefault(pool, []).append(local_tag)
         for pool, local_tags in pools.items():
             yield self._register_pool(pool)
+            yield self._backfill_listed(pool)
             yield self._declare_tags(pool, local_tags)
 
     @Manager.calls_manager
@@ -85,15 +103,16 @@ class TagpoolManager(object):
     def purge_pool(self, pool):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
         metadata_key = self._tag_pool_metadata_key(pool)
+        listed_set_key = self._tag_pool_listed_key(pool)
         in_use_count = yield self.redis.scard(inuse_set_key)
         if in_use_count:
             raise TagpoolError('%s tags of pool %s still in use.' % (
                                in_use_count, pool))
         else:
-            yield self.redis.delete(free_set_key)
-            yield self.redis.delete(free_list_key)
-            yield self.redis.delete(inuse_set_key)
-            yield self.redis.delete(metadata_key)
+            reason_hash_key = self._tag_pool_reason_key(pool)
+            yield self.redis.delete(free_set_key, free_list_key,
+                                    inuse_set_key, metadata_key,
+                                    reason_hash_key, listed_set_key)
             yield self._unregister_pool(pool)
 
     @Manager.calls_manager
@@ -152,55 +171,152 @@ class TagpoolManager(object):
         pool_list_key = self._pool_list_key()
         yield self.redis.srem(pool_list_key, pool)
 
+    def _tag_pool_name(self, pool):
+        # A pool's keys are used together, so they need to be on the same
+        # shard if Redis is sharded.
+        return self.redis.hash_tag(self._encode(pool))
+
     def _tag_pool_keys(self, pool):
-        pool = self._encode(pool)
+        pool = self._tag_pool_name(pool)
         return tuple(":".join(["tagpools", pool, state])
                      for state in ("free:list", "free:set", "inuse:set"))
 
     def _tag_pool_metadata_key(self, pool):
-        pool = self._encode(pool)
+        pool = self._tag_pool_name(pool)
         return ":".join(["tagpools", pool, "metadata"])
 
+    def _tag_pool_listed_key(self, pool):
+        pool = self._tag_pool_name(pool)
+        return ":".join(["tagpools", pool, "free:listed"])
+
     @Manager.calls_manager
     def _acquire_tag(self, pool, owner, reason):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        tag = yield self.redis.lpop(free_list_key)
-        if tag is not None:
-            yield self.redis.smove(free_set_key, inuse_set_key, tag)
-            yield self._store_reason(pool, tag, owner, reason)
-        returnValue(self._decode(tag) if tag is not None else None)
+        listed_set_key = self._tag_pool_listed_key(pool)
+        reason_hash_key = self._tag_pool_reason_key(pool)
+        raw_reason = self._encode_reason(owner, reason)
+        while True:
+            head = yield self.redis.lrange(free_list_key, 0, 0)
+            if not head:
+                returnValue(None)
+            [tag] = head
+            # The SMOVE is what actually hands out the tag. It fails if
+            # another worker got the tag first or the entry is stale, and
+            # then HSETNX leaves the current holder's reason alone.
+            pipe = self.redis.multi()
+            pipe.lrem(free_list_key, tag, 1)
+            pipe.srem(listed_set_key, tag)
+            pipe.smove(free_set_key, inuse_set_key, tag)
+            pipe.hsetnx(reason_hash_key, tag, raw_reason)
+            _removed, _unlisted, moved, reason_set = yield pipe.execute()
+            if moved:
+                break
+            if reason_set:
+                # The tag isn't in use at all, so it shouldn't have a reason.
+                yield self.redis.hdel(reason_hash_key, tag)
+        yield self._acquired(pool, tag, owner, raw_reason, reason_set)
+        returnValue(self._decode(tag))
 
     @Manager.calls_manager
     def _acquire_specific_tag(self, pool, local_tag, owner, reason):
         local_tag = self._encode(local_tag)
-        free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        moved = yield self.redis.lrem(free_list_key, local_tag, num=1)
+        _free_list, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        reason_hash_key = self._tag_pool_reason_key(pool)
+        raw_reason = self._encode_reason(owner, reason)
+        # We leave the tag in the free list rather than searching for it.
+        # _acquire_tag() skips it when it reaches the head of the list.
+        pipe = self.redis.multi()
+        pipe.smove(free_set_key, inuse_set_key, local_tag)
+        pipe.hsetnx(reason_hash_key, local_tag, raw_reason)
+        moved, reason_set = yield pipe.execute()
         if moved:
-            yield self.redis.smove(free_set_key, inuse_set_key, local_tag)
-            yield self._store_reason(pool, local_tag, owner, reason)
+            yield self._acquired(pool, local_tag, owner, raw_reason,
+                                 reason_set)
+        elif reason_set:
+            yield self.redis.hdel(reason_hash_key, local_tag)
         returnValue(moved)
 
+    @Manager.calls_manager
+    def _acquired(self, pool, local_tag, owner, raw_reason, reason_set):
+        if not reason_set:
+            # An older release left its reason behind, so replace it.
+            yield self.redis.hset(
+                self._tag_pool_reason_key(pool), local_tag, raw_reason)
+        yield self.redis.sadd(self._owner_tag_list_key(owner),
+                              json.dumps([pool, self._decode(local_tag)]))
+
     @Manager.calls_manager
     def _release_tag(self, pool, local_tag):
         local_tag = self._encode(local_tag)
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
-        count = yield self.redis.smove(inuse_set_key, free_set_key, local_tag)
-        if count == 1:
+        listed_set_key = self._tag_pool_listed_key(pool)
+        reason_hash_key = self._tag_pool_reason_key(pool)
+        pipe = self.redis.pipeline()
+        pipe.sismember(inuse_set_key, local_tag)
+        pipe.sismember(listed_set_key, local_tag)
+        pipe.hget(reason_hash_key, local_tag)
+        in_use, listed, raw_reason = yield pipe.execute()
+        if not in_use:
+            return
+        pipe = self.redis.multi()
+        pipe.smove(inuse_set_key, free_set_key, local_tag)
+        pipe.hdel(reason_hash_key, local_tag)
+        pipe.sadd(listed_set_key, local_tag)
+        if not listed:
+            # A specifically acquired tag may still have a free list entry,
+            # in which case it doesn't get another one.
+            pipe.rpush(free_list_key, local_tag)
+        moved, _removed, newly_listed = (yield pipe.execute())[:3]
+        if moved and listed and newly_listed:
+            # The stale entry was dropped from the free list after we
+            # checked, so the tag needs a new one.
             yield self.redis.rpush(free_list_key, local_tag)
-            yield self._remove_reason(pool, local_tag)
+        if moved and raw_reason is not None:
+            owner = json.loads(raw_reason).get('owner')
+            yield self.redis.srem(self._owner_tag_list_key(owner),
+                                  json.dumps([pool, self._decode(local_tag)]))
 
     @Manager.calls_manager
     def _declare_tags(self, pool, local_tags):
         free_list_key, free_set_key, inuse_set_key = self._tag_pool_keys(pool)
+        listed_set_key = self._tag_pool_listed_key(pool)
         new_tags = set(self._encode(tag) for tag in local_tags)
         old_tags = yield self.redis.sunion(free_set_key, inuse_set_key)
-        old_tags = set(old_tags)
-        for tag in sorted(new_tags - old_tags):
-            yield self.redis.sadd(free_set_key, tag)
-            yield self.redis.rpush(free_list_key, tag)
+        new_tags = sorted(new_tags - set(old_tags))
+        chunk_size = self.declare_chunk_size
+        for i in range(0, len(new_tags), chunk_size):
+            chunk = new_tags[i:i + chunk_size]
+            pipe = self.redis.multi()
+            pipe.sadd(free_set_key, *chunk)
+            pipe.sadd(listed_set_key, *chunk)
+            pipe.rpush(free_list_key, *chunk)
+            yield pipe.execute()
+
+    @Manager.calls_manager
+    def _backfill_listed(self, pool):
+        """Build the listed set for a pool created before it existed."""
+        free_list_key, _free_set, _inuse_set = self._tag_pool_keys(pool)
+        listed_set_key = self._tag_pool_listed_key(pool)
+        if (yield self.redis.exists(listed_set_key)):
+            return
+        listed_tags = yield self.redis.lrange(free_list_key, 0, -1)
+        if not listed_tags:
+            return
+        pipe = self.redis.multi()
+        pipe.sadd(listed_set_key, *listed_tags)
+        pipe.lrange(free_list_key, 0, -1)
+        _added, still_listed = yield pipe.execute()
+        # Tags acquired while we were reading the list aren't listed any
+        # more, and releasing them again must put them back in the list.
+        unlisted = set(listed_tags) - set(still_listed)
+        if unlisted:
+            pipe = self.redis.pipeline()
+            for tag in unlisted:
+                pipe.srem(listed_set_key, tag)
+            yield pipe.execute()
 
     def _tag_pool_reason_key(self, pool):
-        pool = self._encode(pool)
+        pool = self._tag_pool_name(pool)
         return ":".join(["tagpools", pool, "reason:hash"])
 
     def _owner_tag_list_key(self, owner):
@@ -209,25 +325,9 @@ class TagpoolManager(object):
         owner = self._encode(owner)
         return ":".join(["tagpools", "owners", owner, "tags"])
 
-    @Manager.calls_manager
-    def _store_reason(self, pool, local_tag, owner, reason):
+    def _encode_reason(self, owner, reason):
         if reason is None:
             reason = {}
         reason['timestamp'] = time.time()
         reason['owner'] = owner
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        yield self.redis.hset(reason_hash_key, local_tag, json.dumps(reason))
-        owner_tag_list_key = self._owner_tag_list_key(owner)
-        yield self.redis.sadd(owner_tag_list_key,
-                              json.dumps([pool, self._decode(local_tag)]))
-
-    @Manager.calls_manager
-    def _remove_reason(self, pool, local_tag):
-        reason_hash_key = self._tag_pool_reason_key(pool)
-        reason = yield self.redis.hget(reason_hash_key, local_tag)
-        if reason is not None:
-            reason = json.loads(reason)
-            owner = reason.get('owner')
-            owner_tag_list_key = self._owner_tag_list_key(owner)
-            self.redis.srem(owner_tag_list_key,
-                            json.dumps([pool, self._decode(local_tag)]))
+        return json.dumps(reason)
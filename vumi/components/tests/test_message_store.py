@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 
 """Tests for vumi.components.message_store."""
+import csv
 import time
 from datetime import datetime, timedelta
+from StringIO import StringIO
 
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import Clock
+from twisted.trial.unittest import TestCase
 
-from vumi.message import TransportEvent
+from vumi.message import TransportEvent, TransportUserMessage
 from vumi.application.tests.test_base import ApplicationTestCase
 from vumi.components import MessageStore
+from vumi.components.message_store import (
+    JsonLinesMessageFormatter, CsvMessageFormatter)
 
 
 class TestMessageStoreBase(ApplicationTestCase):
@@ -282,6 +288,100 @@ class TestMessageStore(TestMessageStoreBase):
                 message_id=TransportEvent.generate_id()), batch_id=batch_id)
         self.assertEqual(2, (yield self.store.batch_outbound_count(batch_id)))
 
+    @inlineCallbacks
+    def test_counts_ignore_duplicate_messages(self):
+        msg_id, msg, batch_id = yield self._create_inbound(by_batch=True)
+        yield self.store.add_inbound_message(msg, batch_id=batch_id)
+        self.assertEqual(1, (yield self.store.batch_inbound_count(batch_id)))
+        msg_id, msg, batch_id = yield self._create_outbound(by_batch=True)
+        yield self.store.add_outbound_message(msg, batch_id=batch_id)
+        self.assertEqual(1, (yield self.store.batch_outbound_count(batch_id)))
+
+    @inlineCallbacks
+    def test_stored_counts(self):
+        _msg_id, _msg, batch_id = yield self._create_inbound(by_batch=True)
+        yield self.store.cache.clear_batch(batch_id)
+        self.assertEqual(0, (yield self.store.batch_inbound_count(batch_id)))
+        self.assertEqual(
+            1, (yield self.store.batch_inbound_stored_count(batch_id)))
+        self.assertEqual(
+            0, (yield self.store.batch_outbound_stored_count(batch_id)))
+
+    @inlineCallbacks
+    def test_export_inbound_messages(self):
+        batch_id = yield self.store.batch_start([])
+        messages = yield self.create_inbound_messages(batch_id, 3)
+        output = StringIO()
+        offset = yield self.store.export_inbound_messages(
+            batch_id, output, JsonLinesMessageFormatter(), page_size=2)
+        self.assertEqual(offset, 3)
+        self.assertEqual(
+            [TransportUserMessage.from_json(line)
+             for line in output.getvalue().splitlines()],
+            list(reversed(messages)))
+
+    @inlineCallbacks
+    def test_export_outbound_messages_csv(self):
+        batch_id = yield self.store.batch_start([])
+        messages = yield self.create_outbound_messages(batch_id, 2)
+        output = StringIO()
+        offset = yield self.store.export_outbound_messages(
+            batch_id, output, CsvMessageFormatter())
+        self.assertEqual(offset, 2)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual(rows[0], CsvMessageFormatter.FIELDS)
+        self.assertEqual([row[0] for row in rows[1:]],
+                         [msg['message_id'] for msg in reversed(messages)])
+
+    @inlineCallbacks
+    def test_export_messages_resume(self):
+        batch_id = yield self.store.batch_start([])
+        messages = yield self.create_inbound_messages(batch_id, 3)
+        output = StringIO()
+        offset = yield self.store.export_inbound_messages(
+            batch_id, output, CsvMessageFormatter(), start=1)
+        self.assertEqual(offset, 3)
+        rows = list(csv.reader(StringIO(output.getvalue())))
+        self.assertEqual([row[0] for row in rows],
+                         [msg['message_id'] for msg in messages[1::-1]])
+
+    @inlineCallbacks
+    def test_batch_inbound_keys_page(self):
+        batch_id = yield self.store.batch_start([])
+        messages = yield self.create_inbound_messages(batch_id, 3)
+        keys_page = yield self.store.batch_inbound_keys_page(
+            batch_id, max_results=2)
+        keys = list(keys_page)
+        self.assertEqual(len(keys), 2)
+        keys_page = yield keys_page.next_page()
+        keys.extend(keys_page)
+        self.assertFalse(keys_page.has_next_page())
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in messages))
+
+    @inlineCallbacks
+    def test_batch_outbound_keys_page(self):
+        batch_id = yield self.store.batch_start([])
+        messages = yield self.create_outbound_messages(batch_id, 3)
+        keys_page = yield self.store.batch_outbound_keys_page(
+            batch_id, max_results=2)
+        keys = list(keys_page)
+        self.assertEqual(len(keys), 2)
+        keys_page = yield keys_page.next_page()
+        keys.extend(keys_page)
+        self.assertFalse(keys_page.has_next_page())
+        self.assertEqual(
+            sorted(keys), sorted(msg['message_id'] for msg in messages))
+
+    @inlineCallbacks
+    def test_message_event_keys_page(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        ack = self.mkmsg_ack(user_message_id=msg_id)
+        yield self.store.add_event(ack)
+        keys_page = yield self.store.message_event_keys_page(msg_id)
+        self.assertEqual(list(keys_page), [ack['event_id']])
+        self.assertFalse(keys_page.has_next_page())
+
     @inlineCallbacks
     def test_inbound_keys_matching(self):
         msg_id, msg, batch_id = yield self._create_inbound(content='hello')
@@ -344,6 +444,95 @@ class TestMessageStore(TestMessageStoreBase):
             }])))
 
 
+class TestMessageStoreLookupCache(TestMessageStoreBase):
+
+    @inlineCallbacks
+    def setUp(self):
+        yield super(TestMessageStoreLookupCache, self).setUp()
+        self.clock = Clock()
+        self.patch(MessageStore, 'get_clock', lambda _: self.clock)
+        self.store = MessageStore(self.manager, self.redis,
+                                  lookup_cache_size=10, lookup_cache_ttl=5)
+
+    @inlineCallbacks
+    def test_batch_start_caches_tags(self):
+        tag1 = ("poolA", "tag1")
+        batch_id = yield self.store.batch_start([tag1])
+        self.assertEqual(self.store._cached_tag_batch(tag1), (batch_id,))
+        self.clock.advance(5)
+        self.assertEqual(self.store._cached_tag_batch(tag1), None)
+
+    @inlineCallbacks
+    def test_batch_done_uncaches_tags(self):
+        tag1 = ("poolA", "tag1")
+        batch_id = yield self.store.batch_start([tag1])
+        yield self.store.batch_done(batch_id)
+        self.assertEqual(self.store._cached_tag_batch(tag1), (None,))
+        batch_id = yield self.store.get_tag_batch_id(tag1)
+        self.assertEqual(batch_id, None)
+
+    @inlineCallbacks
+    def test_get_tag_batch_id(self):
+        tag1 = ("poolA", "tag1")
+        other_store = MessageStore(self.manager, self.redis)
+        batch_id = yield other_store.batch_start([tag1])
+        self.assertEqual((yield self.store.get_tag_batch_id(tag1)), batch_id)
+        self.assertEqual(self.store._cached_tag_batch(tag1), (batch_id,))
+
+        # Changes made elsewhere are only seen once the cache expires.
+        yield other_store.batch_done(batch_id)
+        self.assertEqual((yield self.store.get_tag_batch_id(tag1)), batch_id)
+        self.clock.advance(5)
+        self.assertEqual((yield self.store.get_tag_batch_id(tag1)), None)
+
+    @inlineCallbacks
+    def test_lookup_cache_size(self):
+        for i in range(11):
+            yield self.store.get_tag_batch_id(("poolA", "tag%d" % (i,)))
+        self.assertEqual(self.store._cached_tag_batch(("poolA", "tag0")), None)
+        self.assertEqual(
+            self.store._cached_tag_batch(("poolA", "tag10")), (None,))
+
+    @inlineCallbacks
+    def test_add_ack_event_uses_cached_message_batch(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        msg_record = yield self.store.outbound_messages.load(msg_id)
+        msg_record.batch.key = None
+        yield msg_record.save()
+
+        yield self.store.add_event(self.mkmsg_ack(user_message_id=msg_id))
+        batch_status = yield self.store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(sent=1, ack=1))
+
+    @inlineCallbacks
+    def test_message_batch_cache_expires(self):
+        msg_id, msg, batch_id = yield self._create_outbound()
+        self.assertEqual(self.store._cached_message_batch(msg_id), (batch_id,))
+        self.clock.advance(5)
+        self.assertEqual(self.store._cached_message_batch(msg_id), None)
+
+    @inlineCallbacks
+    def test_add_ack_event_with_batch_id_in_metadata(self):
+        store = MessageStore(self.manager, self.redis)
+        batch_id = yield store.batch_start([])
+        ack = self.mkmsg_ack(user_message_id="unknown")
+        MessageStore.add_batch_id_to_msg(ack, batch_id)
+        yield store.add_event(ack)
+
+        batch_status = yield store.batch_status(batch_id)
+        self.assertEqual(batch_status, self._batch_status(ack=1))
+
+    @inlineCallbacks
+    def test_add_inbound_message_with_batch_id_in_metadata(self):
+        batch_id = yield self.store.batch_start([])
+        msg = self.mkmsg_in(message_id=TransportEvent.generate_id())
+        MessageStore.add_batch_id_to_msg(msg, batch_id)
+        yield self.store.add_inbound_message(msg)
+
+        inbound_keys = yield self.store.batch_inbound_keys(batch_id)
+        self.assertEqual(inbound_keys, [msg['message_id']])
+
+
 class TestMessageStoreCache(TestMessageStoreBase):
 
     def clear_cache(self, message_store):
@@ -523,3 +712,34 @@ class TestMessageStoreCache(TestMessageStoreBase):
             found = results[msg['message_id']]
             expected = time.mktime(msg['timestamp'].timetuple())
             self.assertAlmostEqual(found, expected)
+
+
+class TestMessageFormatters(TestCase):
+
+    def mkmsg(self, **kw):
+        kw.setdefault("transport_name", "sphex")
+        kw.setdefault("transport_type", "sms")
+        kw.setdefault("to_addr", "1234")
+        kw.setdefault("from_addr", "5678")
+        return TransportUserMessage(**kw)
+
+    def test_json_lines(self):
+        formatter = JsonLinesMessageFormatter()
+        msg = self.mkmsg(content=u"hello\nworld")
+        self.assertEqual(formatter.header(), '')
+        line = formatter.format(msg)
+        self.assertEqual(line.count('\n'), 1)
+        self.assertEqual(TransportUserMessage.from_json(line), msg)
+
+    def test_csv(self):
+        formatter = CsvMessageFormatter()
+        msg = self.mkmsg(content=u"hell\xf8, world")
+        [header, row] = list(csv.reader(StringIO(
+            formatter.header() + formatter.format(msg))))
+        self.assertEqual(header, CsvMessageFormatter.FIELDS)
+        values = dict(zip(header, row))
+        self.assertEqual(values['message_id'], msg['message_id'])
+        self.assertEqual(values['content'], u"hell\xf8, world".encode('utf-8'))
+        self.assertEqual(values['timestamp'], msg['timestamp'].strftime(
+            "%Y-%m-%d %H:%M:%S.%f"))
+        self.assertEqual(values['in_reply_to'], '')
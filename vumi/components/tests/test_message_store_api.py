@@ -3,6 +3,7 @@ from datetime import datetime, timedelta
 
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.web.client import ResponseFailed
 
 from vumi.components.message_store_api import (MatchResource,
                                                 MessageStoreAPIWorker)
@@ -11,6 +12,10 @@ from vumi.tests.utils import PersistenceMixin, VumiWorkerTestCase
 from vumi.message import TransportUserMessage
 
 
+class ExportTestError(Exception):
+    pass
+
+
 class MessageStoreAPITestCase(VumiWorkerTestCase, PersistenceMixin):
 
     use_riak = True
@@ -254,3 +259,53 @@ class MessageStoreAPITestCase(VumiWorkerTestCase, PersistenceMixin):
         self.assertResultCount(response, 0)
         self.assertEqual(json.loads(response.delivered_body), [])
         self.assertEqual(response.code, 200)
+
+    @inlineCallbacks
+    def test_inbound_export_resource(self):
+        messages = yield self.create_inbound(self.batch_id, 3,
+                                             'hello world {0}')
+        response = yield self.do_get('batch/%s/inbound/export/' % (
+            self.batch_id,))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(
+            [TransportUserMessage.from_json(line)
+             for line in response.delivered_body.splitlines()],
+            list(reversed(messages)))
+
+    @inlineCallbacks
+    def test_outbound_export_resource_csv(self):
+        messages = yield self.create_outbound(self.batch_id, 3,
+                                              'hello world {0}')
+        response = yield self.do_get(
+            'batch/%s/outbound/export/?format=csv&start=1' % (self.batch_id,))
+        self.assertEqual(response.code, 200)
+        self.assertEqual(response.headers.getRawHeaders('Content-Type'),
+                         ['text/csv; charset=utf-8'])
+        rows = response.delivered_body.splitlines()
+        self.assertEqual([row.split(',')[0] for row in rows],
+                         [msg['message_id'] for msg in messages[1::-1]])
+
+    @inlineCallbacks
+    def test_export_resource_failure(self):
+        def failing_export(batch_id, writer, formatter, start):
+            writer.write('{}\n')
+            raise ExportTestError("Export failed")
+
+        self.patch(self.store, 'export_inbound_messages', failing_export)
+        yield self.assertFailure(self.do_get(
+            'batch/%s/inbound/export/' % (self.batch_id,)), ResponseFailed)
+        [failure] = self.flushLoggedErrors(ExportTestError)
+        self.assertEqual(failure.getErrorMessage(), "Export failed")
+
+    @inlineCallbacks
+    def test_export_resource_unknown_format(self):
+        response = yield self.do_get(
+            'batch/%s/inbound/export/?format=xml' % (self.batch_id,))
+        self.assertEqual(response.code, 400)
+
+    @inlineCallbacks
+    def test_export_resource_invalid_start(self):
+        response = yield self.do_get(
+            'batch/%s/inbound/export/?start=foo' % (self.batch_id,))
+        self.assertEqual(response.code, 400)
+        self.assertEqual(response.delivered_body, "Invalid start: 'foo'")
@@ -0,0 +1,100 @@
+"""Tests for vumi.components.message_store_migrators."""
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.trial.unittest import TestCase
+
+from vumi.message import TransportEvent, TransportUserMessage
+from vumi.persist.model import Model
+from vumi.persist.fields import VumiMessage, ForeignKey
+from vumi.components.message_store import (
+    Batch, OutboundMessage, Event, InboundMessage)
+from vumi.tests.utils import PersistenceMixin
+
+
+class OutboundMessageVNone(Model):
+    bucket = 'outboundmessage'
+    msg = VumiMessage(TransportUserMessage)
+    batch = ForeignKey(Batch, null=True)
+
+
+class EventVNone(Model):
+    bucket = 'event'
+    event = VumiMessage(TransportEvent)
+    message = ForeignKey(OutboundMessageVNone)
+
+
+class InboundMessageVNone(Model):
+    bucket = 'inboundmessage'
+    msg = VumiMessage(TransportUserMessage)
+    batch = ForeignKey(Batch, null=True)
+
+
+class TestMigratorBase(PersistenceMixin, TestCase):
+    use_riak = True
+
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = self.get_riak_manager()
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mkmsg(self, **kw):
+        kw.setdefault("transport_name", "sphex")
+        kw.setdefault("transport_type", "sphex_type")
+        kw.setdefault("to_addr", "1234")
+        kw.setdefault("from_addr", "5678")
+        return TransportUserMessage(**kw)
+
+    def mkevent(self, user_message_id):
+        return TransportEvent(
+            event_type='ack', user_message_id=user_message_id,
+            sent_message_id='abc')
+
+
+class TestOutboundMessageMigrator(TestMigratorBase):
+    @inlineCallbacks
+    def test_migrate_from_unversioned(self):
+        old_model = self.manager.proxy(OutboundMessageVNone)
+        new_model = self.manager.proxy(OutboundMessage)
+        batch = self.manager.proxy(Batch)(u"batch-1")
+        msg = self.mkmsg(content=u"hello")
+        yield old_model(msg["message_id"], msg=msg, batch=batch).save()
+
+        stored = yield new_model.load(msg["message_id"])
+        self.assertEqual(stored.msg, msg)
+        self.assertEqual(stored.batch.key, u"batch-1")
+        self.assertEqual(stored._riak_object.get_data()["msg"]["content"],
+                         u"hello")
+        self.assertTrue("msg.content" not in stored._riak_object.get_data())
+
+        yield stored.save()
+        keys = yield new_model.index_lookup('batch', u"batch-1").get_keys()
+        self.assertEqual(keys, [msg["message_id"]])
+
+
+class TestEventMigrator(TestMigratorBase):
+    @inlineCallbacks
+    def test_migrate_from_unversioned(self):
+        old_model = self.manager.proxy(EventVNone)
+        new_model = self.manager.proxy(Event)
+        event = self.mkevent(u"msg-1")
+        yield old_model(event["event_id"], event=event,
+                        message=u"msg-1").save()
+
+        stored = yield new_model.load(event["event_id"])
+        self.assertEqual(stored.event, event)
+        self.assertEqual(stored.message.key, u"msg-1")
+
+
+class TestInboundMessageMigrator(TestMigratorBase):
+    @inlineCallbacks
+    def test_migrate_from_unversioned(self):
+        old_model = self.manager.proxy(InboundMessageVNone)
+        new_model = self.manager.proxy(InboundMessage)
+        msg = self.mkmsg(content=u"hello")
+        yield old_model(msg["message_id"], msg=msg).save()
+
+        stored = yield new_model.load(msg["message_id"])
+        self.assertEqual(stored.msg, msg)
+        self.assertEqual(stored.batch.key, None)
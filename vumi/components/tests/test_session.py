@@ -3,6 +3,7 @@
 import time
 
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
 from twisted.trial.unittest import TestCase
 
 from vumi.components import SessionManager
@@ -42,10 +43,78 @@ class SessionManagerTestCase(TestCase, PersistenceMixin):
         s1, s2 = yield get_sessions()
         self.assertTrue(s1[1]['created_at'] < s2[1]['created_at'])
 
+    @inlineCallbacks
+    def test_active_sessions_paginated(self):
+        for i in range(5):
+            yield self.sm.create_session("u%d" % (i,))
+        page1 = yield self.sm.active_sessions(0, 3)
+        page2 = yield self.sm.active_sessions(3, 3)
+        self.assertEqual(len(page1), 3)
+        self.assertEqual(len(page2), 2)
+        self.assertEqual(sorted(s[0] for s in page1 + page2),
+                         ["u0", "u1", "u2", "u3", "u4"])
+
+    @inlineCallbacks
+    def test_active_sessions_skips_expired(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u1")
+        self.sm.clock.advance(30)
+        yield self.sm.create_session("u2")
+        self.sm.clock.advance(31)
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual([s[0] for s in sessions], ["u2"])
+        # The expired entry has been garbage collected from the index.
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.INDEX_KEY, 0, -1)), ["u2"])
+
+    @inlineCallbacks
+    def test_count_active_sessions(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = 60
+        self.assertEqual((yield self.sm.count_active_sessions()), 0)
+        yield self.sm.create_session("u1")
+        yield self.sm.create_session("u2")
+        self.assertEqual((yield self.sm.count_active_sessions()), 2)
+        self.sm.clock.advance(61)
+        self.assertEqual((yield self.sm.count_active_sessions()), 0)
+
+    @inlineCallbacks
+    def test_gc_sessions(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u1")
+        self.assertEqual((yield self.sm.gc_sessions()), 0)
+        self.sm.clock.advance(61)
+        self.assertEqual((yield self.sm.gc_sessions()), 1)
+        self.assertEqual(
+            (yield self.manager.zcard(self.sm.INDEX_KEY)), 0)
+
+    @inlineCallbacks
+    def test_saving_session_trims_index(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u1")
+        self.sm.clock.advance(61)
+        yield self.sm.create_session("u2")
+        self.assertEqual(
+            (yield self.manager.zrange(self.sm.INDEX_KEY, 0, -1)), ["u2"])
+
+    @inlineCallbacks
+    def test_clear_session(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+        self.assertEqual((yield self.sm.active_sessions()), [])
+        self.assertEqual(
+            (yield self.manager.zcard(self.sm.INDEX_KEY)), 0)
+
     @inlineCallbacks
     def test_schedule_session_expiry(self):
         self.sm.max_session_length = 60.0
         yield self.sm.create_session("u1")
+        self.assertEqual(
+            (yield self.manager.ttl(self.sm.session_key("u1"))), 59)
 
     @inlineCallbacks
     def test_create_and_retrieve_session(self):
@@ -65,3 +134,153 @@ class SessionManagerTestCase(TestCase, PersistenceMixin):
         # Redis saves & returns all session values as strings
         self.assertEqual(session, dict([map(str, kvs) for kvs
                                         in test_session.items()]))
+
+    @inlineCallbacks
+    def test_save_session_refreshes_expiry(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u1")
+        self.sm.clock.advance(50)
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.sm.clock.advance(50)
+        sessions = yield self.sm.active_sessions()
+        self.assertEqual([s[0] for s in sessions], ["u1"])
+
+    @inlineCallbacks
+    def test_save_session_keeps_scheduled_expiry(self):
+        self.sm.clock = Clock()
+        self.sm.max_session_length = None
+        yield self.sm.create_session("u1")
+        yield self.sm.schedule_session_expiry("u1", 30)
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual(
+            (yield self.manager.zscore(self.sm.INDEX_KEY, "u1")), 30)
+        self.sm.clock.advance(31)
+        self.assertEqual((yield self.sm.gc_sessions()), 1)
+        self.assertEqual((yield self.sm.active_sessions()), [])
+
+
+class CachingSessionManagerTestCase(TestCase, PersistenceMixin):
+    timeout = 2
+
+    @inlineCallbacks
+    def setUp(self):
+        self._persist_setUp()
+        self.manager = yield self.get_redis_manager()
+        yield self.manager._purge_all()  # Just in case
+        self.sm = self.get_session_manager()
+
+    @inlineCallbacks
+    def tearDown(self):
+        yield self.sm.stop()
+        yield self._persist_tearDown()
+
+    def get_session_manager(self, **kw):
+        kw.setdefault('cache_size', 2)
+        sm = SessionManager(self.manager, **kw)
+        sm.clock = Clock()
+        return sm
+
+    def stored_session(self, user_id):
+        return self.manager.hgetall(self.sm.session_key(user_id))
+
+    @inlineCallbacks
+    def test_load_session_cached(self):
+        yield self.sm.create_session("u1", foo="bar")
+        # Change the stored session behind the cache's back.
+        yield self.manager.hset(self.sm.session_key("u1"), "foo", "baz")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session['foo'], "bar")
+
+    @inlineCallbacks
+    def test_load_session_cache_ttl(self):
+        yield self.sm.stop(stop_redis=False)
+        self.sm = self.get_session_manager(cache_ttl=10)
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.hset(self.sm.session_key("u1"), "foo", "baz")
+        self.sm.clock.advance(11)
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session['foo'], "baz")
+
+    @inlineCallbacks
+    def test_cache_expires_with_session(self):
+        self.sm.max_session_length = 60
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.delete(self.sm.session_key("u1"))
+        self.sm.clock.advance(61)
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cache_keeps_scheduled_expiry(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.sm.schedule_session_expiry("u1", 30)
+        yield self.sm.save_session("u1", {"foo": "baz"})
+        yield self.manager.delete(self.sm.session_key("u1"))
+        self.sm.clock.advance(31)
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_cache_lru_eviction(self):
+        yield self.sm.create_session("u1", foo="1")
+        yield self.sm.create_session("u2", foo="2")
+        yield self.sm.load_session("u1")
+        yield self.sm.create_session("u3", foo="3")
+        self.assertEqual(self.sm._cache.keys(), ["u1", "u3"])
+
+    @inlineCallbacks
+    def test_save_session_updates_cache(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": 5, "bar": u"b\xe4z"})
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session['foo'], "5")
+        self.assertEqual(session['bar'], u"b\xe4z".encode('utf-8'))
+        stored = yield self.stored_session("u1")
+        self.assertEqual(session, stored)
+
+    @inlineCallbacks
+    def test_clear_session_invalidates_cache(self):
+        yield self.sm.create_session("u1")
+        yield self.sm.clear_session("u1")
+        self.assertEqual((yield self.sm.load_session("u1")), {})
+
+    @inlineCallbacks
+    def test_invalidate_session(self):
+        yield self.sm.create_session("u1", foo="bar")
+        yield self.manager.hset(self.sm.session_key("u1"), "foo", "baz")
+        yield self.sm.invalidate_session("u1")
+        session = yield self.sm.load_session("u1")
+        self.assertEqual(session['foo'], "baz")
+
+    @inlineCallbacks
+    def test_write_behind(self):
+        yield self.sm.stop(stop_redis=False)
+        self.sm = self.get_session_manager(write_behind_delay=5)
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        self.assertEqual((yield self.sm.load_session("u1"))['foo'], "bar")
+        self.assertEqual((yield self.stored_session("u1")).get('foo'), None)
+        yield self.sm.save_session("u1", {"baz": "quux"})
+        self.sm.clock.advance(5)
+        stored = yield self.stored_session("u1")
+        self.assertEqual(stored['foo'], "bar")
+        self.assertEqual(stored['baz'], "quux")
+        self.assertEqual(self.sm._dirty, {})
+
+    @inlineCallbacks
+    def test_write_behind_flushed_on_eviction(self):
+        yield self.sm.stop(stop_redis=False)
+        self.sm = self.get_session_manager(write_behind_delay=5)
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        yield self.sm.create_session("u2")
+        yield self.sm.create_session("u3")
+        self.assertEqual((yield self.stored_session("u1"))['foo'], "bar")
+
+    @inlineCallbacks
+    def test_write_behind_flushed_on_stop(self):
+        yield self.sm.stop(stop_redis=False)
+        self.sm = self.get_session_manager(write_behind_delay=5)
+        yield self.sm.create_session("u1")
+        yield self.sm.save_session("u1", {"foo": "bar"})
+        yield self.sm.stop(stop_redis=False)
+        self.assertEqual((yield self.stored_session("u1"))['foo'], "bar")
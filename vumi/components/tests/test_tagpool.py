@@ -25,7 +25,7 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
 
     def pool_key_generator(self, pool):
         def tkey(x):
-            return "tagpools:%s:%s" % (pool, x)
+            return "tagpools:%s:%s" % (self.redis.hash_tag(pool), x)
         return tkey
 
     @inlineCallbacks
@@ -45,12 +45,24 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         yield self.tpm.declare_tags([tag])
         self.assertEqual((yield self.tpm.acquire_tag(tag[0])), tag)
 
+    @inlineCallbacks
+    def test_declare_tags_in_chunks(self):
+        self.tpm.declare_chunk_size = 3
+        tags = [("poolA", "tag%02d" % i) for i in range(10)]
+        yield self.tpm.declare_tags(tags)
+        self.assertEqual(sorted((yield self.tpm.free_tags("poolA"))), tags)
+        for tag in tags:
+            self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
     @inlineCallbacks
     def test_purge_pool(self):
+        tkey = self.pool_key_generator("poolA")
         tag1, tag2 = ("poolA", "tag1"), ("poolA", "tag2")
         yield self.tpm.declare_tags([tag1, tag2])
         yield self.tpm.purge_pool('poolA')
         self.assertEqual((yield self.tpm.acquire_tag('poolA')), None)
+        self.assertEqual((yield self.redis.keys(tkey("*"))), [])
 
     @inlineCallbacks
     def test_purge_unicode_pool(self):
@@ -118,13 +130,90 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
         free_local_tags = [t[1] for t in tags]
         free_local_tags.remove("tag5")
         redis = self.redis
+        # The free list is cleaned up lazily by acquire_tag().
         self.assertEqual((yield redis.lrange(tkey("free:list"), 0, -1)),
-                         free_local_tags)
+                         [t[1] for t in tags])
         self.assertEqual((yield redis.smembers(tkey("free:set"))),
                          set(free_local_tags))
         self.assertEqual((yield redis.smembers(tkey("inuse:set"))),
                          set(["tag5"]))
 
+    @inlineCallbacks
+    def test_acquire_tag_skips_specifically_acquired_tags(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2, tag3 = [("poolA", "tag%d" % i) for i in (1, 2, 3)]
+        yield self.tpm.declare_tags([tag1, tag2, tag3])
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag1)), tag1)
+        self.assertEqual((yield self.tpm.acquire_specific_tag(tag2)), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag3)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+        self.assertEqual(
+            (yield self.redis.lrange(tkey("free:list"), 0, -1)), [])
+
+    @inlineCallbacks
+    def test_acquire_tag_after_specific_acquire_and_release(self):
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.acquire_specific_tag(tag1)
+        yield self.tpm.release_tag(tag1)
+        # tag1 is still in the free list, so it isn't added again.
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag2)
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), None)
+
+    @inlineCallbacks
+    def test_free_list_does_not_grow(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        for i in range(100):
+            yield self.tpm.acquire_specific_tag(tag1)
+            yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag1", "tag2"])
+        self.assertEqual((yield self.tpm.acquire_tag("poolA")), tag1)
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag2", "tag1"])
+
+    @inlineCallbacks
+    def test_declare_tags_backfills_listed_set(self):
+        tkey = self.pool_key_generator("poolA")
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.acquire_specific_tag(tag1)
+        # Pools created before the listed set existed don't have one.
+        yield self.redis.delete(tkey("free:listed"))
+        yield self.tpm.declare_tags([tag1, tag2])
+        self.assertEqual((yield self.redis.smembers(tkey("free:listed"))),
+                         set(["tag1", "tag2"]))
+        yield self.tpm.release_tag(tag1)
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag1", "tag2"])
+
+    @inlineCallbacks
+    def test_acquire_tag_keeps_specific_tag_reason(self):
+        tag1, tag2 = [("poolA", "tag%d" % i) for i in (1, 2)]
+        yield self.tpm.declare_tags([tag1, tag2])
+        yield self.tpm.acquire_specific_tag(tag1, "me", {"foo": "bar"})
+        self.assertEqual((yield self.tpm.acquire_tag("poolA", "you")), tag2)
+        owner, reason = yield self.tpm.acquired_by(tag1)
+        self.assertEqual((owner, reason["foo"]), ("me", "bar"))
+        self.assertEqual((yield self.tpm.owned_tags("me")), [list(tag1)])
+
+    @inlineCallbacks
+    def test_release_tag_removes_reason(self):
+        tkey = self.pool_key_generator("poolA")
+        tag = ("poolA", "tag1")
+        yield self.tpm.declare_tags([tag])
+        yield self.tpm.acquire_tag("poolA", "me")
+        yield self.tpm.release_tag(tag)
+        yield self.tpm.release_tag(tag)
+        self.assertEqual((yield self.redis.hgetall(tkey("reason:hash"))), {})
+        self.assertEqual((yield self.tpm.owned_tags("me")), [])
+        self.assertEqual((yield self.redis.lrange(tkey("free:list"), 0, -1)),
+                         ["tag1"])
+
     @inlineCallbacks
     def test_acquire_specific_unicode_tag(self):
         tag = (u"poöl", u"tág")
@@ -282,3 +371,12 @@ class TestTxTagpoolManager(TestCase, PersistenceMixin):
 
 class TestTagpoolManager(TestTxTagpoolManager):
     sync_persistence = True
+
+
+class TestShardedTxTagpoolManager(TestTxTagpoolManager):
+    redis_shards = 3
+
+
+class TestShardedTagpoolManager(TestTxTagpoolManager):
+    sync_persistence = True
+    redis_shards = 3
@@ -257,3 +257,7 @@ class ConcurrentWindowManagerTestCase(TestCase, PersistenceMixin):
         yield self.wm.add(self.window_id, 2)
         yield self.wm._monitor_windows(lambda *a: True, True)
         self.assertEqual((yield self.wm.get_next_key(self.window_id)), None)
+
+
+class ShardedWindowManagerTestCase(WindowManagerTestCase):
+    redis_shards = 3
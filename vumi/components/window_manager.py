@@ -51,17 +51,27 @@ class WindowManager(object):
             returnValue(True)
         returnValue(False)
 
+    def _key(self, kind, window_id=None, *keys):
+        parts = [self.WINDOW_KEY]
+        if kind is not None:
+            parts.append(kind)
+        if window_id is not None:
+            # A window's keys are used together, so they need to be on the
+            # same shard if Redis is sharded.
+            parts.append(self.redis.hash_tag(unicode(window_id)))
+        return ':'.join(parts + map(unicode, keys))
+
     def window_key(self, *keys):
-        return ':'.join([self.WINDOW_KEY] + map(unicode, keys))
+        return self._key(None, *keys)
 
     def flight_key(self, *keys):
-        return self.window_key(self.FLIGHT_KEY, *keys)
+        return self._key(self.FLIGHT_KEY, *keys)
 
     def stats_key(self, *keys):
-        return self.window_key(self.FLIGHT_STATS_KEY, *keys)
+        return self._key(self.FLIGHT_STATS_KEY, *keys)
 
     def map_key(self, *keys):
-        return self.window_key(self.MAP_KEY, *keys)
+        return self._key(self.MAP_KEY, *keys)
 
     def get_clock(self):
         return reactor
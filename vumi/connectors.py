@@ -13,7 +13,7 @@ class BaseConnector(object):
     individually all over the place.
     """
     def __init__(self, worker, connector_name, prefetch_count=None,
-                 middlewares=None):
+                 middlewares=None, timing_hook=None):
         self.name = connector_name
         self.worker = worker
         self._consumers = {}
@@ -21,8 +21,9 @@ class BaseConnector(object):
         self._endpoint_handlers = {}
         self._default_handlers = {}
         self._prefetch_count = prefetch_count
-        self._middlewares = MiddlewareStack(middlewares
-                                            if middlewares is not None else [])
+        self._middlewares = MiddlewareStack(
+            middlewares if middlewares is not None else [],
+            timing_hook=timing_hook)
 
     def _rkey(self, mtype):
         return '%s.%s' % (self.name, mtype)
@@ -317,6 +317,13 @@ class DecisionTreeWorker(ApplicationWorker):
         Name of file containing the YAML template for the decision tree.
         Optional. If left out, a demo decision tree is read from
         vumi.demos/toy_decision_tree.yaml.
+    :type session_cache_size: int
+    :param session_cache_size:
+        Number of sessions to cache in process. Optional. Only enable this
+        if all messages for a user are delivered to the same worker.
+    :type session_write_behind_delay: float
+    :param session_write_behind_delay:
+        Seconds to delay and batch writes of cached sessions. Optional.
     """
 
     MAX_SESSION_LENGTH = 3 * 60
@@ -338,7 +345,9 @@ class DecisionTreeWorker(ApplicationWorker):
         r_config = self.config.get('redis_manager')
         r_prefix = "%(worker_name)s:%(transport_name)s" % self.config
         self.session_manager = yield SessionManager.from_redis_config(
-            r_config, r_prefix, self.MAX_SESSION_LENGTH)
+            r_config, r_prefix, self.MAX_SESSION_LENGTH,
+            cache_size=self.config.get('session_cache_size'),
+            write_behind_delay=self.config.get('session_write_behind_delay'))
 
     def teardown_application(self):
         return self.session_manager.stop()
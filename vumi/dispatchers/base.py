@@ -4,6 +4,7 @@
 
 import re
 import functools
+from collections import OrderedDict, deque
 
 from twisted.internet.defer import inlineCallbacks, returnValue, maybeDeferred
 
@@ -11,7 +12,9 @@ from vumi.service import Worker
 from vumi.errors import ConfigError
 from vumi.message import TransportUserMessage, TransportEvent
 from vumi.utils import load_class_by_string, get_first_word
-from vumi.middleware import MiddlewareStack, setup_middlewares_from_config
+from vumi.middleware import (
+    MiddlewareStack, setup_middlewares_from_config,
+    setup_middleware_timing_from_config)
 from vumi import log
 from vumi.components import SessionManager
 from vumi.persist.txredis_manager import TxRedisManager
@@ -56,10 +59,16 @@ class BaseDispatchWorker(Worker):
     @inlineCallbacks
     def setup_middleware(self):
         middlewares = yield setup_middlewares_from_config(self, self.config)
-        self._middlewares = MiddlewareStack(middlewares)
+        self._timing_hook = yield setup_middleware_timing_from_config(
+            self, self.config)
+        self._middlewares = MiddlewareStack(
+            middlewares, timing_hook=self._timing_hook)
 
+    @inlineCallbacks
     def teardown_middleware(self):
-        return self._middlewares.teardown()
+        yield self._middlewares.teardown()
+        if self._timing_hook is not None:
+            self._timing_hook.stop()
 
     def setup_router(self):
         router_cls = load_class_by_string(self.config['router_class'])
@@ -397,8 +406,23 @@ class UserGroupingRouter(SimpleDispatchRouter):
     :param str dispatcher_name:
         The name of the dispatcher, used internally as
         the prefix for Redis keys.
+
+    :param int user_cache_size:
+        Maximum number of user group assignments to cache in memory.
+        Assignments never change once made, so cached assignments
+        never need to be refreshed. Default is 10000.
+
+    :param int round_robin_block_size:
+        Number of round-robin positions to reserve from Redis at a
+        time. Larger blocks save Redis round-trips when many new
+        users arrive, but groups are only assigned in strict rotation
+        across dispatchers sharing a `dispatcher_name` if this is 1.
+        Default is 10.
     """
 
+    DEFAULT_USER_CACHE_SIZE = 10000
+    DEFAULT_ROUND_ROBIN_BLOCK_SIZE = 10
+
     def setup_routing(self):
         r_config = self.config.get('redis_manager', {})
         r_prefix = self.config['dispatcher_name']
@@ -409,25 +433,67 @@ class UserGroupingRouter(SimpleDispatchRouter):
 
         self.groups = self.config['group_mappings']
         self.nr_of_groups = len(self.groups)
+        self.sorted_groups = sorted(self.groups.items())
+        self.user_cache_size = int(self.config.get(
+            'user_cache_size', self.DEFAULT_USER_CACHE_SIZE))
+        self.round_robin_block_size = int(self.config.get(
+            'round_robin_block_size', self.DEFAULT_ROUND_ROBIN_BLOCK_SIZE))
+        # user_id -> group, in LRU order.
+        self._user_groups = OrderedDict()
+        self._round_robin_positions = deque()
 
     def _setup_redis(self, redis):
         self.redis = redis
 
+    def _cache_user_group(self, user_id, group):
+        self._user_groups.pop(user_id, None)
+        self._user_groups[user_id] = group
+        while len(self._user_groups) > self.user_cache_size:
+            self._user_groups.popitem(last=False)
+
+    def _cached_user_group(self, user_id):
+        group = self._user_groups.pop(user_id, None)
+        if group is not None:
+            self._user_groups[user_id] = group
+        return group
+
+    @inlineCallbacks
+    def _next_round_robin_position(self):
+        if not self._round_robin_positions:
+            block_size = self.round_robin_block_size
+            last = yield self.redis.incr('round-robin', block_size)
+            self._round_robin_positions.extend(
+                xrange(last - block_size, last))
+        returnValue(self._round_robin_positions.popleft())
+
     @inlineCallbacks
     def get_next_group(self):
-        counter = (yield self.redis.incr('round-robin')) - 1
-        current_group_id = counter % self.nr_of_groups
-        sorted_groups = sorted(self.groups.items())
-        group = sorted_groups[current_group_id]
-        returnValue(group)
+        counter = yield self._next_round_robin_position()
+        returnValue(self.sorted_groups[counter % self.nr_of_groups])
 
     @inlineCallbacks
     def get_group_for_user(self, user_id):
+        group = self._cached_user_group(user_id)
+        if group is None:
+            group = yield self._assign_group(user_id)
+            self._cache_user_group(user_id, group)
+        returnValue(group)
+
+    @inlineCallbacks
+    def _assign_group(self, user_id):
         user_key = "user:%s" % (user_id,)
         group = yield self.redis.get(user_key)
-        if not group:
-            group, transport_name = yield self.get_next_group()
-            yield self.redis.set(user_key, group)
+        if group is not None:
+            returnValue(group)
+        counter = yield self._next_round_robin_position()
+        group, _transport_name = self.sorted_groups[
+            counter % self.nr_of_groups]
+        if (yield self.redis.setnx(user_key, group)):
+            returnValue(group)
+        # Another worker assigned the user a group first, so the round-robin
+        # position can be used for the next new user.
+        self._round_robin_positions.appendleft(counter)
+        group = yield self.redis.get(user_key)
         returnValue(group)
 
     @inlineCallbacks
@@ -438,6 +504,74 @@ class UserGroupingRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_message(app, msg)
 
 
+class PrefixTrie(object):
+    """
+    Maps string prefixes to values. Looking up a string finds the values
+    added for every prefix of it, shortest prefix first.
+    """
+
+    def __init__(self):
+        self.root = ({}, [])
+
+    def add(self, prefix, value):
+        children, values = self.root
+        for char in prefix:
+            children, values = children.setdefault(char, ({}, []))
+        values.append(value)
+
+    def find(self, string):
+        children, values = self.root
+        found = list(values)
+        for char in string:
+            node = children.get(char)
+            if node is None:
+                break
+            children, values = node
+            found.extend(values)
+        return found
+
+
+class KeywordRoutingTable(object):
+    """
+    Routing rules for :class:`ContentKeywordRouter`, indexed by keyword and
+    `to_addr`, with a :class:`PrefixTrie` of `from_addr` prefixes for each,
+    so that finding the rules a message matches doesn't require checking
+    every rule.
+
+    :param list rules:
+        Routing rules, as described in :class:`ContentKeywordRouter`, with
+        lower case keywords.
+    """
+
+    ANY_TO_ADDR = object()
+
+    def __init__(self, rules):
+        self.rules = rules
+        self.index = {}
+        for i, rule in enumerate(rules):
+            to_addr_index = self.index.setdefault(rule['keyword'], {})
+            to_addr = rule['to_addr'] if 'to_addr' in rule else (
+                self.ANY_TO_ADDR)
+            if to_addr not in to_addr_index:
+                to_addr_index[to_addr] = PrefixTrie()
+            to_addr_index[to_addr].add(rule.get('prefix', ''), i)
+
+    def match(self, keyword, to_addr, from_addr):
+        """
+        Return the rules matching a message, in the order they were given.
+        """
+        to_addr_index = self.index.get(keyword)
+        if to_addr_index is None:
+            return []
+        matches = []
+        for key in (to_addr, self.ANY_TO_ADDR):
+            trie = to_addr_index.get(key)
+            if trie is not None:
+                matches.extend(trie.find(from_addr or ''))
+        matches.sort()
+        return [self.rules[i] for i in matches]
+
+
 class ContentKeywordRouter(SimpleDispatchRouter):
     """Router that dispatches based on the first word of the message
     content. In the context of SMSes the first word is sometimes called
@@ -477,6 +611,10 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         route events such as acknowledgements and delivery reports
         back to the application that sent the outgoing
         message. Default is seven days.
+
+    Return routes are stored as plain Redis strings. Routes stored in
+    sessions by earlier versions of this router are still used for events
+    that have no plain route.
     """
 
     DEFAULT_ROUTING_TIMEOUT = 60 * 60 * 24 * 7  # 7 days
@@ -485,18 +623,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.r_config = self.config.get('redis_manager', {})
         self.r_prefix = self.config['dispatcher_name']
 
-        self.rules = []
-        for rule in self.config.get('rules', []):
-            if 'keyword' not in rule or 'app' not in rule:
-                raise ConfigError("Rule definition %r must contain values for"
-                                  " both 'app' and 'keyword'" % rule)
-            rule = rule.copy()
-            rule['keyword'] = rule['keyword'].lower()
-            self.rules.append(rule)
-        keyword_mappings = self.config.get('keyword_mappings', {})
-        for transport_name, keyword in keyword_mappings.items():
-            self.rules.append({'app': transport_name,
-                               'keyword': keyword.lower()})
+        self.update_rules(self.config.get('rules', []),
+                          self.config.get('keyword_mappings', {}))
         self.fallback_application = self.config.get('fallback_application')
         self.transport_mappings = self.config['transport_mappings']
         self.expire_routing_timeout = int(self.config.get(
@@ -512,6 +640,28 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.session_manager = SessionManager(
             self.redis, self.expire_routing_timeout)
 
+    def update_rules(self, rules, keyword_mappings=None):
+        """
+        Replace the routing rules. Rules and keyword mappings are given as
+        for the `rules` and `keyword_mappings` config options.
+
+        The new rules are indexed before they replace the old ones, so this
+        may be called while messages are being routed.
+        """
+        compiled_rules = []
+        for rule in rules:
+            if 'keyword' not in rule or 'app' not in rule:
+                raise ConfigError("Rule definition %r must contain values for"
+                                  " both 'app' and 'keyword'" % rule)
+            rule = rule.copy()
+            rule['keyword'] = rule['keyword'].lower()
+            compiled_rules.append(rule)
+        for transport_name, keyword in (keyword_mappings or {}).items():
+            compiled_rules.append({'app': transport_name,
+                                   'keyword': keyword.lower()})
+        self.routing_table = KeywordRoutingTable(compiled_rules)
+        self.rules = compiled_rules
+
     def get_message_key(self, message):
         return 'message:%s' % (message,)
 
@@ -525,33 +675,47 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         self.dispatcher.publish_inbound_event(name, msg)
 
     def is_msg_matching_routing_rules(self, keyword, msg, rule):
-        return all([keyword == rule['keyword'],
-                    (not 'to_addr' in rule) or
-                    (msg['to_addr'] == rule['to_addr']),
-                    (not 'prefix' in rule) or
-                    (msg['from_addr'].startswith(rule['prefix']))])
+        return (keyword == rule['keyword'] and
+                ('to_addr' not in rule or
+                 msg['to_addr'] == rule['to_addr']) and
+                ('prefix' not in rule or
+                 msg['from_addr'].startswith(rule['prefix'])))
 
     def dispatch_inbound_message(self, msg):
         keyword = get_first_word(msg['content']).lower()
         matched = False
-        for rule in self.rules:
-            if self.is_msg_matching_routing_rules(keyword, msg, rule):
-                matched = True
-                # copy message so that the middleware doesn't see a particular
-                # message instance multiple times
-                self.publish_exposed_inbound(rule['app'], msg.copy())
+        for rule in self.routing_table.match(keyword, msg['to_addr'],
+                                             msg['from_addr']):
+            matched = True
+            # copy message so that the middleware doesn't see a particular
+            # message instance multiple times
+            self.publish_exposed_inbound(rule['app'], msg.copy())
         if not matched:
             if self.fallback_application is not None:
                 self.publish_exposed_inbound(self.fallback_application, msg)
             else:
                 log.error('Message could not be routed: %r' % (msg,))
 
+    def set_return_route(self, message_id, name):
+        message_key = self.get_message_key(message_id)
+        return self.redis.setex(
+            message_key, self.expire_routing_timeout, name)
+
+    @inlineCallbacks
+    def get_return_route(self, message_id):
+        message_key = self.get_message_key(message_id)
+        name = yield self.redis.get(message_key)
+        if name is None:
+            # Fall back to routes stored as sessions, which will be
+            # around until they expire.
+            session = yield self.session_manager.load_session(message_key)
+            name = session.get('name')
+        returnValue(name)
+
     @inlineCallbacks
     def dispatch_inbound_event(self, msg):
         yield self._redis_d  # Horrible hack to ensure we have it setup.
-        message_key = self.get_message_key(msg['user_message_id'])
-        session = yield self.session_manager.load_session(message_key)
-        name = session.get('name')
+        name = yield self.get_return_route(msg['user_message_id'])
         if not name:
             log.error("No transport_name for return route found in Redis"
                       " while dispatching transport event for message %s"
@@ -567,9 +731,8 @@ class ContentKeywordRouter(SimpleDispatchRouter):
         transport_name = self.transport_mappings.get(msg['from_addr'])
         if transport_name is not None:
             self.publish_transport(transport_name, msg)
-            message_key = self.get_message_key(msg['message_id'])
-            yield self.session_manager.create_session(
-                message_key, name=msg['transport_name'])
+            yield self.set_return_route(
+                msg['message_id'], msg['transport_name'])
         else:
             log.error("No transport for %s" % (msg['from_addr'],))
 
@@ -1,7 +1,11 @@
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.trial.unittest import TestCase
 
 from vumi.dispatchers.base import (
-    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter)
+    BaseDispatchWorker, ToAddrRouter, FromAddrMultiplexRouter, PrefixTrie,
+    KeywordRoutingTable)
+from vumi.errors import ConfigError
+from vumi.message import Message
 from vumi.tests.utils import VumiWorkerTestCase, LogCatcher
 from vumi.dispatchers.tests.utils import DispatcherTestCase, DummyDispatcher
 
@@ -64,6 +68,22 @@ class TestBaseDispatchWorker(VumiWorkerTestCase):
     def clear_dispatched(self):
         self._amqp.dispatched = {}
 
+    @inlineCallbacks
+    def test_middleware_timing_metrics(self):
+        dispatcher = yield self.get_dispatcher(
+            middleware_metrics_prefix='vumi.test.')
+        msg = self.mkmsg_in(transport_name='transport1')
+        yield self.dispatch(msg, 'transport1.inbound')
+        metric_manager = dispatcher._timing_hook.metric_manager
+        metric_manager._publish_metrics()
+        [content] = self._amqp.get_dispatched('vumi.metrics', 'vumi.metrics')
+        datapoints = Message.from_json(content.body)['datapoints']
+        # Each middleware handles the message on the way in and out.
+        self.assertEqual(sorted((dp[0], len(dp[2])) for dp in datapoints), [
+            ('vumi.test.middleware.mw1.inbound', 2),
+            ('vumi.test.middleware.mw2.inbound', 2),
+            ])
+
     @inlineCallbacks
     def test_inbound_message_routing(self):
         yield self.get_dispatcher()
@@ -414,6 +434,59 @@ class UserGroupingRouterTestCase(DispatcherTestCase):
             'group2',
         ])
 
+    @inlineCallbacks
+    def test_group_assignment_cached(self):
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(group, 'group1')
+        yield self.redis.set('user:user1', 'group2')
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(group, 'group1')
+
+    @inlineCallbacks
+    def test_group_assignment_cache_size(self):
+        self.router.user_cache_size = 1
+        yield self.router.get_group_for_user('user1')
+        yield self.router.get_group_for_user('user2')
+        self.assertEqual(self.router._user_groups.keys(), ['user2'])
+        yield self.redis.set('user:user1', 'group2')
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(group, 'group2')
+
+    @inlineCallbacks
+    def test_existing_user_does_not_use_round_robin_position(self):
+        yield self.redis.set('user:user1', 'group2')
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(group, 'group2')
+        self.assertEqual((yield self.redis.get('round-robin')), None)
+        group = yield self.router.get_group_for_user('user2')
+        self.assertEqual(group, 'group1')
+
+    @inlineCallbacks
+    def test_user_assigned_concurrently(self):
+        setnx = self.redis.setnx
+
+        def racing_setnx(key, value):
+            d = self.redis.set('user:user1', 'group2')
+            return d.addCallback(lambda _: setnx(key, value))
+
+        self.patch(self.redis, 'setnx', racing_setnx)
+        group = yield self.router.get_group_for_user('user1')
+        self.assertEqual(group, 'group2')
+        # The unused round-robin position goes to the next new user.
+        self.patch(self.redis, 'setnx', setnx)
+        group = yield self.router.get_group_for_user('user2')
+        self.assertEqual(group, 'group1')
+
+    @inlineCallbacks
+    def test_round_robin_positions_reserved_in_blocks(self):
+        self.router.round_robin_block_size = 3
+        groups = []
+        for i in range(4):
+            groups.append((yield self.router.get_group_for_user(
+                'user%s' % (i,))))
+        self.assertEqual(groups, ['group1', 'group2', 'group1', 'group2'])
+        self.assertEqual((yield self.redis.get('round-robin')), '6')
+
     def mkmsg_from(self, from_addr):
         return self.mkmsg_in(
             transport_name=self.transport_name, from_addr=from_addr)
@@ -584,6 +657,20 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                       direction='event')
         self.assertEqual(app1_event_msg, [])
 
+    @inlineCallbacks
+    def test_inbound_event_routing_plain_route(self):
+        msg = self.mkmsg_ack(user_message_id='1',
+                             transport_name='transport1')
+        yield self.router.set_return_route('1', 'app2')
+
+        yield self.dispatch(msg,
+                            transport_name='transport1',
+                            direction='event')
+
+        app2_event_msg = self.get_dispatched_messages('app2',
+                                                      direction='event')
+        self.assertEqual(app2_event_msg, [msg])
+
     @inlineCallbacks
     def test_inbound_event_routing_failing_publisher_not_defined(self):
         msg = self.mkmsg_ack(transport_name='transport1')
@@ -631,8 +718,105 @@ class TestContentKeywordRouter(DispatcherTestCase):
                                                        direction='outbound')
         self.assertEqual(transport2_msgs, [])
 
-        session = yield self.router.session_manager.load_session('message:1')
-        self.assertEqual(session['name'], 'app2')
+        route = yield self.router.get_return_route('1')
+        self.assertEqual(route, 'app2')
+        self.assertEqual((yield self.redis.get('message:1')), 'app2')
+        ttl = yield self.redis.ttl('message:1')
+        self.assertTrue(0 < ttl <= 3)
+        self.assertEqual((yield self.redis.keys()), ['message:1'])
+
+    @inlineCallbacks
+    def test_inbound_message_routing_multiple_rules_in_order(self):
+        self.router.update_rules([
+            {'app': 'app3', 'keyword': 'multi', 'prefix': '+256'},
+            {'app': 'app1', 'keyword': 'multi'},
+            {'app': 'app2', 'keyword': 'multi', 'to_addr': '8181'},
+            {'app': 'app2', 'keyword': 'multi', 'to_addr': '8282'},
+            ])
+        msg = self.mkmsg_in(content='multi rest of a msg',
+                            to_addr='8181',
+                            from_addr='+256788601462')
+
+        with LogCatcher() as lc:
+            yield self.dispatch(msg,
+                                transport_name='transport1',
+                                direction='inbound')
+            self.assertEqual(lc.errors, [])
+
+        for app in ['app1', 'app2', 'app3']:
+            self.assertEqual(
+                self.get_dispatched_messages(app, direction='inbound'), [msg])
+
+    @inlineCallbacks
+    def test_update_rules(self):
+        self.router.update_rules([{'app': 'app2', 'keyword': 'NEW'}],
+                                 {'app3': 'newer'})
+        msg = self.mkmsg_in(content='KEYWORD1 rest of a msg',
+                            to_addr='8181',
+                            from_addr='+256788601462')
+        msg2 = self.mkmsg_in(content='new rest of a msg')
+        msg3 = self.mkmsg_in(content='newer rest of a msg')
+        for m in [msg, msg2, msg3]:
+            yield self.dispatch(m,
+                                transport_name='transport1',
+                                direction='inbound')
+
+        self.assertEqual(
+            self.get_dispatched_messages('app1', direction='inbound'), [])
+        self.assertEqual(
+            self.get_dispatched_messages('app2', direction='inbound'), [msg2])
+        self.assertEqual(
+            self.get_dispatched_messages('app3', direction='inbound'), [msg3])
+        self.assertEqual(
+            self.get_dispatched_messages('fallback_app', direction='inbound'),
+            [msg])
+
+    def test_update_rules_invalid_rule(self):
+        self.assertRaises(ConfigError, self.router.update_rules,
+                          [{'app': 'app2'}])
+        self.assertEqual(len(self.router.rules), 4)
+
+
+class TestPrefixTrie(TestCase):
+
+    def test_find(self):
+        trie = PrefixTrie()
+        trie.add('', 'any')
+        trie.add('+27', 'za')
+        trie.add('+2782', 'vodacom')
+        trie.add('+256', 'ug')
+        self.assertEqual(trie.find('+27821234567'), ['any', 'za', 'vodacom'])
+        self.assertEqual(trie.find('+27721234567'), ['any', 'za'])
+        self.assertEqual(trie.find('+2'), ['any'])
+        self.assertEqual(trie.find(''), ['any'])
+
+    def test_find_multiple_values(self):
+        trie = PrefixTrie()
+        trie.add('+27', 'a')
+        trie.add('+27', 'b')
+        self.assertEqual(trie.find('+27123'), ['a', 'b'])
+        self.assertEqual(trie.find('+1'), [])
+
+
+class TestKeywordRoutingTable(TestCase):
+
+    def test_match(self):
+        rules = [
+            {'app': 'app1', 'keyword': 'foo', 'to_addr': '8181',
+             'prefix': '+256'},
+            {'app': 'app2', 'keyword': 'foo'},
+            {'app': 'app3', 'keyword': 'bar', 'to_addr': '8181'},
+            {'app': 'app4', 'keyword': 'foo', 'prefix': '+27'},
+            ]
+        table = KeywordRoutingTable(rules)
+        self.assertEqual(table.match('foo', '8181', '+256123'),
+                         [rules[0], rules[1]])
+        self.assertEqual(table.match('foo', '8282', '+256123'), [rules[1]])
+        self.assertEqual(table.match('foo', '8181', '+27123'),
+                         [rules[1], rules[3]])
+        self.assertEqual(table.match('bar', '8181', None), [rules[2]])
+        self.assertEqual(table.match('bar', '8282', '+27123'), [])
+        self.assertEqual(table.match('baz', '8181', '+27123'), [])
 
 
 class TestRedirectOutboundRouterForSMPP(DispatcherTestCase):
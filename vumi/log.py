@@ -1,15 +1,61 @@
 # -*- test-case-name: vumi.tests.test_log -*-
+"""Logging functions with log levels.
+
+Messages logged below the level set with :func:`set_level` are discarded
+before any log event is created. Expensive values should be passed as
+separate message parts or using Twisted's `format` keyword argument (e.g.
+``log.debug(format="Sending %(msg)r", msg=msg)``) so that they are only
+rendered if the message is logged. Work needed only to build a log message
+can be skipped by checking :func:`is_enabled_for` first.
+"""
+
 import logging
-from functools import partial
 
 from twisted.python import log
 
 
-debug = partial(log.msg, logLevel=logging.DEBUG)
-info = partial(log.msg, logLevel=logging.INFO)
-warning = partial(log.msg, logLevel=logging.WARNING)
-error = partial(log.err, logLevel=logging.ERROR)
-critical = partial(log.err, logLevel=logging.CRITICAL)
+_level = logging.NOTSET
+
+
+def set_level(level):
+    """Discard messages logged below `level`.
+
+    :param level:
+        A level number from :mod:`logging` or a level name such as
+        `'info'`.
+    """
+    global _level
+    if isinstance(level, basestring):
+        level_name, level = level, logging.getLevelName(level.upper())
+        if not isinstance(level, int):
+            raise ValueError("Unknown log level: %r" % (level_name,))
+    _level = level
+
+
+def get_level():
+    return _level
+
+
+def is_enabled_for(level):
+    """Return True if messages logged at `level` are not discarded."""
+    return level >= _level
+
+
+def _make_logger(log_func, level):
+    def logger(*args, **kw):
+        kw.setdefault('logLevel', level)
+        if kw['logLevel'] < _level:
+            return
+        return log_func(*args, **kw)
+    logger.level = level
+    return logger
+
+
+debug = _make_logger(log.msg, logging.DEBUG)
+info = _make_logger(log.msg, logging.INFO)
+warning = _make_logger(log.msg, logging.WARNING)
+error = _make_logger(log.err, logging.ERROR)
+critical = _make_logger(log.err, logging.CRITICAL)
 
 # make transition from twisted.python.log easier
 msg = info
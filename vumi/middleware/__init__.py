@@ -3,10 +3,11 @@
 
 from vumi.middleware.base import (
     BaseMiddleware, TransportMiddleware, ApplicationMiddleware,
-    MiddlewareStack, create_middlewares_from_config,
-    setup_middlewares_from_config)
+    MiddlewareStack, MiddlewareTimingMetrics, create_middlewares_from_config,
+    setup_middlewares_from_config, setup_middleware_timing_from_config)
 
 __all__ = [
     'BaseMiddleware', 'TransportMiddleware', 'ApplicationMiddleware',
-    'MiddlewareStack', 'create_middlewares_from_config',
-    'setup_middlewares_from_config']
+    'MiddlewareStack', 'MiddlewareTimingMetrics',
+    'create_middlewares_from_config', 'setup_middlewares_from_config',
+    'setup_middleware_timing_from_config']
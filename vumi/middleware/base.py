@@ -1,9 +1,13 @@
 # -*- test-case-name: vumi.middleware.tests.test_base -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import time
+
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, fail)
 
 from vumi.utils import load_class_by_string
 from vumi.errors import ConfigError, VumiError
+from vumi.blinkenlights.metrics import MetricManager, Timer
 
 
 class MiddlewareError(VumiError):
@@ -108,22 +112,71 @@ class ApplicationMiddleware(BaseMiddleware):
 
 class MiddlewareStack(object):
     """Ordered list of middlewares to pass a Message through.
+
+    Middleware handlers that return plain values are called one after the
+    other without any Deferred handling. Once a handler returns a Deferred
+    the remaining handlers are called when it fires.
+
+    :param list middlewares:
+        The middlewares, in consume order.
+    :param timing_hook:
+        Optional callable, called as `timing_hook(middleware, handler_name,
+        seconds)` with the time each handler took to process a message
+        (including waiting for any Deferred it returned). See
+        :class:`MiddlewareTimingMetrics`.
     """
 
-    def __init__(self, middlewares):
+    def __init__(self, middlewares, timing_hook=None):
         self.middlewares = middlewares
+        self.timing_hook = timing_hook
 
-    @inlineCallbacks
     def _handle(self, middlewares, handler_name, message, connector_name):
-        method_name = 'handle_%s' % (handler_name,)
-        for middleware in middlewares:
-            handler = getattr(middleware, method_name)
-            message = yield handler(message, connector_name)
-            if message is None:
-                raise MiddlewareError(
-                    'Returned value of %s.%s should never be None' % (
-                        middleware, method_name,))
-        returnValue(message)
+        return self._process(iter(middlewares), handler_name,
+                             'handle_%s' % (handler_name,), message,
+                             connector_name)
+
+    def _process(self, middlewares, handler_name, method_name, message,
+                 connector_name):
+        try:
+            for middleware in middlewares:
+                result = self._call_handler(
+                    middleware, handler_name, method_name, message,
+                    connector_name)
+                if isinstance(result, Deferred):
+                    result.addCallback(
+                        self._check_result, middleware, method_name)
+                    return result.addCallback(
+                        lambda message: self._process(
+                            middlewares, handler_name, method_name, message,
+                            connector_name))
+                message = self._check_result(result, middleware, method_name)
+        except Exception:
+            return fail()
+        return succeed(message)
+
+    def _call_handler(self, middleware, handler_name, method_name, message,
+                      connector_name):
+        handler = getattr(middleware, method_name)
+        if self.timing_hook is None:
+            return handler(message, connector_name)
+        start = time.time()
+        result = handler(message, connector_name)
+        if isinstance(result, Deferred):
+            result.addBoth(self._record_time, middleware, handler_name, start)
+        else:
+            self._record_time(None, middleware, handler_name, start)
+        return result
+
+    def _record_time(self, result, middleware, handler_name, start):
+        self.timing_hook(middleware, handler_name, time.time() - start)
+        return result
+
+    def _check_result(self, message, middleware, method_name):
+        if message is None:
+            raise MiddlewareError(
+                'Returned value of %s.%s should never be None' % (
+                    middleware, method_name,))
+        return message
 
     def apply_consume(self, handler_name, message, connector_name):
         return self._handle(
@@ -139,6 +192,40 @@ class MiddlewareStack(object):
             yield mw.teardown_middleware()
 
 
+class MiddlewareTimingMetrics(object):
+    """A :class:`MiddlewareStack` timing hook that records handler times
+    as metrics.
+
+    A :class:`vumi.blinkenlights.metrics.Timer` named
+    `<prefix><middleware name>.<handler name>` is registered with the
+    metric manager for each middleware handler the first time it's timed.
+
+    :param metric_manager:
+        The :class:`vumi.blinkenlights.metrics.MetricManager` to register
+        metrics with.
+    :param str prefix:
+        Prefix for metric names. Default is `middleware.`.
+    """
+
+    def __init__(self, metric_manager, prefix='middleware.'):
+        self.metric_manager = metric_manager
+        self.prefix = prefix
+        self._timers = {}
+
+    def stop(self):
+        """Stop the metric manager publishing."""
+        self.metric_manager.stop()
+
+    def __call__(self, middleware, handler_name, seconds):
+        key = (middleware.name, handler_name)
+        timer = self._timers.get(key)
+        if timer is None:
+            timer = self.metric_manager.register(Timer('%s%s.%s' % (
+                self.prefix, middleware.name, handler_name)))
+            self._timers[key] = timer
+        timer.set(seconds)
+
+
 def create_middlewares_from_config(worker, config):
     """Return a list of middleware objects created from a worker
        configuration.
@@ -170,3 +257,19 @@ def setup_middlewares_from_config(worker, config):
     for mw in middlewares:
         yield mw.setup_middleware()
     returnValue(middlewares)
+
+
+@inlineCallbacks
+def setup_middleware_timing_from_config(worker, config):
+    """Return a :class:`MiddlewareTimingMetrics` hook for a worker, or
+       `None` if middleware timing isn't configured.
+
+       If `middleware_metrics_prefix` is set in the worker configuration, a
+       :class:`vumi.blinkenlights.metrics.MetricManager` with that prefix is
+       started on the worker to publish the timings.
+       """
+    prefix = config.get("middleware_metrics_prefix")
+    if prefix is None:
+        returnValue(None)
+    metric_manager = yield worker.start_publisher(MetricManager, prefix)
+    returnValue(MiddlewareTimingMetrics(metric_manager))
@@ -25,8 +25,9 @@ class LoggingMiddleware(BaseMiddleware):
         self.failure_logger = getattr(log, failure_log_level)
 
     def _log(self, direction, logger, msg, connector_name):
-        logger("Processed %s message for %s: %s" % (
-                direction, connector_name, msg.to_json()))
+        if log.is_enabled_for(logger.level):
+            logger("Processed %s message for %s: %s" % (
+                    direction, connector_name, msg.to_json()))
         return msg
 
     def handle_inbound(self, message, connector_name):
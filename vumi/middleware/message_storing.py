@@ -1,7 +1,15 @@
 # -*- test-case-name: vumi.middleware.tests.test_message_storing -*-
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from collections import deque
 
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, Deferred, succeed, maybeDeferred)
+from twisted.internet.task import LoopingCall
+
+from vumi import log
+from vumi.blinkenlights.metrics import MetricManager, Metric, MAX
+from vumi.errors import ConfigError
 from vumi.middleware.base import BaseMiddleware
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.components.message_store import MessageStore
@@ -9,6 +17,159 @@ from vumi.persist.txriak_manager import TxRiakManager
 from vumi.persist.txredis_manager import TxRedisManager
 
 
+class WriteBehindQueue(object):
+    """A bounded queue of writes performed by background writers.
+
+    Writes are queued by :meth:`enqueue` and performed in order by up to
+    `writers` concurrent writers. Failed writes are logged and counted but
+    not retried. Writes aren't batched because each message store write is
+    a separate Riak object, so throughput comes from running several
+    writers at once.
+
+    :param int max_size:
+        Maximum number of writes to queue.
+    :param int writers:
+        Maximum number of writes to perform at once.
+    :param str overflow:
+        What to do when the queue is full. If 'block' (the default),
+        :meth:`enqueue` returns a deferred that only fires once there's room
+        in the queue. If 'drop', the write is discarded and logged.
+    """
+
+    OVERFLOW_POLICIES = ('block', 'drop')
+
+    def __init__(self, max_size, writers=1, overflow='block'):
+        if overflow not in self.OVERFLOW_POLICIES:
+            raise ValueError("Unknown overflow policy %r" % (overflow,))
+        self.max_size = max_size
+        self.writers = writers
+        self.overflow = overflow
+        self.clock = self.get_clock()
+        self.stored = 0
+        self.failed = 0
+        self.dropped = 0
+        self.total_lag = 0.0
+        # [enqueued_at, func, args, kw] lists waiting for a writer.
+        self._queue = deque()
+        # (write, deferred) pairs waiting for room in the queue.
+        self._blocked = deque()
+        self._active = 0
+        self._flush_deferreds = []
+        self._metrics_task = None
+
+    def get_clock(self):
+        return reactor
+
+    def get_clocktime(self):
+        return self.clock.seconds()
+
+    def __len__(self):
+        return len(self._queue) + len(self._blocked)
+
+    def enqueue(self, func, *args, **kw):
+        """Queue a call to `func(*args, **kw)`.
+
+        :returns:
+            A deferred that fires once the write has been queued.
+        """
+        write = [self.get_clocktime(), func, args, kw]
+        if len(self._queue) < self.max_size:
+            self._queue.append(write)
+            d = succeed(None)
+        elif self.overflow == 'drop':
+            self.dropped += 1
+            log.warning("Write-behind queue full, dropping write.")
+            return succeed(None)
+        else:
+            d = Deferred()
+            self._blocked.append((write, d))
+        if self._active < self.writers:
+            self._write_queued()
+        return d
+
+    def _unblock(self):
+        while self._blocked and len(self._queue) < self.max_size:
+            write, d = self._blocked.popleft()
+            self._queue.append(write)
+            d.callback(None)
+
+    @inlineCallbacks
+    def _write_queued(self):
+        self._active += 1
+        try:
+            while self._queue:
+                enqueued_at, func, args, kw = self._queue.popleft()
+                self._unblock()
+                try:
+                    yield maybeDeferred(func, *args, **kw)
+                except Exception:
+                    self.failed += 1
+                    log.err(None, "Write-behind write failed.")
+                else:
+                    self.stored += 1
+                self.total_lag += self.get_clocktime() - enqueued_at
+        finally:
+            self._active -= 1
+        if not self._active:
+            flush_deferreds, self._flush_deferreds = self._flush_deferreds, []
+            for d in flush_deferreds:
+                d.callback(None)
+
+    def flush(self):
+        """Return a deferred that fires once all queued writes are done."""
+        if not self._active and not self:
+            return succeed(None)
+        d = Deferred()
+        self._flush_deferreds.append(d)
+        return d
+
+    def get_stats(self):
+        """Return a dict of queue length, write counts and lag statistics.
+
+        `lag` is the age of the oldest write still queued and `average_lag`
+        is the average time from queueing to completion of finished writes.
+        """
+        finished = self.stored + self.failed
+        lag = 0.0
+        if self._queue:
+            lag = self.get_clocktime() - self._queue[0][0]
+        return {
+            'queued': len(self),
+            'writing': self._active,
+            'stored': self.stored,
+            'failed': self.failed,
+            'dropped': self.dropped,
+            'lag': lag,
+            'average_lag': self.total_lag / finished if finished else 0.0,
+        }
+
+    def start_metrics(self, metric_manager, interval=1):
+        """Record the queue length and lag as metrics every `interval`
+        seconds.
+
+        The metrics are registered with `metric_manager` as
+        `write_behind.queued` and `write_behind.lag` and publish the
+        largest value seen since they were last published.
+        """
+        self._queued_metric = metric_manager.register(
+            Metric('write_behind.queued', [MAX]))
+        self._lag_metric = metric_manager.register(
+            Metric('write_behind.lag', [MAX]))
+        self._metrics_task = LoopingCall(self._record_metrics)
+        self._metrics_task.clock = self.clock
+        self._metrics_task.start(interval, now=False)
+
+    def stop_metrics(self):
+        if self._metrics_task is not None:
+            self._metrics_task.stop()
+            self._metrics_task = None
+
+    def _record_metrics(self):
+        stats = self.get_stats()
+        self._queued_metric.set(stats['queued'])
+        self._lag_metric.set(stats['lag'])
+
+
 class StoringMiddleware(BaseMiddleware):
     """
     Middleware for storing inbound and outbound messages and events.
@@ -35,6 +196,35 @@ class StoringMiddleware(BaseMiddleware):
     :param dict riak:
         Riak configuration parameters. Must contain at least
         a bucket_prefix key.
+    :param int lookup_cache_size:
+        Number of tags and outbound messages to cache the batch of, so that
+        most messages and events don't need a Riak lookup to find their
+        batch. Set to 0 to disable the cache. Default is 10000.
+    :param float lookup_cache_ttl:
+        Number of seconds to cache the batch a tag is associated with. Batches
+        started or finished by other workers may be missed for this long.
+        Default is 5.
+    :param bool write_behind:
+        If True, messages and events are passed on immediately and stored by
+        background writers instead of waiting for the store. Queued writes
+        are flushed when the middleware is torn down but are lost if the
+        worker dies, and events may be stored before the messages they refer
+        to. Default is False.
+    :param int write_behind_size:
+        Maximum number of messages and events waiting to be stored.
+        Default is 10000.
+    :param int write_behind_writers:
+        Number of messages and events to store at once. Default is 10.
+    :param string write_behind_overflow:
+        What to do when the write-behind queue is full. If 'block',
+        processing waits until there's room in the queue. If 'drop', the
+        message or event is passed on without being stored. Default is
+        'block'.
+    :param string write_behind_metrics_prefix:
+        If set, the write-behind queue length and the age of the oldest
+        queued write are published as metrics named
+        `<prefix>write_behind.queued` and `<prefix>write_behind.lag`.
+        Default is not to publish them.
     """
 
     @inlineCallbacks
@@ -43,23 +233,52 @@ class StoringMiddleware(BaseMiddleware):
         r_config = self.config.get('redis_manager', {})
         self.redis = yield TxRedisManager.from_config(r_config)
         manager = TxRiakManager.from_config(self.config.get('riak_manager'))
-        self.store = MessageStore(manager,
-                                  self.redis.sub_manager(store_prefix))
+        self.store = MessageStore(
+            manager, self.redis.sub_manager(store_prefix),
+            lookup_cache_size=self.config.get('lookup_cache_size', 10000),
+            lookup_cache_ttl=self.config.get('lookup_cache_ttl', 5))
+        self.write_behind = None
+        self.metric_manager = None
+        if self.config.get('write_behind', False):
+            overflow = self.config.get('write_behind_overflow', 'block')
+            if overflow not in WriteBehindQueue.OVERFLOW_POLICIES:
+                raise ConfigError(
+                    "Unknown write_behind_overflow policy %r" % (overflow,))
+            self.write_behind = WriteBehindQueue(
+                self.config.get('write_behind_size', 10000),
+                writers=self.config.get('write_behind_writers', 10),
+                overflow=overflow)
+            metrics_prefix = self.config.get('write_behind_metrics_prefix')
+            if metrics_prefix is not None:
+                self.metric_manager = yield self.worker.start_publisher(
+                    MetricManager, metrics_prefix)
+                self.write_behind.start_metrics(self.metric_manager)
 
     @inlineCallbacks
     def teardown_middleware(self):
+        if self.write_behind is not None:
+            yield self.write_behind.flush()
+            self.write_behind.stop_metrics()
+        if self.metric_manager is not None:
+            self.metric_manager.stop()
         yield self.redis.close_manager()
 
+    def _store(self, func, message, **kw):
+        if self.write_behind is None:
+            return func(message, **kw)
+        # Later handlers may modify the message before it's written.
+        return self.write_behind.enqueue(func, message.copy(), **kw)
+
     @inlineCallbacks
     def handle_inbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_inbound_message(message, tag=tag)
+        yield self._store(self.store.add_inbound_message, message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
     def handle_outbound(self, message, connector_name):
         tag = TaggingMiddleware.map_msg_to_tag(message)
-        yield self.store.add_outbound_message(message, tag=tag)
+        yield self._store(self.store.add_outbound_message, message, tag=tag)
         returnValue(message)
 
     @inlineCallbacks
@@ -72,5 +291,5 @@ class StoringMiddleware(BaseMiddleware):
             date = transport_metadata['date']
             if not isinstance(date, basestring):
                 transport_metadata['date'] = date.isoformat()
-        yield self.store.add_event(event)
+        yield self._store(self.store.add_event, event)
         returnValue(event)
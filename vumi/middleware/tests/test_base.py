@@ -1,12 +1,14 @@
 import time
 import yaml
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
 from twisted.trial.unittest import TestCase
 
 from vumi.middleware.base import (BaseMiddleware, MiddlewareStack,
+                                  MiddlewareError, MiddlewareTimingMetrics,
                                   create_middlewares_from_config,
                                   setup_middlewares_from_config)
+from vumi.blinkenlights.metrics import MetricManager
 
 
 class ToyMiddleware(BaseMiddleware):
@@ -83,6 +85,62 @@ class MiddlewareStackTestCase(TestCase):
                 ('mw1', 'inbound', 'dummy_msg.mw3.mw2.mw1', 'end_foo'),
                 ])
 
+    def test_apply_consume_sync_middlewares(self):
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(self.successResultOf(d), 'dummy_msg.mw1.mw2.mw3')
+
+    def test_apply_consume_async_middleware(self):
+        deferreds = []
+
+        def handle_inbound(message, connector_name):
+            deferreds.append(Deferred())
+            return deferreds[-1]
+
+        self.stack.middlewares[1].handle_inbound = handle_inbound
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.assertNoResult(d)
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ])
+        deferreds[0].callback('async_msg')
+        self.assertEqual(self.successResultOf(d), 'async_msg.mw3')
+        self.assert_processed([
+                ('mw1', 'inbound', 'dummy_msg.mw1', 'end_foo'),
+                ('mw3', 'inbound', 'async_msg.mw3', 'end_foo'),
+                ])
+
+    def test_apply_consume_none_result(self):
+        self.stack.middlewares[1].handle_inbound = lambda msg, conn: None
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d).trap(MiddlewareError)
+        self.assertEqual(len(self.processed_messages), 1)
+
+    def test_apply_consume_handler_error(self):
+        def handle_inbound(message, connector_name):
+            raise ValueError("bad message")
+
+        self.stack.middlewares[0].handle_inbound = handle_inbound
+        d = self.stack.apply_consume('inbound', 'dummy_msg', 'end_foo')
+        self.failureResultOf(d).trap(ValueError)
+        self.assert_processed([])
+
+    def test_timing_hook(self):
+        timings = []
+        self.stack.timing_hook = lambda mw, handler_name, seconds: (
+            timings.append((mw.name, handler_name, seconds)))
+        async_d = Deferred()
+        self.stack.middlewares[2].handle_outbound = lambda msg, conn: async_d
+        d = self.stack.apply_publish('outbound', 'dummy_msg', 'end_foo')
+        self.assertEqual(timings, [])
+        async_d.callback('async_msg')
+        self.successResultOf(d)
+        self.assertEqual([t[:2] for t in timings], [
+                ('mw3', 'outbound'),
+                ('mw2', 'outbound'),
+                ('mw1', 'outbound'),
+                ])
+        self.assertTrue(all(t[2] >= 0 for t in timings))
+
     @inlineCallbacks
     def test_teardown_in_reverse_order(self):
 
@@ -98,6 +156,22 @@ class MiddlewareStackTestCase(TestCase):
             ['mw3', 'mw2', 'mw1'])
 
 
+class MiddlewareTimingMetricsTestCase(TestCase):
+
+    def test_records_timers(self):
+        mm = MetricManager("vumi.test.")
+        hook = MiddlewareTimingMetrics(mm)
+        mw = ToyMiddleware('mw1', {}, self)
+        hook(mw, 'inbound', 0.5)
+        hook(mw, 'inbound', 1.5)
+        hook(mw, 'event', 0.25)
+        inbound = mm['middleware.mw1.inbound']
+        self.assertEqual(inbound.name, 'vumi.test.middleware.mw1.inbound')
+        self.assertEqual([v for _, v in inbound.poll()], [0.5, 1.5])
+        event = mm['middleware.mw1.event']
+        self.assertEqual([v for _, v in event.poll()], [0.25])
+
+
 class UtilityFunctionsTestCase(TestCase):
 
     TEST_CONFIG_1 = {
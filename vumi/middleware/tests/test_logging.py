@@ -1,9 +1,12 @@
 """Tests from vumi.middleware.logging."""
 
+import logging
+
 from twisted.trial.unittest import TestCase
 
 from vumi.middleware.logging import LoggingMiddleware
 from vumi.tests.utils import LogCatcher
+from vumi import log
 
 
 class DummyMessage(object):
@@ -11,6 +14,8 @@ class DummyMessage(object):
         self._json = json
 
     def to_json(self):
+        if self._json is None:
+            raise AssertionError("Message serialized for discarded log.")
         return self._json
 
 
@@ -66,3 +71,12 @@ class LoggingMiddlewareTestCase(TestCase):
         self.assertEqual([log['message'][0] for log in logs], [
             "Processed failure message for dummy_connector: failure",
             ])
+
+    def test_log_level_disabled(self):
+        self.patch(log, '_level', logging.WARNING)
+        mw = self.mklogger({})
+        with LogCatcher() as lc:
+            msg = DummyMessage(None)
+            result = mw.handle_inbound(msg, "dummy_connector")
+            self.assertEqual(result, msg)
+        self.assertEqual(lc.logs, [])
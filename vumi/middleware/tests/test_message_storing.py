@@ -1,13 +1,135 @@
 """Tests for vumi.middleware.message_storing."""
 
 from twisted.trial.unittest import TestCase
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from twisted.internet.task import Clock
 
 from vumi.middleware.tagger import TaggingMiddleware
 from vumi.message import TransportUserMessage, TransportEvent
+from vumi.middleware.message_storing import WriteBehindQueue
+from vumi.blinkenlights.metrics import MetricManager
 from vumi.tests.utils import PersistenceMixin
 
 
+class WriteBehindQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.patch(WriteBehindQueue, 'get_clock', lambda _: self.clock)
+        self.writes = []
+
+    def write(self, value):
+        d = Deferred()
+        self.writes.append((value, d))
+        return d
+
+    def finish_write(self, index=0):
+        _value, d = self.writes.pop(index)
+        d.callback(None)
+
+    def test_enqueue(self):
+        queue = WriteBehindQueue(10)
+        stored = []
+        d = queue.enqueue(stored.append, "a")
+        self.assertTrue(d.called)
+        self.assertEqual(stored, ["a"])
+        self.assertEqual(queue.get_stats()['stored'], 1)
+
+    def test_writers(self):
+        queue = WriteBehindQueue(10, writers=2)
+        for value in "abc":
+            queue.enqueue(self.write, value)
+        self.assertEqual([v for v, _ in self.writes], ["a", "b"])
+        self.assertEqual(len(queue), 1)
+        self.finish_write()
+        self.assertEqual([v for v, _ in self.writes], ["b", "c"])
+        self.assertEqual(len(queue), 0)
+        self.assertEqual(queue.get_stats()['writing'], 2)
+
+    def test_overflow_block(self):
+        queue = WriteBehindQueue(1)
+        queue.enqueue(self.write, "a")
+        self.assertTrue(queue.enqueue(self.write, "b").called)
+        d = queue.enqueue(self.write, "c")
+        self.assertFalse(d.called)
+        self.assertEqual(len(queue), 2)
+        self.finish_write()
+        self.assertTrue(d.called)
+        self.assertEqual([v for v, _ in self.writes], ["b"])
+
+    def test_overflow_drop(self):
+        queue = WriteBehindQueue(1, overflow='drop')
+        queue.enqueue(self.write, "a")
+        queue.enqueue(self.write, "b")
+        self.assertTrue(queue.enqueue(self.write, "c").called)
+        self.assertEqual(queue.get_stats()['dropped'], 1)
+        self.finish_write()
+        self.finish_write()
+        self.assertEqual(self.writes, [])
+        self.assertEqual(queue.get_stats()['stored'], 2)
+
+    def test_unknown_overflow_policy(self):
+        self.assertRaises(ValueError, WriteBehindQueue, 1, overflow='foo')
+
+    def test_failed_write(self):
+        queue = WriteBehindQueue(10)
+
+        def fail():
+            raise ValueError("Oops")
+
+        queue.enqueue(fail)
+        queue.enqueue(self.write, "a")
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertEqual([v for v, _ in self.writes], ["a"])
+        self.assertEqual(queue.get_stats()['failed'], 1)
+
+    def test_flush(self):
+        queue = WriteBehindQueue(10)
+        self.assertTrue(queue.flush().called)
+        queue.enqueue(self.write, "a")
+        queue.enqueue(self.write, "b")
+        d = queue.flush()
+        self.finish_write()
+        self.assertFalse(d.called)
+        self.finish_write()
+        self.assertTrue(d.called)
+
+    def test_lag_stats(self):
+        queue = WriteBehindQueue(10)
+        queue.enqueue(self.write, "a")
+        self.clock.advance(1)
+        queue.enqueue(self.write, "b")
+        self.clock.advance(2)
+        stats = queue.get_stats()
+        self.assertEqual(stats['queued'], 1)
+        self.assertEqual(stats['lag'], 2)
+        self.finish_write()
+        self.finish_write()
+        stats = queue.get_stats()
+        self.assertEqual(stats['lag'], 0)
+        self.assertEqual(stats['average_lag'], 2.5)
+
+    def test_metrics(self):
+        queue = WriteBehindQueue(10)
+        mm = MetricManager("vumi.test.")
+        queue.start_metrics(mm)
+        queue.enqueue(self.write, "a")
+        queue.enqueue(self.write, "b")
+        queue.enqueue(self.write, "c")
+        self.clock.advance(1)
+        self.finish_write()
+        self.clock.advance(1)
+        queued = mm['write_behind.queued']
+        self.assertEqual(queued.name, 'vumi.test.write_behind.queued')
+        self.assertEqual(queued.aggs, ('max',))
+        self.assertEqual([v for _, v in queued.poll()], [2, 1])
+        self.assertEqual(
+            [v for _, v in mm['write_behind.lag'].poll()], [1, 2])
+        queue.stop_metrics()
+        self.clock.advance(1)
+        self.assertEqual(queued.poll(), [])
+
+
 class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
 
     use_riak = True
@@ -19,7 +141,7 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
     def setUp(self):
         self._persist_setUp()
         dummy_worker = object()
-        config = self.mk_config({})
+        config = self.mk_config(self.DEFAULT_CONFIG)
 
         # Create and stash a riak manager to clean up afterwards, because we
         # don't get access to the one inside the middleware.
@@ -52,6 +174,11 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
                              sent_message_id="1")
         return ack
 
+    def flush_writes(self):
+        if self.mw.write_behind is None:
+            return succeed(None)
+        return self.mw.write_behind.flush()
+
     @inlineCallbacks
     def assert_batch_keys(self, batch_id, outbound=[], inbound=[]):
         outbound_keys = yield self.store.batch_outbound_keys(batch_id)
@@ -61,6 +188,7 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
 
     @inlineCallbacks
     def assert_outbound_stored(self, msg, batch_id=None, events=[]):
+        yield self.flush_writes()
         msg_id = msg['message_id']
         stored_msg = yield self.store.get_outbound_message(msg_id)
         self.assertEqual(stored_msg, msg)
@@ -72,6 +200,7 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
 
     @inlineCallbacks
     def assert_inbound_stored(self, msg, batch_id=None):
+        yield self.flush_writes()
         msg_id = msg['message_id']
         stored_msg = yield self.store.get_inbound_message(msg_id)
         self.assertEqual(stored_msg, msg)
@@ -122,3 +251,18 @@ class StoringMiddlewareTestCase(TestCase, PersistenceMixin):
         response = yield self.mw.handle_event(ack, "dummy_connector")
         self.assertTrue(isinstance(response, TransportEvent))
         yield self.assert_outbound_stored(msg, events=[event_id])
+
+
+class WriteBehindStoringMiddlewareTestCase(StoringMiddlewareTestCase):
+
+    DEFAULT_CONFIG = {
+        'write_behind': True,
+        }
+
+    @inlineCallbacks
+    def test_handle_outbound_copies_message(self):
+        msg = self.mk_msg()
+        yield self.mw.handle_outbound(msg, "dummy_connector")
+        stored = msg.copy()
+        msg['content'] = 'modified'
+        yield self.assert_outbound_stored(stored)
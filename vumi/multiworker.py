@@ -1,8 +1,68 @@
 # -*- test-case-name: vumi.tests.test_multiworker -*-
 
+import os
+import sys
+import shutil
+import logging
+import tempfile
 from copy import deepcopy
 
-from vumi.service import Worker, WorkerCreator
+import yaml
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, inlineCallbacks, gatherResults, succeed)
+from twisted.internet.protocol import ProcessProtocol
+
+from vumi.service import Worker, WorkerCreator, AmqpConnectionPool
+from vumi.sentry import SentryLoggerService
+from vumi.errors import ConfigError
+from vumi import log
+
+
+class ChildProcess(object):
+    """A child process started by a supervising :class:`MultiWorker`.
+
+    :param str name:
+        Name of the child process, used in logs.
+    :param dict workers:
+        Dict of worker_name -> fully-qualified class name of the workers
+        the process runs.
+    """
+
+    def __init__(self, name, workers):
+        self.name = name
+        self.workers = workers
+        self.process = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.restart_call = None
+        self._exit_waiters = []
+
+    def is_running(self):
+        return self.process is not None
+
+    def wait_for_exit(self):
+        if not self.is_running():
+            return succeed(None)
+        d = Deferred()
+        self._exit_waiters.append(d)
+        return d
+
+    def exited(self):
+        self.process = None
+        waiters, self._exit_waiters = self._exit_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+
+class ChildProcessProtocol(ProcessProtocol):
+    def __init__(self, supervisor, child):
+        self.supervisor = supervisor
+        self.child = child
+
+    def processEnded(self, reason):
+        self.supervisor.child_process_ended(self.child, reason)
 
 
 class MultiWorker(Worker):
@@ -16,6 +76,32 @@ class MultiWorker(Worker):
     :type defaults: dict
     :param defaults:
         Default configuration for child workers.
+    :type amqp_connections: int
+    :param amqp_connections:
+        If set, child workers share this many AMQP connections rather than
+        each opening its own, and publishers on a connection share a
+        channel. Default is None (one connection per child worker).
+    :type processes: int
+    :param processes:
+        If set, run the child workers in up to this many separate
+        processes rather than in this one, so that they can use more than
+        one CPU. Crashed processes are restarted. Default is None (run all
+        child workers in this process).
+    :type process_grouping: str
+    :param process_grouping:
+        How to distribute child workers across processes. `instance`
+        (the default) spreads workers evenly across processes. `class`
+        keeps all workers of the same class in the same process.
+    :type restart_delay: float
+    :param restart_delay:
+        Seconds to wait before restarting a crashed process. The delay is
+        doubled each time the process crashes again soon after being
+        restarted. Default is 1.
+    :type max_restart_delay: float
+    :param max_restart_delay:
+        Maximum seconds to wait before restarting a crashed process. A
+        process that runs for at least this long before crashing is
+        restarted after `restart_delay` again. Default is 60.
 
     Each entry in the ``workers`` config dict defines a child worker to start.
     A child worker's configuration should be provided in a config dict keyed by
@@ -25,6 +111,15 @@ class MultiWorker(Worker):
 
     WORKER_CREATOR = WorkerCreator
 
+    PROCESS_GROUPINGS = ('instance', 'class')
+    SUPERVISOR_OPTIONS = ('processes', 'process_grouping', 'restart_delay',
+                          'max_restart_delay')
+    DEFAULT_RESTART_DELAY = 1
+    DEFAULT_MAX_RESTART_DELAY = 60
+
+    def get_clock(self):
+        return reactor
+
     def construct_worker_config(self, worker_name):
         """
         Construct an appropriate configuration for the child worker.
@@ -33,6 +128,14 @@ class MultiWorker(Worker):
         config.update(self.config.get(worker_name, {}))
         return config
 
+    def create_connection_pool(self, size):
+        """
+        Create a pool of AMQP connections for child workers to share.
+        """
+        pool = AmqpConnectionPool(self.options, size)
+        pool.setServiceParent(self)
+        return pool
+
     def create_worker(self, worker_name, worker_class):
         """
         Create a child worker.
@@ -46,10 +149,161 @@ class MultiWorker(Worker):
     def startService(self):
         super(MultiWorker, self).startService()
         self.workers = []
+        self.child_processes = []
+        if self.config.get('processes'):
+            return self.start_child_processes()
         self.worker_creator = self.WORKER_CREATOR(self.options)
+        if self.config.get('amqp_connections'):
+            self.worker_creator.connection_pool = self.create_connection_pool(
+                int(self.config['amqp_connections']))
         for wname, wclass in self.config.get('workers', {}).items():
             worker = self.create_worker(wname, wclass)
             self.workers.append(worker)
 
+    @inlineCallbacks
+    def stopService(self):
+        yield self.stop_child_processes()
+        yield super(MultiWorker, self).stopService()
+
     def startWorker(self):
         pass
+
+    def group_workers(self):
+        """
+        Split the configured workers into groups, one per child process.
+        """
+        processes = int(self.config['processes'])
+        grouping = self.config.get('process_grouping', 'instance')
+        if grouping not in self.PROCESS_GROUPINGS:
+            raise ConfigError("Unknown process_grouping %r, should be one"
+                              " of %r." % (grouping, self.PROCESS_GROUPINGS))
+        workers = self.config.get('workers', {})
+        if grouping == 'class':
+            by_class = {}
+            for wname, wclass in sorted(workers.items()):
+                by_class.setdefault(wclass, []).append(wname)
+            units = [by_class[wclass] for wclass in sorted(by_class)]
+        else:
+            units = [[wname] for wname in sorted(workers)]
+        groups = [{} for _ in range(processes)]
+        for i, wnames in enumerate(units):
+            for wname in wnames:
+                groups[i % processes][wname] = workers[wname]
+        return [group for group in groups if group]
+
+    def start_child_processes(self):
+        self.clock = self.get_clock()
+        self.restart_delay = float(self.config.get(
+            'restart_delay', self.DEFAULT_RESTART_DELAY))
+        self.max_restart_delay = float(self.config.get(
+            'max_restart_delay', self.DEFAULT_MAX_RESTART_DELAY))
+        groups = self.group_workers()
+        self.supervising = True
+        self.config_dir = tempfile.mkdtemp(prefix='vumi-multiworker-')
+        self.write_config_file('vumi-options.yaml', self.options)
+        prefix = self.name or 'multiworker'
+        for i, workers in enumerate(groups):
+            child = ChildProcess('%s-%d' % (prefix, i), workers)
+            self.child_processes.append(child)
+            self.start_child_process(child)
+
+    def write_config_file(self, filename, config):
+        path = os.path.join(self.config_dir, filename)
+        with open(path, 'w') as config_file:
+            yaml.safe_dump(config, config_file)
+        return path
+
+    def construct_child_process_config(self, child):
+        config = deepcopy(self.config)
+        for option in self.SUPERVISOR_OPTIONS:
+            config.pop(option, None)
+        config['workers'] = child.workers
+        return config
+
+    def child_process_args(self, child):
+        config_path = self.write_config_file(
+            '%s.yaml' % (child.name,),
+            self.construct_child_process_config(child))
+        return [
+            sys.executable, '-c',
+            'from twisted.scripts.twistd import run; run()',
+            '--nodaemon', '--pidfile=',
+            'vumi_worker',
+            '--worker-class', 'vumi.multiworker.MultiWorker',
+            '--config', config_path,
+            '--vumi-config', os.path.join(self.config_dir,
+                                          'vumi-options.yaml'),
+        ] + self.child_process_options()
+
+    def child_process_options(self):
+        """
+        Return command-line options for the settings that the vumi_worker
+        plugin removes from a worker's vumi options, so that child processes
+        log the same way as this one.
+        """
+        options = []
+        for service in self:
+            if isinstance(service, SentryLoggerService):
+                options.extend(['--sentry', service.dsn])
+        level = log.get_level()
+        if level != logging.NOTSET:
+            options.extend(['--log-level', logging.getLevelName(level)])
+        return options
+
+    def spawn_process(self, protocol, args):
+        return reactor.spawnProcess(
+            protocol, args[0], args, env=os.environ,
+            childFDs={0: 'w', 1: 1, 2: 2})
+
+    def start_child_process(self, child):
+        child.restart_call = None
+        child.started_at = self.clock.seconds()
+        child.process = self.spawn_process(
+            ChildProcessProtocol(self, child), self.child_process_args(child))
+        log.msg("Started process %s (pid %s) for workers: %s" % (
+            child.name, child.process.pid, ", ".join(sorted(child.workers))))
+
+    def child_process_ended(self, child, reason):
+        child.exited()
+        if not self.supervising:
+            return
+        if self.clock.seconds() - child.started_at >= self.max_restart_delay:
+            child.failures = 0
+        delay = min(self.restart_delay * 2 ** child.failures,
+                    self.max_restart_delay)
+        child.failures += 1
+        child.restarts += 1
+        log.warning("Process %s exited (%s), restarting in %s seconds." % (
+            child.name, reason.getErrorMessage(), delay))
+        child.restart_call = self.clock.callLater(
+            delay, self.start_child_process, child)
+
+    def get_process_status(self):
+        """
+        Return a list of dicts describing each child process.
+        """
+        now = self.clock.seconds() if self.child_processes else None
+        return [{
+            'name': child.name,
+            'workers': sorted(child.workers),
+            'pid': child.process.pid if child.is_running() else None,
+            'running': child.is_running(),
+            'uptime': now - child.started_at if child.is_running() else 0,
+            'restarts': child.restarts,
+        } for child in self.child_processes]
+
+    def stop_child_processes(self):
+        if not getattr(self, 'child_processes', None):
+            return succeed(None)
+        self.supervising = False
+        waiting = []
+        for child in self.child_processes:
+            if child.restart_call is not None:
+                child.restart_call.cancel()
+                child.restart_call = None
+            if child.is_running():
+                waiting.append(child.wait_for_exit())
+                child.process.signalProcess('TERM')
+        d = gatherResults(waiting)
+        d.addCallback(lambda _: shutil.rmtree(self.config_dir, True))
+        return d
@@ -91,6 +91,17 @@ class FakeRedis(object):
     def keys(self, pattern='*'):
         return fnmatch.filter(self._data.keys(), pattern)
 
+    @maybe_async
+    def scan(self, cursor, match=None, count=None):
+        # Our cursor is an offset into the sorted keys, which is stable
+        # enough for tests as long as keys aren't added during the scan.
+        keys = sorted(self._data)
+        if match is not None:
+            keys = fnmatch.filter(keys, match)
+        start = int(cursor)
+        end = start + (count or 10)
+        return [end if end < len(keys) else 0, keys[start:end]]
+
     @maybe_async
     def flushdb(self):
         self._data = {}
@@ -106,6 +117,12 @@ class FakeRedis(object):
         value = self._encode(value)  # set() sets string value
         self._data[key] = value
 
+    @maybe_async
+    def setex(self, key, seconds, value):
+        self.set.sync(self, key, value)
+        self.expire.sync(self, key, seconds)
+        return True
+
     @maybe_async
     def setnx(self, key, value):
         value = self._encode(value)  # set() sets string value
@@ -115,10 +132,17 @@ class FakeRedis(object):
         return 0
 
     @maybe_async
-    def delete(self, key):
-        existed = (key in self._data)
-        self._data.pop(key, None)
-        return existed
+    def delete(self, key, *keys):
+        if not keys:
+            existed = (key in self._data)
+            self._data.pop(key, None)
+            return existed
+        deleted = 0
+        for dkey in (key,) + keys:
+            if dkey in self._data:
+                del self._data[dkey]
+                deleted += 1
+        return deleted
 
     # Integer operations
 
@@ -303,6 +327,11 @@ class FakeRedis(object):
         zval = self._data.get(key, Zset())
         return zval.zscore(value)
 
+    @maybe_async
+    def zremrangebyscore(self, key, min, max):
+        zval = self._data.get(key, Zset())
+        return zval.zremrangebyscore(min, max)
+
     # List operations
     @maybe_async
     def llen(self, key):
@@ -323,8 +352,8 @@ class FakeRedis(object):
         self._data.setdefault(key, []).insert(0, obj)
 
     @maybe_async
-    def rpush(self, key, obj):
-        self._data.setdefault(key, []).append(obj)
+    def rpush(self, key, *values):
+        self._data.setdefault(key, []).extend(values)
         return self.llen.sync(self, key) - 1
 
     @maybe_async
@@ -395,6 +424,40 @@ class FakeRedis(object):
             return 1
         return 0
 
+    # Pipelining
+
+    def pipeline(self, transaction=True):
+        return FakeRedisPipeline(self, transaction)
+
+    @maybe_async
+    def _execute_pipeline(self, commands):
+        return [func(self, *args, **kw) for func, args, kw in commands]
+
+
+class FakeRedisPipeline(object):
+    """Queues calls to a :class:`FakeRedis` to be run together.
+
+    Since the fake is in process, queued calls are always run atomically
+    regardless of whether a transaction was requested.
+    """
+
+    def __init__(self, redis, transaction=True):
+        self._redis = redis
+        self._transaction = transaction
+        self._commands = []
+
+    def __getattr__(self, name):
+        func = getattr(self._redis, name).sync
+
+        def queue_call(*args, **kw):
+            self._commands.append((func, args, kw))
+            return self
+        return queue_call
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        return self._redis._execute_pipeline(commands)
+
 
 class Zset(object):
     """A Redis-like ordered set implementation."""
@@ -459,10 +522,15 @@ class Zset(object):
         results = dropwhile(mkcheck(min, False), results)
         results = takewhile(mkcheck(max, True), results)
         results = list(results)[start:]
-        if num is not None:
+        if num is not None and num >= 0:
             results = results[:num]
         return list(results)
 
+    def zremrangebyscore(self, min, max):
+        removed = set(v for v, _ in self.zrangebyscore(min, max))
+        self._zval = [val for val in self._zval if val[1] not in removed]
+        return len(removed)
+
     def zscore(self, val):
         for score, value in self._zval:
             if value == val:
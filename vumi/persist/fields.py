@@ -254,10 +254,19 @@ class VumiMessageDescriptor(FieldDescriptor):
         return dt.strftime(VUMI_DATE_FORMAT)
 
     def _timestamp_from_json(self, value):
+        if len(value) == 26:
+            # We always write timestamps in this fixed-width format and
+            # taking them apart by hand is much cheaper than strptime().
+            return datetime(
+                int(value[0:4]), int(value[5:7]), int(value[8:10]),
+                int(value[11:13]), int(value[14:16]), int(value[17:19]),
+                int(value[20:26]))
         return datetime.strptime(value, VUMI_DATE_FORMAT)
 
     def set_value(self, modelobj, msg):
         """Set the value associated with this descriptor."""
+        if not self.field.flatten:
+            return self._set_nested_value(modelobj, msg)
         self._clear_keys(modelobj)
         if msg is None:
             return
@@ -268,8 +277,20 @@ class VumiMessageDescriptor(FieldDescriptor):
             full_key = "%s%s" % (self.prefix, key)
             modelobj._riak_object._data[full_key] = value
 
+    def _set_nested_value(self, modelobj, msg):
+        payload = None
+        if msg is not None:
+            payload = msg.payload.copy()
+            # TODO: timestamp as datetime in payload must die.
+            if "timestamp" in payload:
+                payload["timestamp"] = self._timestamp_to_json(
+                    payload["timestamp"])
+        modelobj._riak_object._data[self.key] = payload
+
     def get_value(self, modelobj):
         """Get the value associated with this descriptor."""
+        if not self.field.flatten:
+            return self._get_nested_value(modelobj)
         payload = {}
         for key, value in modelobj._riak_object._data.iteritems():
             if key.startswith(self.prefix):
@@ -282,6 +303,17 @@ class VumiMessageDescriptor(FieldDescriptor):
             return None
         return self.field.message_class(**to_kwargs(payload))
 
+    def _get_nested_value(self, modelobj):
+        payload = modelobj._riak_object._data.get(self.key)
+        if not payload:
+            return None
+        payload = to_kwargs(payload)
+        # TODO: timestamp as datetime in payload must die.
+        if "timestamp" in payload:
+            payload["timestamp"] = self._timestamp_from_json(
+                payload["timestamp"])
+        return self.field.message_class(**payload)
+
 
 class VumiMessage(Field):
     """Field that represents a Vumi message.
@@ -293,14 +325,22 @@ class VumiMessage(Field):
         Usually one of Message, TransportUserMessage or TransportEvent.
     :param string prefix:
         The prefix to use when storing message payload keys in Riak. Default is
-        the name of the field followed by a dot ('.').
+        the name of the field followed by a dot ('.'). Ignored if `flatten`
+        is False.
+    :param bool flatten:
+        If True (the default), each payload key is stored as a separate
+        top-level key with `prefix` prepended. If False, the whole payload is
+        stored as a single nested value under the field name, which is much
+        cheaper to read and write. Models switching from one layout to the
+        other need a migrator.
     """
     descriptor_class = VumiMessageDescriptor
 
-    def __init__(self, message_class, prefix=None, **kw):
+    def __init__(self, message_class, prefix=None, flatten=True, **kw):
         super(VumiMessage, self).__init__(**kw)
         self.message_class = message_class
         self.prefix = prefix
+        self.flatten = flatten
 
     def custom_validate(self, value):
         if not isinstance(value, self.message_class):
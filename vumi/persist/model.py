@@ -2,8 +2,12 @@
 
 """Base classes for Vumi persistence models."""
 
+import urllib
+from collections import deque
 from functools import wraps
 
+from twisted.internet.defer import Deferred
+
 from vumi.errors import VumiError
 from vumi.persist.fields import Field, FieldDescriptor, ValidationError
 
@@ -272,6 +276,21 @@ class Model(object):
         """
         return manager.mr_from_field(cls, field_name, value)
 
+    @classmethod
+    def index_keys_page(cls, manager, field_name, value, end_value=None,
+                        max_results=None, continuation=None):
+        """Find object keys by index, a page at a time.
+
+        :returns:
+            A (possibly deferred) :class:`IndexPage`.
+        """
+        index_name, start_value, end_value = (
+            VumiMapReduce._index_vals_for_field(
+                cls, field_name, value, end_value))
+        return manager.index_keys_page(
+            cls, index_name, start_value, end_value,
+            max_results=max_results, continuation=continuation)
+
     @classmethod
     def index_match(cls, manager, query, field_name, value):
         """
@@ -394,6 +413,9 @@ class VumiMapReduce(object):
                 "pattern": "the regex pattern the value of `key` should match",
                 "flags": "the modifier flags to give to the RegExp object",
             }
+
+            A dotted key such as "msg.content" that isn't in the JSON
+            dictionary is looked up in nested dictionaries instead.
         :param str index_name:
             The name of the index
         :param str start_value:
@@ -416,6 +438,16 @@ class VumiMapReduce(object):
                         for (j in arg) {
                             var query = arg[j];
                             var content = data[query.key];
+                            if (content === undefined) {
+                                /*
+                                    look up dotted keys in nested values
+                                    too, e.g. "msg.content"
+                                */
+                                content = query.key.split(".").reduce(
+                                    function(obj, part) {
+                                        return obj ? obj[part] : undefined;
+                                    }, data);
+                            }
                             var regex = RegExp(query.pattern, query.flags)
                             if(content && regex.test(content)) {
                                 return [value.key];
@@ -477,17 +509,80 @@ class VumiMapReduce(object):
             self._riak_mapreduce_obj, self._results_to_keys)
 
 
+class IndexPage(object):
+    """A page of keys from a paginated secondary index query.
+
+    Iterating over the page gives its keys. Further pages are fetched with
+    :meth:`next_page`, so a large index can be walked without holding all
+    of its keys in memory at once.
+
+    :param Manager manager:
+        The manager to fetch further pages with.
+    :param Model model:
+        The model class whose bucket was queried.
+    :param str index_name:
+        The name of the index.
+    :param str start_value:
+        The value (or start of the range of values) queried.
+    :param str end_value:
+        The end of the range of values queried, or None.
+    :param int max_results:
+        The maximum number of keys per page, or None for no limit.
+    :param list keys:
+        The keys in this page.
+    :param str continuation:
+        The continuation for the next page, or None if this is the last page.
+    """
+
+    def __init__(self, manager, model, index_name, start_value, end_value,
+                 max_results, keys, continuation):
+        self._manager = manager
+        self._model = model
+        self._index_name = index_name
+        self._start_value = start_value
+        self._end_value = end_value
+        self._max_results = max_results
+        self._keys = keys
+        self.continuation = continuation
+
+    def __iter__(self):
+        return iter(self._keys)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def has_next_page(self):
+        return self.continuation is not None
+
+    def next_page(self):
+        """Fetch the next page of keys.
+
+        :returns:
+            A (possibly deferred) :class:`IndexPage`, or None if this is the
+            last page.
+        """
+        if not self.has_next_page():
+            return None
+        return self._manager.index_keys_page(
+            self._model, self._index_name, self._start_value,
+            self._end_value, max_results=self._max_results,
+            continuation=self.continuation)
+
+
 class Manager(object):
     """A wrapper around a Riak client."""
 
     DEFAULT_LOAD_BUNCH_SIZE = 100
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 1
     DEFAULT_MAPREDUCE_TIMEOUT = 4 * 60 * 1000  # in milliseconds
 
     def __init__(self, client, bucket_prefix, load_bunch_size=None,
-                 mapreduce_timeout=None):
+                 mapreduce_timeout=None, load_bunch_concurrency=None):
         self.client = client
         self.bucket_prefix = bucket_prefix
         self.load_bunch_size = load_bunch_size or self.DEFAULT_LOAD_BUNCH_SIZE
+        self.load_bunch_concurrency = (load_bunch_concurrency or
+                                       self.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         self.mapreduce_timeout = (mapreduce_timeout or
                                   self.DEFAULT_MAPREDUCE_TIMEOUT)
         self._bucket_cache = {}
@@ -496,7 +591,11 @@ class Manager(object):
         return ModelProxy(self, modelcls)
 
     def sub_manager(self, sub_prefix):
-        return self.__class__(self.client, self.bucket_prefix + sub_prefix)
+        return self.__class__(
+            self.client, self.bucket_prefix + sub_prefix,
+            load_bunch_size=self.load_bunch_size,
+            mapreduce_timeout=self.mapreduce_timeout,
+            load_bunch_concurrency=self.load_bunch_concurrency)
 
     def bucket_name(self, modelcls_or_obj):
         return self.bucket_prefix + modelcls_or_obj.bucket
@@ -585,13 +684,28 @@ class Manager(object):
     def load_all_bunches(self, model, keys):
         """Load batches of model instances for a list of keys from Riak.
 
+        Up to `load_bunch_concurrency` bunches are loaded at once. Loading
+        the next bunch only starts when the caller asks for it, so a slow
+        consumer never has more than that many bunches in flight.
+
         :returns:
-            An iterator over (possibly deferred) lists of model instances.
+            An iterator over (possibly deferred) lists of model instances,
+            one per bunch of keys and in the same order as the keys.
         """
-        while keys:
-            batch_keys = keys[:self.load_bunch_size]
-            keys = keys[self.load_bunch_size:]
-            yield self._load_bunch(model, batch_keys)
+        pending = deque()
+        try:
+            for start in xrange(0, len(keys), self.load_bunch_size):
+                pending.append(self._load_bunch(
+                    model, keys[start:start + self.load_bunch_size]))
+                if len(pending) >= self.load_bunch_concurrency:
+                    yield pending.popleft()
+            while pending:
+                yield pending.popleft()
+        finally:
+            # If the caller stops early, nobody will see these results.
+            for bunch in pending:
+                if isinstance(bunch, Deferred):
+                    bunch.addErrback(lambda f: None)
 
     def riak_map_reduce(self):
         """Construct a RiakMapReduce object for this client."""
@@ -628,6 +742,46 @@ class Manager(object):
     def mr_from_keys(self, model, keys):
         return VumiMapReduce.from_keys(self, model, keys)
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        """Fetch a page of keys from a secondary index.
+
+        Pages are fetched directly from the index rather than through a
+        map-reduce, using Riak's continuation-based pagination.
+
+        :param int max_results:
+            Maximum number of keys to return. Default is None (all keys).
+        :param str continuation:
+            The continuation from the previous page, if any.
+
+        :returns:
+            A (possibly deferred) :class:`IndexPage`.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " .index_keys_page(...)")
+
+    def _index_page_request(self, model, index_name, start_value, end_value,
+                            max_results, continuation):
+        """Return the URI and query parameters for an index page request."""
+        segments = [
+            "buckets", self.bucket_name(model), "index", index_name,
+            str(start_value)]
+        if end_value is not None:
+            segments.append(str(end_value))
+        uri = "/".join(urllib.quote(segment, safe='') for segment in segments)
+        params = {}
+        if max_results is not None:
+            params['max_results'] = max_results
+            if continuation is not None:
+                params['continuation'] = continuation
+        return uri, params or None
+
+    def _index_page_from_response(self, model, index_name, start_value,
+                                  end_value, max_results, response):
+        return IndexPage(
+            self, model, index_name, start_value, end_value, max_results,
+            response.get('keys', []), response.get('continuation'))
+
     def riak_enable_search(self, model):
         """Enable search indexing for the model's bucket."""
         raise NotImplementedError("Sub-classes of Manager should implement"
@@ -661,6 +815,12 @@ class ModelProxy(object):
     def index_lookup(self, field_name, value):
         return self._modelcls.index_lookup(self._manager, field_name, value)
 
+    def index_keys_page(self, field_name, value, end_value=None,
+                        max_results=None, continuation=None):
+        return self._modelcls.index_keys_page(
+            self._manager, field_name, value, end_value,
+            max_results=max_results, continuation=continuation)
+
     def index_match(self, query, field_name, value):
         return self._modelcls.index_match(self._manager, query, field_name,
                                             value)
@@ -1,12 +1,20 @@
 # -*- test-case-name: vumi.persist.tests.test_redis_base -*-
 
 import os
+import hashlib
+from bisect import bisect
 from functools import wraps
+from itertools import chain
 
+from vumi.errors import VumiError
 from vumi.persist.ast_magic import make_function
 from vumi.persist.fake_redis import FakeRedis
 
 
+class CrossShardError(VumiError):
+    """Raised when a command's keys are on different shards."""
+
+
 def make_callfunc(name, redis_call):
 
     def func(self, *a, **kw):
@@ -44,15 +52,44 @@ class RedisCall(object):
         self.key_args = key_args
 
 
+class LazyCallMethod(object):
+    """Builds the method for a :class:`RedisCall` when first looked up.
+
+    Building methods is relatively slow and most processes only use a
+    handful of them, so we don't build them all when the class is created.
+    Once built, the method replaces this descriptor on the class.
+    """
+
+    def __init__(self, name, redis_call):
+        self.name = name
+        self.redis_call = redis_call
+        self.owner = None
+
+    def __get__(self, instance, owner):
+        func = make_callfunc(self.name, self.redis_call)
+        setattr(self.owner, self.name, func)
+        return func.__get__(instance, owner)
+
+
 class CallMakerMetaclass(type):
     def __new__(meta, classname, bases, class_dict):
         new_class_dict = {}
+        redis_calls = {}
+        lazy_methods = []
+        for base in reversed(bases):
+            redis_calls.update(getattr(base, '_redis_calls', {}))
         for name, attr in class_dict.items():
             if isinstance(attr, RedisCall):
-                attr = make_callfunc(name, attr)
+                redis_calls[name] = attr
+                attr = LazyCallMethod(name, attr)
+                lazy_methods.append(attr)
 
             new_class_dict[name] = attr
-        return type.__new__(meta, classname, bases, new_class_dict)
+        new_class_dict['_redis_calls'] = redis_calls
+        cls = type.__new__(meta, classname, bases, new_class_dict)
+        for lazy_method in lazy_methods:
+            lazy_method.owner = cls
+        return cls
 
 
 class Manager(object):
@@ -80,8 +117,36 @@ class Manager(object):
                                  key_separator=self._key_separator)
         if isinstance(self._client, FakeRedis):
             sub_man._close = self._client.teardown
+        elif isinstance(self._client, ShardedRedis):
+            sub_man._close = self._client.close
         return sub_man
 
+    def hash_tag(self, value):
+        """Mark `value` as the part of a key to use for choosing a shard.
+
+        Keys containing the same hash tag are stored on the same shard of a
+        sharded manager, so they can be used together in commands like
+        SMOVE. Managers that aren't sharded return `value` unchanged, so that
+        existing keys keep their names.
+        """
+        if isinstance(self._client, ShardedRedis):
+            return "{%s}" % (value,)
+        return value
+
+    def pipeline(self, transaction=False):
+        """Return a :class:`Pipeline` for sending several calls together.
+
+        :param bool transaction:
+            If true, the calls are wrapped in MULTI/EXEC so that they are
+            executed atomically.
+        """
+        return Pipeline(self, transaction)
+
+    def multi(self):
+        """Return a :class:`Pipeline` whose calls are executed atomically.
+        """
+        return self.pipeline(transaction=True)
+
     @staticmethod
     def calls_manager(manager_attr):
         """Decorate a method that calls a manager.
@@ -132,6 +197,11 @@ class Manager(object):
                 fake_redis = None
             return cls._fake_manager(fake_redis, key_prefix, key_separator)
 
+        shards = config.pop('shards', None)
+        if shards is not None:
+            return cls._sharded_manager(
+                cls._shard_configs(config, shards), key_prefix, key_separator)
+
         return cls._manager_from_config(config, key_prefix, key_separator)
 
     @classmethod
@@ -139,6 +209,39 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._fake_manager(...)")
 
+    @staticmethod
+    def _shard_configs(config, shards):
+        """Return a list of `(name, config)` pairs for the given shards.
+
+        Each shard's config is merged with the shared `config`. Shards are
+        named by their position in the list unless they have a `name`.
+        """
+        shard_configs = []
+        for i, shard in enumerate(shards):
+            shard_config = dict(config, **shard)
+            name = shard_config.pop('name', 'shard%d' % (i,))
+            shard_configs.append((name, shard_config))
+        return shard_configs
+
+    @classmethod
+    def _sharded_manager(cls, shard_configs, key_prefix, key_separator):
+        """Construct a manager that shards keys across several servers.
+
+        :param list shard_configs:
+            List of `(name, config)` pairs, one for each shard.
+        :param str key_prefix:
+            Key prefix for namespacing.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._sharded_manager(...)")
+
+    @classmethod
+    def _from_shard_managers(cls, shards, key_prefix, key_separator):
+        client = ShardedRedis(cls, shards)
+        manager = cls(client, key_prefix, key_separator)
+        manager._close = client.close
+        return manager
+
     @classmethod
     def _manager_from_config(cls, config, key_prefix, key_separator):
         """Construct a client from a dictionary of options.
@@ -179,6 +282,15 @@ class Manager(object):
         raise NotImplementedError("Sub-classes of Manager should implement"
                                   " ._filter_redis_results()")
 
+    @staticmethod
+    def _combine_redis_results(results, func):
+        """Combine the results of several redis calls.
+
+        `func` is called with the list of results.
+        """
+        raise NotImplementedError("Sub-classes of Manager should implement"
+                                  " ._combine_redis_results()")
+
     def _key(self, key):
         """
         Generate a key using this manager's key prefix
@@ -199,19 +311,25 @@ class Manager(object):
     def _unkeys(self, keys):
         return [self._unkey(k) for k in keys]
 
+    def _unscan(self, result):
+        cursor, keys = result
+        return int(cursor), self._unkeys(keys)
+
     # Global operations
 
     type = RedisCall(['key'])
     exists = RedisCall(['key'])
     keys = RedisCall(['pattern'], defaults=['*'], key_args=['pattern'],
                      filter_func='_unkeys')
+    scan = RedisCall(['cursor', 'match', 'count'], defaults=['*', None],
+                     key_args=['match'], filter_func='_unscan')
 
     # String operations
 
     get = RedisCall(['key'])
     set = RedisCall(['key', 'value'])
     setnx = RedisCall(['key', 'value'])
-    delete = RedisCall(['key'])
+    delete = RedisCall(['key'], vararg='keys', key_args=['key', 'keys'])
     setex = RedisCall(['key', 'seconds', 'value'])
 
     # Integer operations
@@ -255,6 +373,7 @@ class Manager(object):
         'withscores'], defaults=['-inf', '+inf', None, None, False])
     zscore = RedisCall(['key', 'value'])
     zcount = RedisCall(['key', 'min', 'max'])
+    zremrangebyscore = RedisCall(['key', 'min', 'max'])
 
     # List operations
 
@@ -262,7 +381,7 @@ class Manager(object):
     lpop = RedisCall(['key'])
     rpop = RedisCall(['key'])
     lpush = RedisCall(['key', 'obj'])
-    rpush = RedisCall(['key', 'obj'])
+    rpush = RedisCall(['key'], vararg='values')
     lrange = RedisCall(['key', 'start', 'end'])
     lrem = RedisCall(['key', 'value', 'num'], defaults=[0])
     rpoplpush = RedisCall(['source'], vararg='destination',
@@ -274,3 +393,236 @@ class Manager(object):
     expire = RedisCall(['key', 'seconds'])
     persist = RedisCall(['key'])
     ttl = RedisCall(['key'])
+
+
+class Pipeline(Manager):
+    """A batch of redis calls that are sent together.
+
+    Calls on a pipeline have the same key prefixing as the manager that
+    created it, but are queued instead of sent. They return the pipeline
+    itself so that they can be chained. :meth:`execute` sends all the queued
+    calls in a single round trip and returns a list of their results (after
+    any result filtering, such as removing key prefixes) in call order.
+
+    The underlying client must provide a redis-py style `pipeline()`.
+    """
+
+    def __init__(self, manager, transaction=False):
+        super(Pipeline, self).__init__(
+            manager._client, manager._key_prefix, manager._key_separator)
+        self._manager = manager
+        self._pipe = manager._client.pipeline(transaction=transaction)
+        self._filters = []
+
+    def __len__(self):
+        return len(self._filters)
+
+    def sub_manager(self, sub_prefix):
+        raise NotImplementedError("Pipelines do not support sub-managers.")
+
+    def pipeline(self, transaction=False):
+        raise NotImplementedError("Pipelines cannot be nested.")
+
+    def _make_redis_call(self, call, *args, **kw):
+        getattr(self._pipe, call)(*args, **kw)
+        self._filters.append(None)
+        return self
+
+    def _filter_redis_results(self, func, results):
+        self._filters[-1] = func
+        return results
+
+    def execute(self):
+        """Send all queued calls and return a list of their results.
+
+        This returns a deferred if the manager is asynchronous.
+        """
+        filters, self._filters = self._filters, []
+
+        def filter_results(results):
+            return [r if f is None else f(r)
+                    for f, r in zip(filters, results)]
+
+        return self._manager._filter_redis_results(
+            filter_results, self._pipe.execute())
+
+
+class HashRing(object):
+    """A consistent hash ring for assigning keys to nodes.
+
+    Each node is placed at several points on the ring and a key belongs to
+    the first node after the key's hash, so adding or removing a node only
+    moves the keys nearest to it.
+
+    :param list nodes:
+        Names of the nodes.
+    :param int replicas:
+        Number of points on the ring for each node.
+    """
+
+    def __init__(self, nodes, replicas=160):
+        ring = sorted((self.hash("%s-%d" % (node, i)), node)
+                      for node in nodes for i in range(replicas))
+        self._points = [point for point, _ in ring]
+        self._nodes = [node for _, node in ring]
+
+    @staticmethod
+    def hash(value):
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        return int(hashlib.md5(value).hexdigest()[:8], 16)
+
+    def get_node(self, key):
+        i = bisect(self._points, self.hash(key)) % len(self._points)
+        return self._nodes[i]
+
+
+class ShardedRedis(object):
+    """A redis client that distributes keys across several managers.
+
+    Keys are assigned to shards with a :class:`HashRing`. If a key contains
+    a hash tag (the part between the first `{` and the next `}`, if that
+    isn't empty) only the tag is hashed, so that keys with the same tag are
+    on the same shard. All the keys used by a command must be on the same
+    shard, except for DEL, which is split between shards, and KEYS, which
+    is sent to every shard.
+
+    :param manager_cls:
+        The :class:`Manager` subclass the shard managers belong to.
+    :param list shards:
+        List of `(name, manager)` pairs.
+    """
+
+    def __init__(self, manager_cls, shards):
+        self._redis_calls = manager_cls._redis_calls
+        self._combine = manager_cls._combine_redis_results
+        self._shards = shards
+        self._clients = dict((name, m._client) for name, m in shards)
+        self._ring = HashRing([name for name, _ in shards])
+
+    def __getattr__(self, name):
+        if name not in self._redis_calls:
+            raise AttributeError(name)
+        return lambda *args, **kw: self._call(name, args, kw)
+
+    @staticmethod
+    def hash_key(key):
+        """Return the part of `key` that is hashed to choose its shard."""
+        start = key.find('{')
+        if start != -1:
+            end = key.find('}', start + 1)
+            if end > start + 1:
+                return key[start + 1:end]
+        return key
+
+    def shard_for_key(self, key):
+        return self._ring.get_node(self.hash_key(key))
+
+    def _command_keys(self, call, args, kw):
+        redis_call = self._redis_calls[call]
+        arg_names = list(redis_call.args)
+        arg_names += [redis_call.vararg] * (len(args) - len(arg_names))
+        keys = [v for k, v in zip(arg_names, args)
+                if k in redis_call.key_args]
+        keys.extend(v for k, v in kw.iteritems() if k in redis_call.key_args)
+        return keys
+
+    def shard_for_command(self, call, args, kw):
+        if call in ('keys', 'scan'):
+            raise CrossShardError("%s uses every shard." % (call.upper(),))
+        shards = set(self.shard_for_key(key)
+                     for key in self._command_keys(call, args, kw))
+        if len(shards) != 1:
+            raise CrossShardError("%s keys %r are on different shards." % (
+                call.upper(), self._command_keys(call, args, kw)))
+        return shards.pop()
+
+    def _call(self, call, args, kw):
+        if call == 'keys':
+            results = [client.keys(*args, **kw)
+                       for client in self._clients.values()]
+            return self._combine(results, lambda r: list(chain(*r)))
+        if call == 'scan':
+            return self._scan(*args, **kw)
+        if call == 'delete' and len(args) > 1:
+            shard_keys = {}
+            for key in args:
+                shard_keys.setdefault(self.shard_for_key(key), []).append(key)
+            if len(shard_keys) > 1:
+                results = [self._clients[shard].delete(*keys)
+                           for shard, keys in shard_keys.iteritems()]
+                return self._combine(results, sum)
+        client = self._clients[self.shard_for_command(call, args, kw)]
+        return getattr(client, call)(*args, **kw)
+
+    def _scan(self, cursor, match=None, count=None):
+        """Scan each shard in turn.
+
+        The cursor we return encodes both the shard being scanned and that
+        shard's cursor, so that it's zero only once every shard is done.
+        """
+        names = sorted(self._clients)
+        shard_cursor, shard = divmod(int(cursor), len(names))
+        result = self._clients[names[shard]].scan(
+            shard_cursor, match=match, count=count)
+
+        def next_cursor(results):
+            [(new_shard_cursor, keys)] = results
+            new_shard_cursor = int(new_shard_cursor)
+            if new_shard_cursor != 0:
+                return [new_shard_cursor * len(names) + shard, keys]
+            if shard + 1 < len(names):
+                return [shard + 1, keys]
+            return [0, keys]
+
+        return self._combine([result], next_cursor)
+
+    def pipeline(self, transaction=True):
+        return ShardedPipeline(self, transaction)
+
+    def close(self):
+        """Close all the shard managers."""
+        return self._combine([m._close() for _, m in self._shards],
+                             lambda _: None)
+
+
+class ShardedPipeline(object):
+    """A pipeline for a :class:`ShardedRedis`.
+
+    Calls are queued on a pipeline for each shard and their results are put
+    back in call order when the pipeline is executed. A transaction may only
+    use keys on a single shard.
+    """
+
+    def __init__(self, redis, transaction=True):
+        self._redis = redis
+        self._transaction = transaction
+        self._pipes = {}
+        self._shard_order = []
+
+    def __getattr__(self, name):
+        def queue_call(*args, **kw):
+            shard = self._redis.shard_for_command(name, args, kw)
+            if shard not in self._pipes:
+                if self._transaction and self._pipes:
+                    raise CrossShardError(
+                        "Transactions may not span shards.")
+                self._pipes[shard] = self._redis._clients[shard].pipeline(
+                    transaction=self._transaction)
+            getattr(self._pipes[shard], name)(*args, **kw)
+            self._shard_order.append(shard)
+            return self
+        return queue_call
+
+    def execute(self):
+        pipes, self._pipes = self._pipes, {}
+        shard_order, self._shard_order = self._shard_order, []
+        shards = pipes.keys()
+
+        def reassemble(shard_results):
+            results = dict((shard, iter(r))
+                           for shard, r in zip(shards, shard_results))
+            return [results[shard].next() for shard in shard_order]
+
+        return self._redis._combine(
+            [pipes[shard].execute() for shard in shards], reassemble)
@@ -7,6 +7,25 @@ from vumi.persist.fake_redis import FakeRedis
 from vumi.utils import flatten_generator
 
 
+class VumiRedis(redis.Redis):
+    """Wrapper around redis.Redis that adds commands older versions lack.
+
+    It also takes SETEX arguments in the order Redis itself uses, which
+    :class:`vumi.persist.redis_base.Manager` relies on.
+    """
+
+    def setex(self, name, time, value):
+        return self.execute_command('SETEX', name, time, value)
+
+    def scan(self, cursor=0, match=None, count=None):
+        args = ['SCAN', cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        return self.execute_command(*args)
+
+
 class RedisManager(Manager):
 
     call_decorator = staticmethod(flatten_generator)
@@ -30,7 +49,25 @@ class RedisManager(Manager):
             Key prefix for namespacing.
         """
 
-        return cls(redis.Redis(**config), key_prefix, key_separator)
+        # These configure the connection pool shared by TxRedisManagers and
+        # don't apply here.
+        for option in ('pool_size', 'health_check_interval',
+                       'max_reconnect_delay'):
+            config.pop(option, None)
+        return cls(VumiRedis(**config), key_prefix, key_separator)
+
+    @classmethod
+    def _sharded_manager(cls, shard_configs, key_prefix, key_separator):
+        """Construct a manager that shards keys across several servers.
+
+        :param list shard_configs:
+            List of `(name, config)` pairs, one for each shard.
+        :param str key_prefix:
+            Key prefix for namespacing.
+        """
+        shards = [(name, cls.from_config(config))
+                  for name, config in shard_configs]
+        return cls._from_shard_managers(shards, key_prefix, key_separator)
 
     def _close(self):
         """Close redis connection."""
@@ -53,3 +90,9 @@ class RedisManager(Manager):
         """Filter results of a redis call.
         """
         return func(results)
+
+    @staticmethod
+    def _combine_redis_results(results, func):
+        """Combine the results of several redis calls.
+        """
+        return func(results)
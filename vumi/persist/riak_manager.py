@@ -24,6 +24,8 @@ class RiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': RiakHttpTransport,
@@ -53,7 +55,8 @@ class RiakManager(Manager):
         client.set_decoder('application/json', json.loads)
         client.set_decoder('text/json', json.loads)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency)
 
     def riak_object(self, modelcls, key, result=None):
         bucket = self.bucket_for_modelcls(modelcls)
@@ -108,6 +111,25 @@ class RiakManager(Manager):
             results = reducer_func(self, results)
         return results
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        transport = self.client.get_transport()
+        if not hasattr(transport, 'get_request'):
+            # Only the HTTP transport supports paginated index queries.
+            keys = transport.get_index(
+                self.bucket_name(model), index_name, start_value, end_value)
+            return self._index_page_from_response(
+                model, index_name, start_value, end_value, None,
+                {'keys': keys})
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        response = transport.get_request(uri, params)
+        transport.check_http_code(response, [200])
+        return self._index_page_from_response(
+            model, index_name, start_value, end_value, max_results,
+            json.loads(response[1]))
+
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
@@ -22,6 +22,31 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(True, 'delete', "delete_me")
         yield self.assert_redis_op(False, 'delete', "delete_me")
 
+    @inlineCallbacks
+    def test_delete_multiple(self):
+        yield self.redis.set("delete_me", 1)
+        yield self.redis.set("delete_me_too", 1)
+        yield self.assert_redis_op(2, 'delete', "delete_me", "delete_me_too",
+                                   "missing")
+        yield self.assert_redis_op(False, 'exists', "delete_me")
+
+    @inlineCallbacks
+    def test_rpush_multiple(self):
+        yield self.redis.rpush('list', 'a')
+        yield self.assert_redis_op(2, 'rpush', 'list', 'b', 'c')
+        yield self.assert_redis_op(['a', 'b', 'c'], 'lrange', 'list', 0, -1)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.redis.pipeline()
+        pipe.set('foo', 'bar').sadd('set', 'a', 'b')
+        pipe.get('foo')
+        results = yield pipe.execute()
+        self.assertEqual([None, 2, 'bar'], results)
+        yield self.assert_redis_op(set(['a', 'b']), 'smembers', 'set')
+        results = yield pipe.execute()
+        self.assertEqual([], results)
+
     @inlineCallbacks
     def test_incr(self):
         yield self.redis.set("inc", 1)
@@ -60,6 +85,12 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(False, 'setnx', "mykey", "other")
         yield self.assert_redis_op("value", 'get', "mykey")
 
+    @inlineCallbacks
+    def test_setex(self):
+        yield self.assert_redis_op(True, 'setex', "mykey", 10, "value")
+        yield self.assert_redis_op("value", 'get', "mykey")
+        yield self.assert_redis_op(9, 'ttl', "mykey")
+
     @inlineCallbacks
     def test_incr_with_by_param(self):
         yield self.redis.set("inc", 1)
@@ -119,6 +150,20 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(['one', 'two'],
             'zrangebyscore', 'set', '-inf', '0.2')
 
+    @inlineCallbacks
+    def test_zrangebyscore_negative_num(self):
+        yield self.redis.zadd('set', one=0.1, two=0.2, three=0.3)
+        yield self.assert_redis_op(['two', 'three'], 'zrangebyscore',
+            'set', '-inf', '+inf', 1, -1)
+
+    @inlineCallbacks
+    def test_zremrangebyscore(self):
+        yield self.redis.zadd('set', one=0.1, two=0.2, three=0.3, four=0.4)
+        yield self.assert_redis_op(2, 'zremrangebyscore',
+            'set', '-inf', '(0.3')
+        yield self.assert_redis_op(['three', 'four'], 'zrange', 'set', 0, -1)
+        yield self.assert_redis_op(0, 'zremrangebyscore', 'set', 0.5, 1)
+
     @inlineCallbacks
     def test_zcount(self):
         yield self.redis.zadd('set', one=0.1, two=0.2, three=0.3, four=0.4,
@@ -300,6 +345,20 @@ class FakeRedisTestCase(TestCase):
         yield self.assert_redis_op(0, 'persist', "tempval")
         yield self.assert_redis_op(1, 'expire', "tempval", 10)
 
+    @inlineCallbacks
+    def test_scan(self):
+        for i in range(5):
+            yield self.redis.set("key%d" % i, i)
+        yield self.redis.set("other", 1)
+        yield self.assert_redis_op(
+            [2, ["key0", "key1"]], 'scan', 0, match="key*", count=2)
+        yield self.assert_redis_op(
+            [4, ["key2", "key3"]], 'scan', 2, match="key*", count=2)
+        yield self.assert_redis_op(
+            [0, ["key4"]], 'scan', 4, match="key*", count=2)
+        yield self.assert_redis_op(
+            [0, ["key0", "key1", "key2", "key3", "key4", "other"]], 'scan', 0)
+
     @inlineCallbacks
     def test_type(self):
         yield self.assert_redis_op('none', 'type', 'unknown_key')
@@ -8,7 +8,8 @@ from twisted.trial.unittest import TestCase
 
 from vumi.persist.fields import (
     ValidationError, Field, Integer, Unicode, Tag, Timestamp, Json,
-    Dynamic, FieldWithSubtype, Boolean)
+    Dynamic, FieldWithSubtype, Boolean, VumiMessage)
+from vumi.message import TransportUserMessage
 
 
 class TestBaseField(TestCase):
@@ -142,6 +143,24 @@ class TestJson(TestCase):
         self.assertEqual(j.from_riak(d), d)
 
 
+class TestVumiMessage(TestCase):
+    def test_timestamp_from_json(self):
+        descriptor = VumiMessage(TransportUserMessage).get_descriptor("msg")
+        self.assertEqual(
+            descriptor._timestamp_from_json("2012-03-04 05:06:07.000089"),
+            datetime(2012, 3, 4, 5, 6, 7, 89))
+        self.assertEqual(
+            descriptor._timestamp_from_json("2012-03-04 05:06:07.5"),
+            datetime(2012, 3, 4, 5, 6, 7, 500000))
+
+    def test_timestamp_round_trip(self):
+        descriptor = VumiMessage(TransportUserMessage).get_descriptor("msg")
+        dt = datetime(2012, 3, 4, 5, 6, 7, 123456)
+        self.assertEqual(
+            descriptor._timestamp_from_json(descriptor._timestamp_to_json(dt)),
+            dt)
+
+
 class TestFieldWithSubtype(TestCase):
     def test_fails_on_fancy_subtype(self):
         self.assertRaises(RuntimeError, FieldWithSubtype, Dynamic())
@@ -4,7 +4,7 @@ from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks, returnValue
 
 from vumi.persist.model import (
-    Model, Manager, ModelMigrator, ModelMigrationError)
+    Model, Manager, ModelMigrator, ModelMigrationError, IndexPage)
 from vumi.persist.fields import (
     ValidationError, Integer, Unicode, VumiMessage, Dynamic, ListOf,
     ForeignKey, ManyToMany)
@@ -26,6 +26,11 @@ class VumiMessageModel(Model):
     msg = VumiMessage(TransportUserMessage)
 
 
+class NestedVumiMessageModel(Model):
+    msg = VumiMessage(TransportUserMessage, flatten=False)
+    group = Unicode(index=True, null=True)
+
+
 class DynamicModel(Model):
     a = Unicode()
     contact_info = Dynamic()
@@ -108,6 +113,51 @@ class UnknownVersionedModel(Model):
     d = Integer()
 
 
+class TestIndexPage(TestCase):
+
+    def setUp(self):
+        self.manager = Manager(None, 'test.')
+
+    def test_index_page_request(self):
+        uri, params = self.manager._index_page_request(
+            IndexedModel, 'a_bin', '1', None, 10, None)
+        self.assertEqual(uri, 'buckets/test.indexedmodel/index/a_bin/1')
+        self.assertEqual(params, {'max_results': 10})
+
+    def test_index_page_request_with_range_and_continuation(self):
+        uri, params = self.manager._index_page_request(
+            IndexedModel, 'b_bin', 'a b', 'c/d', 10, 'abc=')
+        self.assertEqual(
+            uri, 'buckets/test.indexedmodel/index/b_bin/a%20b/c%2Fd')
+        self.assertEqual(params, {'max_results': 10, 'continuation': 'abc='})
+
+    def test_index_page_request_unpaginated(self):
+        uri, params = self.manager._index_page_request(
+            IndexedModel, 'a_bin', '1', None, None, 'abc=')
+        self.assertEqual(params, None)
+
+    def test_next_page(self):
+        requests = []
+        self.manager.index_keys_page = lambda *args, **kw: requests.append(
+            (args, kw))
+        page = self.manager._index_page_from_response(
+            IndexedModel, 'a_bin', '1', None, 2,
+            {'keys': ['foo1', 'foo2'], 'continuation': 'abc='})
+        self.assertEqual(list(page), ['foo1', 'foo2'])
+        self.assertEqual(len(page), 2)
+        self.assertTrue(page.has_next_page())
+        page.next_page()
+        self.assertEqual(requests, [
+            ((IndexedModel, 'a_bin', '1', None),
+             {'max_results': 2, 'continuation': 'abc='})])
+
+    def test_last_page(self):
+        page = IndexPage(
+            self.manager, IndexedModel, 'a_bin', '1', None, 2, ['foo3'], None)
+        self.assertFalse(page.has_next_page())
+        self.assertEqual(page.next_page(), None)
+
+
 class TestModelOnTxRiak(TestCase):
 
     # TODO: all copies of mkmsg must be unified!
@@ -321,6 +371,33 @@ class TestModelOnTxRiak(TestCase):
             ["foo1", "foo2"], lookup, 'b', u"one")
         yield self.assert_mapreduce_results(["foo3"], lookup, 'b', None)
 
+    @Manager.calls_manager
+    def test_index_keys_page(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=1, b=u"one").save()
+        yield indexed_model("foo3", a=1, b=None).save()
+        yield indexed_model("foo4", a=2, b=None).save()
+
+        keys_page = yield indexed_model.index_keys_page('a', 1, max_results=2)
+        self.assertEqual(sorted(keys_page), ["foo1", "foo2"])
+        self.assertTrue(keys_page.has_next_page())
+
+        keys_page = yield keys_page.next_page()
+        self.assertEqual(list(keys_page), ["foo3"])
+        self.assertFalse(keys_page.has_next_page())
+        self.assertEqual((yield keys_page.next_page()), None)
+
+    @Manager.calls_manager
+    def test_index_keys_page_unpaginated(self):
+        indexed_model = self.manager.proxy(IndexedModel)
+        yield indexed_model("foo1", a=1, b=u"one").save()
+        yield indexed_model("foo2", a=2, b=u"one").save()
+
+        keys_page = yield indexed_model.index_keys_page('b', u"one")
+        self.assertEqual(sorted(keys_page), ["foo1", "foo2"])
+        self.assertFalse(keys_page.has_next_page())
+
     @Manager.calls_manager
     def test_index_match(self):
         indexed_model = self.manager.proxy(IndexedModel)
@@ -362,6 +439,35 @@ class TestModelOnTxRiak(TestCase):
         m1.msg = msg2
         self.assertTrue("extra" not in m1.msg)
 
+    @Manager.calls_manager
+    def test_vumimessage_field_nested(self):
+        msg_model = self.manager.proxy(NestedVumiMessageModel)
+        msg = self.mkmsg(extra="bar")
+        m1 = msg_model("foo", msg=msg)
+        yield m1.save()
+
+        m2 = yield msg_model.load("foo")
+        self.assertEqual(m1.msg, m2.msg)
+        self.assertEqual(m2.msg, msg)
+        self.assertEqual(m2._riak_object.get_data()["msg"]["extra"], "bar")
+
+        # test extra keys are removed
+        msg2 = self.mkmsg()
+        m1.msg = msg2
+        self.assertTrue("extra" not in m1.msg)
+
+    @Manager.calls_manager
+    def test_index_match_nested_key(self):
+        msg_model = self.manager.proxy(NestedVumiMessageModel)
+        yield msg_model(
+            "foo", msg=self.mkmsg(content=u"one two"), group=u"g").save()
+        yield msg_model(
+            "bar", msg=self.mkmsg(content=u"three"), group=u"g").save()
+
+        yield self.assert_mapreduce_results(["foo"], msg_model.index_match,
+            [{'key': 'msg.content', 'pattern': 'two', 'flags': ''}],
+            'group', u"g")
+
     def _create_dynamic_instance(self, dynamic_model):
         d1 = dynamic_model("foo", a=u"ab")
         d1.contact_info['cellphone'] = u"+27123"
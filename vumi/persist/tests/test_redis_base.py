@@ -1,8 +1,19 @@
 """Tests for vumi.persist.redis_base."""
 
+import inspect
+
 from twisted.trial.unittest import TestCase
 
-from vumi.persist.redis_base import Manager
+from vumi.persist.redis_base import (
+    Manager, HashRing, ShardedRedis, RedisCall, LazyCallMethod)
+
+
+class RecordingManager(Manager):
+    get = RedisCall(['key'])
+    mget = RedisCall([], vararg='keys', key_args=('keys',))
+
+    def _make_redis_call(self, call, *args, **kw):
+        return (call, args, kw)
 
 
 class ManagerTestCase(TestCase):
@@ -34,3 +45,62 @@ class ManagerTestCase(TestCase):
         self.assertEqual(sub_manager._key_prefix, "foo")
         self.assertEqual(sub_manager._client, manager._client)
         self.assertEqual(sub_manager._key_separator, manager._key_separator)
+
+    def test_redis_call_methods_built_lazily(self):
+        class LazyManager(RecordingManager):
+            set = RedisCall(['key', 'value'])
+
+        self.assertTrue(
+            isinstance(LazyManager.__dict__['set'], LazyCallMethod))
+        manager = LazyManager(object(), 'test')
+        self.assertEqual(manager.set('foo', 'bar'),
+                         ('set', ('test:foo', 'bar'), {}))
+        self.assertTrue(inspect.isfunction(LazyManager.__dict__['set']))
+        self.assertEqual(inspect.getargspec(LazyManager.set).args,
+                         ['self', 'key', 'value'])
+
+    def test_inherited_redis_call_methods(self):
+        class SubManager(RecordingManager):
+            pass
+
+        manager = SubManager(object(), 'test')
+        self.assertEqual(manager.get('foo'), ('get', ('test:foo',), {}))
+        self.assertFalse('get' in SubManager.__dict__)
+        self.assertTrue(inspect.isfunction(RecordingManager.__dict__['get']))
+        self.assertEqual(manager.mget('a', 'b'),
+                         ('mget', ('test:a', 'test:b'), {}))
+        self.assertEqual(SubManager._redis_calls['mget'],
+                         RecordingManager._redis_calls['mget'])
+
+
+class HashRingTestCase(TestCase):
+    def test_get_node(self):
+        ring = HashRing(['a', 'b', 'c'])
+        nodes = [ring.get_node('key%d' % i) for i in range(300)]
+        self.assertEqual(set(nodes), set(['a', 'b', 'c']))
+        self.assertEqual(nodes, [ring.get_node('key%d' % i)
+                                 for i in range(300)])
+
+    def test_get_node_unicode(self):
+        ring = HashRing(['a', 'b'])
+        self.assertEqual(ring.get_node(u'k\xe9y'),
+                         ring.get_node(u'k\xe9y'.encode('utf-8')))
+
+    def test_adding_node_moves_few_keys(self):
+        keys = ['key%d' % i for i in range(1000)]
+        ring = HashRing(['a', 'b', 'c'])
+        bigger_ring = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys
+                 if ring.get_node(key) != bigger_ring.get_node(key)]
+        self.assertTrue(len(moved) < 400)
+        self.assertEqual(
+            set(bigger_ring.get_node(key) for key in moved), set(['d']))
+
+
+class ShardedRedisTestCase(TestCase):
+    def test_hash_key(self):
+        self.assertEqual(ShardedRedis.hash_key('foo'), 'foo')
+        self.assertEqual(ShardedRedis.hash_key('a:{foo}:b'), 'foo')
+        self.assertEqual(ShardedRedis.hash_key('a:{foo}:{bar}'), 'foo')
+        self.assertEqual(ShardedRedis.hash_key('a:{}:{bar}'), 'a:{}:{bar}')
+        self.assertEqual(ShardedRedis.hash_key('a:{foo'), 'a:{foo')
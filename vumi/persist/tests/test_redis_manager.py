@@ -2,6 +2,7 @@
 
 from twisted.trial.unittest import TestCase
 
+from vumi.persist.redis_base import CrossShardError
 from vumi.tests.utils import import_skip
 
 
@@ -38,3 +39,123 @@ class RedisManagerTestCase(TestCase):
         self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], self.manager.keys())
         self.assertEqual('baz', self.manager.get('foo'))
+
+    def test_scan(self):
+        for i in range(5):
+            self.manager.set('key%d' % i, i)
+        self.manager.set('other', 1)
+        self.assertEqual(self.manager.scan(0, 'key*', 3),
+                         (3, ['key0', 'key1', 'key2']))
+        self.assertEqual(self.manager.scan(3, 'key*', 3),
+                         (0, ['key3', 'key4']))
+        self.assertEqual(self.manager.scan(0)[1], [
+            'key0', 'key1', 'key2', 'key3', 'key4', 'other'])
+
+    def test_pipeline(self):
+        self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.get('foo'), pipe)
+        pipe.sadd('set', 'a', 'b').keys('f*')
+        self.assertEqual(len(pipe), 3)
+        self.assertEqual(pipe.execute(), ['bar', 2, ['foo']])
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(['a', 'b'], sorted(self.manager.smembers('set')))
+
+    def test_multi(self):
+        pipe = self.manager.multi()
+        pipe.zadd('zset', a=1, b=2).zrange('zset', 0, -1)
+        self.assertEqual(pipe.execute(), [2, ['a', 'b']])
+
+
+class ShardedRedisManagerTestCase(TestCase):
+    def setUp(self):
+        try:
+            from vumi.persist.redis_manager import RedisManager
+        except ImportError, e:
+            import_skip(e, 'redis')
+
+        self.manager = RedisManager.from_config({
+            'key_prefix': 'redistest',
+            'shards': [{'FAKE_REDIS': 'yes'}, {'FAKE_REDIS': 'yes'},
+                       {'FAKE_REDIS': 'yes', 'name': 'named'}],
+        })
+        self.shards = dict((name, manager) for name, manager
+                           in self.manager._client._shards)
+
+    def tearDown(self):
+        self.manager._close()
+
+    def shard_keys(self):
+        return dict((name, sorted(manager.keys()))
+                    for name, manager in self.shards.items())
+
+    def test_shards(self):
+        self.assertEqual(sorted(self.shards), ['named', 'shard0', 'shard1'])
+
+    def test_keys_distributed(self):
+        for i in range(30):
+            self.manager.set('key%d' % i, i)
+        self.assertEqual(len(self.manager.keys()), 30)
+        shard_keys = self.shard_keys()
+        for name, keys in shard_keys.items():
+            self.assertTrue(keys, "No keys on %s" % (name,))
+            for key in keys:
+                self.assertTrue(key.startswith('redistest:key'))
+        self.assertEqual(self.manager.get('key7'), '7')
+
+    def test_hash_tags(self):
+        tag = self.manager.hash_tag('pool')
+        self.assertEqual(tag, '{pool}')
+        for i in range(10):
+            self.manager.sadd('%s:set%d' % (tag, i), 'a')
+        self.assertEqual(
+            sorted(len(keys) for keys in self.shard_keys().values()),
+            [0, 0, 10])
+        self.assertEqual(
+            self.manager.smove('%s:set0' % tag, '%s:set1' % tag, 'a'), True)
+        self.assertEqual(
+            self.manager.sunion('%s:set0' % tag, '%s:set1' % tag), set(['a']))
+
+    def test_cross_shard_command(self):
+        keys = ['key%d' % i for i in range(10)]
+        for key in keys:
+            self.manager.sadd(key, 'a')
+        self.assertRaises(CrossShardError, self.manager.sunion, *keys)
+
+    def test_scan_across_shards(self):
+        for i in range(30):
+            self.manager.set('key%d' % i, i)
+        keys, cursor = [], None
+        while cursor != 0:
+            cursor, page = self.manager.scan(cursor or 0, count=4)
+            keys.extend(page)
+        self.assertEqual(sorted(keys), sorted(self.manager.keys()))
+        self.assertEqual(len(keys), 30)
+
+    def test_delete_across_shards(self):
+        keys = ['key%d' % i for i in range(10)]
+        for key in keys:
+            self.manager.set(key, 'a')
+        self.assertEqual(self.manager.delete(*keys), 10)
+        self.assertEqual(self.manager.keys(), [])
+
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        for i in range(10):
+            pipe.set('key%d' % i, i)
+        for i in range(10):
+            pipe.get('key%d' % i)
+        self.assertEqual(pipe.execute(),
+                         [None] * 10 + [str(i) for i in range(10)])
+
+    def test_multi_across_shards(self):
+        pipe = self.manager.multi()
+        self.assertRaises(CrossShardError, lambda: [
+            pipe.set('key%d' % i, i) for i in range(10)])
+
+    def test_sub_manager(self):
+        sub_manager = self.manager.sub_manager('sub')
+        sub_manager.set('foo', 'bar')
+        self.assertEqual(self.manager.keys(), ['sub:foo'])
+        self.assertEqual(sub_manager.keys(), ['foo'])
+        self.assertEqual(sub_manager._close, self.manager._client.close)
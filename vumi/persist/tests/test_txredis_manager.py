@@ -2,8 +2,11 @@
 
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
 
-from vumi.persist.txredis_manager import TxRedisManager
+from vumi.persist.txredis_manager import (
+    TxRedisManager, VumiRedis, RedisConnectionPool, txr)
 
 
 class RedisManagerTestCase(TestCase):
@@ -37,3 +40,250 @@ class RedisManagerTestCase(TestCase):
         yield self.manager.set('foo', 'baz')
         self.assertEqual(['foo'], (yield self.manager.keys()))
         self.assertEqual('baz', (yield self.manager.get('foo')))
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        yield self.manager.set('foo', 'bar')
+        pipe = self.manager.pipeline()
+        self.assertEqual(pipe.get('foo'), pipe)
+        pipe.sadd('set', 'a', 'b').keys('f*')
+        self.assertEqual(len(pipe), 3)
+        results = yield pipe.execute()
+        self.assertEqual(results, ['bar', 2, ['foo']])
+        self.assertEqual(len(pipe), 0)
+        self.assertEqual(['a', 'b'],
+                         sorted((yield self.manager.smembers('set'))))
+
+    @inlineCallbacks
+    def test_multi(self):
+        pipe = self.manager.multi()
+        pipe.zadd('zset', a=1, b=2).zrange('zset', 0, -1)
+        results = yield pipe.execute()
+        self.assertEqual(results, [2, ['a', 'b']])
+
+    @inlineCallbacks
+    def test_empty_pipeline(self):
+        self.assertEqual([], (yield self.manager.pipeline().execute()))
+
+
+class VumiRedisTestCase(TestCase):
+    def setUp(self):
+        self.transport = StringTransport()
+        self.redis = VumiRedis()
+        self.redis.makeConnection(self.transport)
+
+    def encode(self, *args):
+        args = [str(arg) for arg in args]
+        return '*%d\r\n%s' % (len(args), ''.join(
+            '$%d\r\n%s\r\n' % (len(arg), arg) for arg in args))
+
+    def assert_sent(self, *commands):
+        self.assertEqual(self.transport.value(),
+                         ''.join(self.encode(*cmd) for cmd in commands))
+        self.transport.clear()
+
+    def test_zadd(self):
+        d = self.redis.zadd('zset', 'a', 1, 'b', 2)
+        self.assert_sent(['ZADD', 'zset', 1, 'a', 2, 'b'])
+        self.redis.dataReceived(':2\r\n')
+        self.assertEqual(self.successResultOf(d), 2)
+
+    def test_nested_multi_bulk_reply(self):
+        d = self.redis.send('EVAL')
+        self.redis.dataReceived(
+            '*3\r\n*2\r\n$1\r\na\r\n:1\r\n*-1\r\n*0\r\n')
+        self.assertEqual(self.successResultOf(d), [['a', 1], None, []])
+
+    def test_pipeline(self):
+        pipe = self.redis.pipeline(transaction=False)
+        pipe.set('foo', 'bar').hgetall('hash')
+        self.assert_sent()
+        d = pipe.execute()
+        self.assert_sent(['SET', 'foo', 'bar'], ['HGETALL', 'hash'])
+        self.redis.dataReceived('+OK\r\n*2\r\n$1\r\na\r\n$1\r\nb\r\n')
+        self.assertEqual(self.successResultOf(d), ['OK', {'a': 'b'}])
+
+    def test_pipeline_error(self):
+        pipe = self.redis.pipeline(transaction=False)
+        d = pipe.incr('foo').get('bar').execute()
+        self.redis.dataReceived('-ERR not an integer\r\n$3\r\nbaz\r\n')
+        self.failureResultOf(d).trap(txr.ResponseError)
+
+    def test_transaction(self):
+        pipe = self.redis.pipeline()
+        d = pipe.set('foo', 'bar').hgetall('hash').incr('baz').execute()
+        self.assert_sent(['MULTI'], ['SET', 'foo', 'bar'], ['HGETALL', 'hash'],
+                         ['INCR', 'baz'], ['EXEC'])
+        self.redis.dataReceived('+OK\r\n' + '+QUEUED\r\n' * 3)
+        self.assertNoResult(d)
+        self.redis.dataReceived(
+            '*3\r\n+OK\r\n*2\r\n$1\r\na\r\n$1\r\nb\r\n:1\r\n')
+        self.assertEqual(self.successResultOf(d), ['OK', {'a': 'b'}, 1])
+        # The connection is usable afterwards.
+        d = self.redis.get('foo')
+        self.redis.dataReceived('$3\r\nbar\r\n')
+        self.assertEqual(self.successResultOf(d), 'bar')
+
+    def test_transaction_command_error(self):
+        pipe = self.redis.pipeline()
+        d = pipe.incr('foo').get('bar').execute()
+        self.redis.dataReceived('+OK\r\n+QUEUED\r\n+QUEUED\r\n'
+                                '*2\r\n-ERR not an integer\r\n:1\r\n')
+        self.failureResultOf(d).trap(txr.ResponseError)
+
+    def test_transaction_aborted(self):
+        pipe = self.redis.pipeline()
+        d = pipe.get('foo').execute()
+        self.redis.dataReceived('+OK\r\n-ERR wrong number of arguments\r\n'
+                                '-EXECABORT Transaction discarded\r\n')
+        self.failureResultOf(d).trap(txr.ResponseError)
+
+    def test_transaction_queueing_error(self):
+        pipe = self.redis.pipeline()
+        d = pipe.set('foo', 'bar').zadd('zset', 'a').execute()
+        self.assert_sent(['MULTI'], ['SET', 'foo', 'bar'], ['DISCARD'])
+        self.redis.dataReceived('+OK\r\n+QUEUED\r\n+OK\r\n')
+        self.failureResultOf(d).trap(ValueError)
+
+
+class RedisConnectionPoolTestCase(TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.transports = []
+        self.patch(RedisConnectionPool, 'get_clock', lambda _: self.clock)
+        self.patch(RedisConnectionPool, 'connect',
+                   lambda pool, factory: self.connect(factory))
+
+    def tearDown(self):
+        for pool in RedisConnectionPool.pools.values():
+            pool.close()
+
+    def connect(self, factory):
+        transport = StringTransport()
+        factory.buildProtocol(None).makeConnection(transport)
+        self.transports.append(transport)
+
+    def get_manager(self, **config):
+        return TxRedisManager.from_config(config)
+
+    def get_pool(self, manager):
+        return manager._client._connection.pool
+
+    @inlineCallbacks
+    def test_shared_connection(self):
+        manager1 = yield self.get_manager(key_prefix='foo')
+        manager2 = yield self.get_manager(key_prefix='bar')
+        self.assertEqual(len(self.transports), 1)
+        self.assertTrue(
+            manager1._client._connection is manager2._client._connection)
+        self.assertEqual(self.get_pool(manager1).get_stats(), [
+            {'connected': True, 'clients': 2, 'outstanding': 0}])
+
+    @inlineCallbacks
+    def test_separate_pools_per_config(self):
+        manager1 = yield self.get_manager()
+        manager2 = yield self.get_manager(port=6380)
+        self.assertEqual(len(self.transports), 2)
+        self.assertNotEqual(self.get_pool(manager1), self.get_pool(manager2))
+
+    @inlineCallbacks
+    def test_pool_size(self):
+        managers = []
+        for _ in range(5):
+            managers.append((yield self.get_manager(pool_size=2)))
+        self.assertEqual(len(self.transports), 2)
+        pool = self.get_pool(managers[0])
+        self.assertEqual([c['clients'] for c in pool.get_stats()], [3, 2])
+
+    @inlineCallbacks
+    def test_outstanding_commands(self):
+        manager = yield self.get_manager()
+        d = manager.get('foo')
+        pool = self.get_pool(manager)
+        self.assertEqual(pool.get_stats()[0]['outstanding'], 1)
+        manager._client.dataReceived('$3\r\nbar\r\n')
+        self.assertEqual((yield d), 'bar')
+        self.assertEqual(pool.get_stats()[0]['outstanding'], 0)
+
+    @inlineCallbacks
+    def test_close(self):
+        manager1 = yield self.get_manager()
+        manager2 = yield self.get_manager()
+        pool = self.get_pool(manager1)
+        yield manager1._close()
+        yield manager1._close()
+        self.assertFalse(self.transports[0].disconnecting)
+        self.assertEqual(RedisConnectionPool.pools.values(), [pool])
+        yield manager2._close()
+        self.assertTrue(self.transports[0].disconnecting)
+        self.assertEqual(RedisConnectionPool.pools, {})
+
+    @inlineCallbacks
+    def test_reconnect(self):
+        manager = yield self.get_manager()
+        factory = manager._client._connection.factory
+        self.connect(factory)
+        manager.get('foo')
+        self.assertEqual(self.transports[0].value(), '')
+        self.assertEqual(self.transports[1].value(),
+                         '*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n')
+
+    @inlineCallbacks
+    def test_command_while_disconnected(self):
+        manager = yield self.get_manager()
+        factory = manager._client._connection.factory
+        factory.client.connectionLost(None)
+        factory.client = None
+        d = manager.get('foo')
+        self.failureResultOf(d).trap(txr.ConnectionError)
+        self.connect(factory)
+        manager.get('foo')
+        self.assertEqual(self.transports[1].value(),
+                         '*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n')
+
+    @inlineCallbacks
+    def test_health_check(self):
+        manager = yield self.get_manager(health_check_interval=5)
+        transport = self.transports[0]
+        self.clock.advance(5)
+        self.assertEqual(transport.value(), '*1\r\n$4\r\nPING\r\n')
+        transport.clear()
+        manager._client.dataReceived('+PONG\r\n')
+        self.clock.advance(5)
+        self.assertEqual(transport.value(), '*1\r\n$4\r\nPING\r\n')
+        self.assertFalse(transport.disconnecting)
+        self.clock.advance(5)
+        self.assertTrue(transport.disconnecting)
+
+
+class ShardedTxRedisManagerTestCase(TestCase):
+    @inlineCallbacks
+    def setUp(self):
+        self.manager = yield TxRedisManager.from_config({
+            'key_prefix': 'redistest',
+            'shards': [{'FAKE_REDIS': 'yes'}, {'FAKE_REDIS': 'yes'}],
+        })
+
+    def tearDown(self):
+        return self.manager._close()
+
+    @inlineCallbacks
+    def test_keys_distributed(self):
+        for i in range(20):
+            yield self.manager.set('key%d' % i, i)
+        self.assertEqual(len((yield self.manager.keys())), 20)
+        for name, manager in self.manager._client._shards:
+            self.assertTrue((yield manager.keys()))
+        self.assertEqual((yield self.manager.get('key7')), '7')
+        self.assertEqual((yield self.manager.delete(
+            *['key%d' % i for i in range(20)])), 20)
+
+    @inlineCallbacks
+    def test_pipeline(self):
+        pipe = self.manager.pipeline()
+        for i in range(10):
+            pipe.set('key%d' % i, i)
+        for i in range(10):
+            pipe.get('key%d' % i)
+        self.assertEqual((yield pipe.execute()),
+                         [None] * 10 + [str(i) for i in range(10)])
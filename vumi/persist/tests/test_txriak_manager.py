@@ -75,6 +75,13 @@ class CommonRiakManagerTests(object):
                                            })
         self.assertEqual(manager.mapreduce_timeout, 1000)
 
+    def test_from_config_with_load_bunch_concurrency(self):
+        manager_cls = self.manager.__class__
+        manager = manager_cls.from_config({'bucket_prefix': 'test.',
+                                           'load_bunch_concurrency': 8,
+                                           })
+        self.assertEqual(manager.load_bunch_concurrency, 8)
+
     def test_sub_manager(self):
         sub_manager = self.manager.sub_manager("foo.")
         self.assertEqual(sub_manager.client, self.manager.client)
@@ -149,6 +156,24 @@ class CommonRiakManagerTests(object):
         result_data.sort(key=lambda d: d["a"])
         self.assertEqual(result_data, [{"a": 0}, {"a": 1}, {"a": 2}])
 
+    def test_load_all_bunches_concurrency(self):
+        self.manager.load_bunch_size = 2
+        self.manager.load_bunch_concurrency = 2
+        started = []
+
+        def load_bunch(model, keys):
+            started.append(keys)
+            return keys
+
+        self.manager._load_bunch = load_bunch
+        bunches = self.manager.load_all_bunches(DummyModel, range(7))
+        self.assertEqual(bunches.next(), [0, 1])
+        self.assertEqual(started, [[0, 1], [2, 3]])
+        self.assertEqual(bunches.next(), [2, 3])
+        self.assertEqual(started, [[0, 1], [2, 3], [4, 5]])
+        self.assertEqual(list(bunches), [[4, 5], [6]])
+        self.assertEqual(started, [[0, 1], [2, 3], [4, 5], [6]])
+
     @Manager.calls_manager
     def test_run_riak_map_reduce(self):
         dummies = [self.mkdummy(str(i), {"a": i}) for i in range(4)]
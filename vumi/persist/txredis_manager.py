@@ -13,8 +13,11 @@ except ImportError:
 
 from twisted.internet import reactor
 from twisted.internet.defer import (
-    inlineCallbacks, DeferredList, succeed, Deferred)
+    inlineCallbacks, DeferredList, succeed, fail, Deferred)
+from twisted.internet.task import LoopingCall
+from twisted.python.failure import Failure
 
+from vumi import log
 from vumi.persist.redis_base import Manager
 from vumi.persist.fake_redis import FakeRedis
 
@@ -34,17 +37,168 @@ class VumiRedis(txr.Redis):
     def __init__(self, *args, **kw):
         super(VumiRedis, self).__init__(*args, **kw)
         self.connected_d = Deferred()
+        self._transaction_replies = None
+        self._multi_bulk_stack = []
 
     def connectionMade(self):
         d = super(VumiRedis, self).connectionMade()
         d.addCallback(lambda _: self)
         return d.chainDeferred(self.connected_d)
 
+    def dataReceived(self, data):
+        """Receive data.
+
+        This is txredis's parser, extended to handle nested multi-bulk
+        replies (such as EXEC returns) by keeping a stack of the enclosing
+        replies.
+        """
+        self.resetTimeout()
+        self._buffer = self._buffer + data
+
+        while self._buffer:
+            if self._bulk_length is not None:
+                if len(self._buffer) < self._bulk_length + 2:
+                    return
+                data = self._buffer[:self._bulk_length]
+                self._buffer = self._buffer[self._bulk_length + 2:]
+                self.bulkDataReceived(data)
+                continue
+
+            if '\r\n' not in self._buffer:
+                return
+            line, self._buffer = self._buffer.split('\r\n', 1)
+            if len(line) == 0:
+                continue
+
+            reply_type, reply_data = line[0], line[1:]
+            if reply_type == self.ERROR:
+                self.errorReceived(reply_data)
+            elif reply_type == self.INTEGER:
+                self.integerReceived(reply_data)
+            elif reply_type == self.SINGLE_LINE:
+                self.singleLineReceived(reply_data)
+            elif reply_type == self.BULK:
+                try:
+                    self._bulk_length = int(reply_data)
+                except ValueError:
+                    self.responseReceived(txr.InvalidResponse(
+                        "Cannot convert data '%s' to integer" % reply_data))
+                    return
+                if self._bulk_length == -1:
+                    self.bulkDataReceived(None)
+            elif reply_type == self.MULTI_BULK:
+                try:
+                    length = int(reply_data)
+                except ValueError:
+                    self.responseReceived(txr.InvalidResponse(
+                        "Cannot convert data '%s' to integer" % reply_data))
+                    return
+                if self._multi_bulk_length > 0:
+                    self._multi_bulk_stack.append(
+                        (self._multi_bulk_length, self._multi_bulk_reply))
+                    self._multi_bulk_reply = []
+                self._multi_bulk_length = length
+                if length == -1:
+                    self._multi_bulk_reply = None
+                    self.multiBulkDataReceived()
+                elif length == 0:
+                    self.multiBulkDataReceived()
+
+    def multiBulkDataReceived(self):
+        reply = self._multi_bulk_reply
+        if self._multi_bulk_stack:
+            self._multi_bulk_length, self._multi_bulk_reply = (
+                self._multi_bulk_stack.pop())
+            self.handleMultiBulkElement(reply)
+        else:
+            self._multi_bulk_reply = []
+            self._multi_bulk_length = None
+            self.handleCompleteMultiBulkData(reply)
+
+    def getResponse(self):
+        if self._transaction_replies is None:
+            return super(VumiRedis, self).getResponse()
+        # Inside MULTI the server replies to each command with QUEUED and
+        # the real replies arrive together in the EXEC reply. We hand out a
+        # separate deferred for the real reply so that any post-processing
+        # the command adds is applied to it rather than to QUEUED.
+        queued_d = super(VumiRedis, self).getResponse()
+        reply_d = Deferred()
+        self._transaction_replies.append((queued_d, reply_d))
+        return reply_d
+
+    def errorReceived(self, data):
+        # txredis doesn't expect errors inside multi-bulk replies, which EXEC
+        # can return, so we collect them as elements of the reply.
+        if self._multi_bulk_length > 0:
+            self.handleMultiBulkElement(txr.ResponseError(data))
+        else:
+            super(VumiRedis, self).errorReceived(data)
+
+    def pipeline(self, transaction=True):
+        return VumiRedisPipeline(self, transaction)
+
+    def execute_pipeline(self, commands):
+        """Send a list of `(method, args, kw)` commands without waiting for
+        replies and return a deferred that fires with a list of the results.
+        """
+        return gather_commands([method(*args, **kw)
+                                for method, args, kw in commands])
+
+    def execute_transaction(self, commands):
+        """Send a list of `(method, args, kw)` commands in a MULTI/EXEC block
+        and return a deferred that fires with a list of the results.
+        """
+        self._send('MULTI')
+        queued = [super(VumiRedis, self).getResponse()]
+        self._transaction_replies = replies = []
+        try:
+            for method, args, kw in commands:
+                method(*args, **kw)
+        except Exception:
+            failure = Failure()
+            self._transaction_replies = None
+            self._send('DISCARD')
+            queued.extend(queued_d for queued_d, _ in replies)
+            queued.append(self.getResponse())
+            d = DeferredList(queued, consumeErrors=True)
+            return d.addCallback(lambda _: failure)
+        self._transaction_replies = None
+        self._send('EXEC')
+        d = self.getResponse()
+        # Errors queueing a command also cause EXEC to fail, so we only need
+        # the EXEC reply and can ignore the QUEUED ones.
+        queued.extend(queued_d for queued_d, _ in replies)
+        DeferredList(queued, consumeErrors=True)
+
+        def deliver(results):
+            for (_, reply_d), result in zip(replies, results):
+                if isinstance(result, txr.ResponseError):
+                    reply_d.errback(result)
+                else:
+                    reply_d.callback(result)
+            return gather_commands([reply_d for _, reply_d in replies])
+        return d.addCallback(deliver)
+
     def hget(self, key, field):
         d = super(VumiRedis, self).hget(key, field)
         d.addCallback(lambda r: r.get(field) if r else None)
         return d
 
+    # txredis only supports a single key or value for these commands.
+
+    def delete(self, key, *keys):
+        self._send('DEL', key, *keys)
+        return self.getResponse()
+
+    def sadd(self, key, *values):
+        self._send('SADD', key, *values)
+        return self.getResponse()
+
+    def rpush(self, key, *values):
+        self._send('RPUSH', key, *values)
+        return self.getResponse()
+
     def lrem(self, key, value, num=0):
         return super(VumiRedis, self).lrem(key, value, count=num)
 
@@ -78,12 +232,20 @@ class VumiRedis(txr.Redis):
                                  "values and scores")
         pieces = zip(args[::2], args[1::2])
         pieces.extend(kwargs.iteritems())
-        orig_zadd = super(VumiRedis, self).zadd
-        deferreds = [orig_zadd(key, member, score) for member, score in pieces]
-        d = DeferredList(deferreds, fireOnOneErrback=True)
-        d.addCallback(lambda results: sum([result for success, result
-                                            in results if success]))
-        return d
+        command = ['ZADD', key]
+        for member, score in pieces:
+            command.extend([score, member])
+        self._send(*command)
+        return self.getResponse()
+
+    def scan(self, cursor, match=None, count=None):
+        args = ['SCAN', cursor]
+        if match is not None:
+            args.extend(['MATCH', match])
+        if count is not None:
+            args.extend(['COUNT', count])
+        self._send(*args)
+        return self.getResponse()
 
     def zrange(self, key, start, end, desc=False, withscores=False):
         return super(VumiRedis, self).zrange(key, start, end,
@@ -92,17 +254,264 @@ class VumiRedis(txr.Redis):
 
     def zrangebyscore(self, key, min, max, start=None, num=None,
                      withscores=False, score_cast_func=float):
-        d = super(VumiRedis, self).zrangebyscore(key, min, max,
-                        offset=start, count=num, withscores=withscores)
+        # txredis ignores the LIMIT clause when the offset is zero, so we
+        # build the command ourselves.
+        args = ['ZRANGEBYSCORE', key, min, max]
+        if start is not None and num is not None:
+            args.extend(['LIMIT', start, num])
+        if withscores:
+            args.append('WITHSCORES')
+        self._send(*args)
+        d = self.getResponse()
         if withscores:
-            d.addCallback(lambda r: [(v, score_cast_func(s)) for v, s in r])
+            d.addCallback(lambda r: [(v, score_cast_func(s))
+                                     for v, s in zip(r[::2], r[1::2])])
         return d
 
 
+def gather_commands(deferreds):
+    """Gather command results, failing with the first error (if any) once
+    all the commands have completed.
+    """
+    d = DeferredList(deferreds, consumeErrors=True)
+
+    def check_results(results):
+        for success, result in results:
+            if not success:
+                return result
+        return [result for _, result in results]
+    return d.addCallback(check_results)
+
+
+class VumiRedisPipeline(object):
+    """Queues commands for a :class:`VumiRedis` client and sends them
+    together when :meth:`execute` is called.
+    """
+
+    def __init__(self, client, transaction=True):
+        self._client = client
+        self._transaction = transaction
+        self._commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self._client, name)
+
+        def queue_command(*args, **kw):
+            self._commands.append((method, args, kw))
+            return self
+        return queue_command
+
+    def execute(self):
+        commands, self._commands = self._commands, []
+        if not commands:
+            return succeed([])
+        if self._transaction:
+            return self._client.execute_transaction(commands)
+        return self._client.execute_pipeline(commands)
+
+
 class VumiRedisClientFactory(txr.RedisClientFactory):
     protocol = VumiRedis
 
 
+class PooledRedisClient(object):
+    """A manager's handle on a connection in a :class:`RedisConnectionPool`.
+
+    Attribute access is passed through to the connection's current
+    :class:`VumiRedis` client, so the manager keeps working when the
+    connection is re-established. While the connection is down, commands
+    fail with :class:`ConnectionError` instead.
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self._released = False
+
+    def __getattr__(self, name):
+        if not self._connection.is_connected():
+            return self._not_connected
+        return getattr(self._connection.factory.client, name)
+
+    def _not_connected(self, *args, **kw):
+        return fail(txr.ConnectionError(
+            "Not connected to Redis, waiting to reconnect."))
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._connection.release()
+
+
+class RedisConnection(object):
+    """A reconnecting connection in a :class:`RedisConnectionPool`.
+    """
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.factory = VumiRedisClientFactory(**pool.client_config)
+        if pool.max_reconnect_delay is not None:
+            self.factory.maxDelay = pool.max_reconnect_delay
+        self.clients = 0
+        self._connected = False
+        self._waiting = []
+        self._ping_d = None
+        d = self.factory.deferred.addCallback(lambda r: r.connected_d)
+        d.addCallback(self._first_connected)
+        pool.connect(self.factory)
+
+    def _first_connected(self, _):
+        self._connected = True
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(self)
+
+    def wait_connected(self):
+        if self._connected:
+            return succeed(self)
+        d = Deferred()
+        self._waiting.append(d)
+        return d
+
+    def is_connected(self):
+        client = self.factory.client
+        return (client is not None and client.transport is not None
+                and not client._disconnected)
+
+    def outstanding(self):
+        """Return the number of commands awaiting a reply."""
+        client = self.factory.client
+        if client is None:
+            return 0
+        return len(client._request_queue)
+
+    def release(self):
+        self.clients -= 1
+        self.pool.release(self)
+
+    def check_health(self):
+        if not self.is_connected():
+            # The factory is already reconnecting.
+            return
+        client = self.factory.client
+        if self._ping_d is not None:
+            log.warning("Redis connection to %s:%s is not responding,"
+                        " reconnecting." % (self.pool.host, self.pool.port))
+            client.transport.loseConnection()
+            return
+        self._ping_d = client.ping()
+        self._ping_d.addBoth(self._ping_done)
+
+    def _ping_done(self, _):
+        self._ping_d = None
+
+    def close(self):
+        self.factory.stopTrying()
+        if self.is_connected():
+            self.factory.client.transport.loseConnection()
+
+
+class RedisConnectionPool(object):
+    """A pool of connections to a Redis server, shared by all the
+    :class:`TxRedisManager` instances in a process that have the same config.
+
+    Each manager is assigned to one connection for its lifetime, so that its
+    commands are processed in the order they are sent, and is given the
+    connection serving the fewest managers. Connections are opened as needed
+    up to the pool size and closed once all their managers are closed.
+    Dropped connections are re-established with exponential back-off.
+
+    :param int pool_size:
+        Maximum number of connections. Default is 1.
+    :param float health_check_interval:
+        Seconds between PINGs of each connection. A connection that hasn't
+        answered the previous PING is dropped and re-established. Default is
+        None (no health checks).
+    :param float max_reconnect_delay:
+        Maximum number of seconds between attempts to reconnect. Default is
+        None (Twisted's default of an hour).
+
+    Other parameters are passed to :class:`VumiRedis`.
+    """
+
+    # (host, port, config) -> pool
+    pools = {}
+
+    def __init__(self, host, port, pool_size=1, health_check_interval=None,
+                 max_reconnect_delay=None, **client_config):
+        self.host = host
+        self.port = port
+        self.pool_size = pool_size
+        self.max_reconnect_delay = max_reconnect_delay
+        self.client_config = client_config
+        self.connections = []
+        self.clock = self.get_clock()
+        self._health_check = None
+        if health_check_interval:
+            self._health_check = LoopingCall(self.check_health)
+            self._health_check.clock = self.clock
+            self._health_check.start(health_check_interval, now=False)
+
+    @classmethod
+    def get_pool(cls, host, port, config):
+        """Return the pool for the given server and config, creating it if
+        necessary.
+        """
+        key = (host, port, tuple(sorted(config.items())))
+        pool = cls.pools.get(key)
+        if pool is None:
+            pool = cls(host, port, **config)
+            pool._pool_key = key
+            cls.pools[key] = pool
+        return pool
+
+    def get_clock(self):
+        return reactor
+
+    def connect(self, factory):
+        return reactor.connectTCP(self.host, self.port, factory)
+
+    def get_client(self):
+        """Return a deferred that fires with a :class:`PooledRedisClient`
+        once its connection is established.
+        """
+        if len(self.connections) < self.pool_size:
+            connection = RedisConnection(self)
+            self.connections.append(connection)
+        else:
+            connection = min(self.connections, key=lambda c: (
+                c.clients, c.outstanding()))
+        connection.clients += 1
+        return connection.wait_connected().addCallback(PooledRedisClient)
+
+    def release(self, connection):
+        if sum(c.clients for c in self.connections) == 0:
+            self.close()
+
+    def check_health(self):
+        for connection in self.connections:
+            connection.check_health()
+
+    def close(self):
+        if self._health_check is not None and self._health_check.running:
+            self._health_check.stop()
+        for connection in self.connections:
+            connection.close()
+        self.connections = []
+        if self.pools.get(self._pool_key) is self:
+            del self.pools[self._pool_key]
+
+    def get_stats(self):
+        """Return a list of dicts describing each connection, with the
+        number of managers using it and the number of commands awaiting a
+        reply.
+        """
+        return [{
+            'connected': connection.is_connected(),
+            'clients': connection.clients,
+            'outstanding': connection.outstanding(),
+        } for connection in self.connections]
+
+
 class TxRedisManager(Manager):
 
     call_decorator = staticmethod(inlineCallbacks)
@@ -129,17 +538,31 @@ class TxRedisManager(Manager):
         host = config.pop('host', 'localhost')
         port = config.pop('port', 6379)
 
-        factory = VumiRedisClientFactory(**config)
-        d = factory.deferred.addCallback(lambda r: r.connected_d)
-        reactor.connectTCP(host, port, factory)
+        pool = RedisConnectionPool.get_pool(host, port, config)
+        d = pool.get_client()
         return d.addCallback(lambda r: cls(r, key_prefix, key_separator))
 
-    @inlineCallbacks
+    @classmethod
+    def _sharded_manager(cls, shard_configs, key_prefix, key_separator):
+        """Construct a manager that shards keys across several servers.
+
+        :param list shard_configs:
+            List of `(name, config)` pairs, one for each shard.
+        :param str key_prefix:
+            Key prefix for namespacing.
+        """
+        names = [name for name, _ in shard_configs]
+        d = gather_commands([cls.from_config(config)
+                             for _, config in shard_configs])
+        return d.addCallback(lambda managers: cls._from_shard_managers(
+            zip(names, managers), key_prefix, key_separator))
+
     def _close(self):
-        """Close redis connection."""
-        yield self._client.factory.stopTrying()
-        if self._client.transport is not None:
-            yield self._client.transport.loseConnection()
+        """Release this manager's pooled redis connection.
+
+        The connection is closed once no managers are using it.
+        """
+        return succeed(self._client.release())
 
     @inlineCallbacks
     def _purge_all(self):
@@ -161,3 +584,11 @@ class TxRedisManager(Manager):
         """Filter results of a redis call.
         """
         return results.addCallback(func)
+
+    @staticmethod
+    def _combine_redis_results(results, func):
+        """Combine the results of several redis calls.
+        """
+        d = gather_commands([result if isinstance(result, Deferred)
+                             else succeed(result) for result in results])
+        return d.addCallback(func)
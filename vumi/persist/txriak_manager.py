@@ -2,6 +2,8 @@
 
 """A manager implementation on top of txriak."""
 
+import json
+
 from riakasaurus.riak import RiakClient, RiakObject, RiakMapReduce
 from riakasaurus import transport
 from twisted.internet.defer import (
@@ -15,6 +17,9 @@ class TxRiakManager(Manager):
 
     call_decorator = staticmethod(inlineCallbacks)
 
+    # Bunches are loaded by map-reduce jobs that Riak runs in parallel.
+    DEFAULT_LOAD_BUNCH_CONCURRENCY = 4
+
     @classmethod
     def from_config(cls, config):
         config = config.copy()
@@ -23,6 +28,8 @@ class TxRiakManager(Manager):
                                      cls.DEFAULT_LOAD_BUNCH_SIZE)
         mapreduce_timeout = config.pop('mapreduce_timeout',
                                        cls.DEFAULT_MAPREDUCE_TIMEOUT)
+        load_bunch_concurrency = config.pop(
+            'load_bunch_concurrency', cls.DEFAULT_LOAD_BUNCH_CONCURRENCY)
         transport_type = config.pop('transport_type', 'http')
         transport_class = {
             'http': transport.HTTPTransport,
@@ -41,7 +48,8 @@ class TxRiakManager(Manager):
             mapred_prefix=mapred_prefix, client_id=client_id,
             transport=transport_class)
         return cls(client, bucket_prefix, load_bunch_size=load_bunch_size,
-                   mapreduce_timeout=mapreduce_timeout)
+                   mapreduce_timeout=mapreduce_timeout,
+                   load_bunch_concurrency=load_bunch_concurrency)
 
     def _encode_indexes(self, iterable, encoding='utf-8'):
         """
@@ -122,6 +130,29 @@ class TxRiakManager(Manager):
     def riak_map_reduce(self):
         return RiakMapReduce(self.client)
 
+    def index_keys_page(self, model, index_name, start_value, end_value=None,
+                        max_results=None, continuation=None):
+        transport = self.client.get_transport()
+        if not hasattr(transport, 'get_request'):
+            # Only the HTTP transport supports paginated index queries.
+            d = transport.get_index(
+                self.bucket_name(model), index_name, start_value, end_value)
+            return d.addCallback(
+                lambda keys: self._index_page_from_response(
+                    model, index_name, start_value, end_value, None,
+                    {'keys': keys}))
+
+        def build_page(response):
+            transport.check_http_code(response, [200])
+            return self._index_page_from_response(
+                model, index_name, start_value, end_value, max_results,
+                json.loads(response[1]))
+
+        uri, params = self._index_page_request(
+            model, index_name, start_value, end_value, max_results,
+            continuation)
+        return transport.get_request(uri, params).addCallback(build_page)
+
     def riak_enable_search(self, modelcls):
         bucket_name = self.bucket_name(modelcls)
         bucket = self.client.bucket(bucket_name)
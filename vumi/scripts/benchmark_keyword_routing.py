@@ -0,0 +1,105 @@
+# -*- test-case-name: vumi.scripts.tests.test_benchmark_keyword_routing -*-
+import sys
+import time
+import random
+
+from twisted.python import usage
+
+from vumi.dispatchers.base import KeywordRoutingTable
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["rules", "r", "10000", "Number of keyword routing rules."],
+        ["messages", "m", "10000", "Number of messages to route."],
+        ["to-addrs", "t", "10", "Number of distinct rule to_addrs."],
+    ]
+
+    longdesc = """Benchmarks matching messages against
+                  vumi.dispatchers.base.ContentKeywordRouter rules, using a
+                  linear scan of the rules and using a KeywordRoutingTable."""
+
+
+class KeywordRoutingBenchmark(object):
+    """
+    Generates a set of keyword rules, some with `to_addr` and `prefix`
+    conditions, and a set of messages that mostly match one of them, and
+    reports how quickly each approach routes the messages.
+    """
+
+    def __init__(self, options):
+        self.num_rules = int(options['rules'])
+        self.num_messages = int(options['messages'])
+        self.num_to_addrs = int(options['to-addrs'])
+        self.random = random.Random(0)
+
+    def emit(self, s):
+        print s
+
+    def make_rules(self):
+        rules = []
+        for i in xrange(self.num_rules):
+            rule = {'app': 'app%d' % (i % 10,), 'keyword': 'keyword%d' % i}
+            if i % 2:
+                rule['to_addr'] = str(8000 + i % self.num_to_addrs)
+            if i % 3:
+                rule['prefix'] = '+27%d' % (i % 10,)
+            rules.append(rule)
+        return rules
+
+    def make_messages(self):
+        messages = []
+        for _ in xrange(self.num_messages):
+            keyword = 'keyword%d' % self.random.randrange(
+                int(self.num_rules * 1.1))
+            to_addr = str(8000 + self.random.randrange(self.num_to_addrs))
+            from_addr = '+27%09d' % self.random.randrange(10 ** 9)
+            messages.append({'keyword': keyword, 'to_addr': to_addr,
+                             'from_addr': from_addr})
+        return messages
+
+    def linear_match(self, rules, msg):
+        # See ContentKeywordRouter.is_msg_matching_routing_rules.
+        return [rule for rule in rules
+                if msg['keyword'] == rule['keyword'] and
+                ('to_addr' not in rule or
+                 msg['to_addr'] == rule['to_addr']) and
+                ('prefix' not in rule or
+                 msg['from_addr'].startswith(rule['prefix']))]
+
+    def timed(self, name, func, messages):
+        start = time.time()
+        matched = 0
+        for msg in messages:
+            matched += len(func(msg))
+        elapsed = max(time.time() - start, 1e-6)
+        self.emit("%s: %d in %.2f seconds (%.2f/s)" % (
+            name, len(messages), elapsed, len(messages) / elapsed))
+        return matched
+
+    def run(self):
+        rules = self.make_rules()
+        messages = self.make_messages()
+        start = time.time()
+        table = KeywordRoutingTable(rules)
+        self.emit("Index %d rules: %.2f seconds" % (
+            len(rules), time.time() - start))
+        indexed = self.timed("Indexed", lambda msg: table.match(
+            msg['keyword'], msg['to_addr'], msg['from_addr']), messages)
+        linear = self.timed("Linear", lambda msg: self.linear_match(
+            rules, msg), messages)
+        if indexed != linear:
+            raise RuntimeError("Indexed rules matched %d times, linear scan"
+                               " matched %d times." % (indexed, linear))
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    KeywordRoutingBenchmark(options).run()
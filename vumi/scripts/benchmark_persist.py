@@ -19,10 +19,20 @@ class Options(usage.Options):
          "Number of messages to read and write concurrently"],
     ]
 
+    optFlags = [
+        ["flatten", "f",
+         "Store each message payload key as a separate field, as unversioned"
+         " message store models do."],
+    ]
+
     longdesc = """Benchmarks vumi.persist.model.Model"""
 
 
 class MessageModel(Model):
+    msg = VumiMessage(TransportUserMessage, flatten=False)
+
+
+class FlattenedMessageModel(Model):
     msg = VumiMessage(TransportUserMessage)
 
 
@@ -34,6 +44,8 @@ class WriteReadBenchmark(object):
     def __init__(self, options):
         self.messages = int(options['messages'])
         self.concurrent = int(options['concurrent-messages'])
+        self.model_cls = (
+            FlattenedMessageModel if options['flatten'] else MessageModel)
 
     def make_batches(self):
         num_batches, rem = divmod(self.messages, self.concurrent)
@@ -67,7 +79,7 @@ class WriteReadBenchmark(object):
     @inlineCallbacks
     def run(self):
         manager = TxRiakManager.from_config({'bucket_prefix': 'test.bench.'})
-        model = manager.proxy(MessageModel)
+        model = manager.proxy(self.model_cls)
         yield manager.purge_all()
 
         msg_batches = self.make_batches()
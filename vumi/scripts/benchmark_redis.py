@@ -0,0 +1,144 @@
+# -*- test-case-name: vumi.scripts.tests.test_benchmark_redis -*-
+import sys
+import time
+
+import yaml
+from twisted.python import usage
+
+from vumi.persist.redis_manager import RedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["config", "c", None,
+         "A config file with a redis_manager setting."],
+        ["count", "n", "1000",
+         "Number of times to perform each operation."],
+        ["prefix", "p", "benchmark_redis",
+         "Key prefix to use. Keys with this prefix are deleted afterwards."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-memory fake Redis."],
+    ]
+
+    longdesc = """Benchmarks common Redis operations performed by vumi
+                  components, with and without pipelining."""
+
+
+class RedisBenchmark(object):
+    """
+    Performs a set of operations modelled on those made by vumi components,
+    first with one round trip per command and then pipelined, reporting the
+    throughput of each.
+    """
+
+    def __init__(self, options):
+        self.count = int(options['count'])
+        config = {}
+        if options['config'] is not None:
+            config = yaml.safe_load(open(options['config'], "rb"))
+        redis_config = config.get('redis_manager', {})
+        if options['fake-redis']:
+            redis_config = {'FAKE_REDIS': True}
+        self.redis = RedisManager.from_config(redis_config).sub_manager(
+            options['prefix'])
+
+    def emit(self, s):
+        print s
+
+    def used_memory(self):
+        """
+        Return the memory used by Redis in bytes, or None if the backend
+        doesn't report it (e.g. fake Redis).
+        """
+        info = getattr(getattr(self.redis, '_client', None), 'info', None)
+        if info is None:
+            return None
+        return info()['used_memory']
+
+    def timed(self, name, func):
+        memory_before = self.used_memory()
+        start = time.time()
+        for i in xrange(self.count):
+            func(i)
+        elapsed = max(time.time() - start, 1e-6)
+        memory_after = self.used_memory()
+        memory = ""
+        if memory_before is not None and memory_after is not None:
+            memory = ", %.1f bytes each" % (
+                float(memory_after - memory_before) / self.count,)
+        self.emit("%s: %d in %.2f seconds (%.2f/s%s)" % (
+            name, self.count, elapsed, self.count / elapsed, memory))
+
+    def save_session(self, redis, i):
+        # See vumi.components.session.SessionManager.
+        key = "session:%d" % (i,)
+        redis.hmset(key, {'created_at': time.time(), 'state': 'menu'})
+        redis.expire(key, 600)
+        redis.zadd("session_index", **{str(i): time.time() + 600})
+
+    def store_reason(self, redis, i):
+        # See vumi.components.tagpool.TagpoolManager.
+        redis.hset("tagpools:pool:reason:hash", "tag%d" % (i,), '{}')
+        redis.sadd("tagpools:unowned:tags", '["pool", "tag%d"]' % (i,))
+
+    def count_message(self, redis, i):
+        # See vumi.components.message_store.MessageStore.
+        redis.hincrby("batch:counts", "inbound")
+        redis.hincrby("batch:counts", "outbound")
+        redis.zadd("batch:timestamps", **{"msg%d" % (i,): time.time()})
+
+    def store_return_route(self, redis, i):
+        # See vumi.dispatchers.base.ContentKeywordRouter.
+        key = "message:route%d" % (i,)
+        redis.set(key, "app")
+        redis.expire(key, 604800)
+
+    def store_return_route_session(self, redis, i):
+        # Return routes as previously stored by ContentKeywordRouter.
+        user_id = "message:session-route%d" % (i,)
+        key = "session:%s" % (user_id,)
+        redis.hmset(key, {'created_at': time.time(), 'name': 'app'})
+        redis.expire(key, 604800)
+        redis.zadd("session_index", **{user_id: time.time() + 604800})
+
+    def sequential(self, operation):
+        return lambda i: operation(self.redis, i)
+
+    def pipelined(self, operation):
+        def run(i):
+            pipe = self.redis.pipeline()
+            operation(pipe, i)
+            pipe.execute()
+        return run
+
+    def run(self):
+        if self.redis.keys():
+            raise RuntimeError("Keys with prefix %s exist, refusing to"
+                               " benchmark." % (self.redis.get_key_prefix(),))
+        try:
+            for name, operation in [
+                    ("Save session", self.save_session),
+                    ("Store tag reason", self.store_reason),
+                    ("Count message", self.count_message),
+                    ("Store return route", self.store_return_route),
+                    ("Store return route (session)",
+                     self.store_return_route_session)]:
+                self.timed(name, self.sequential(operation))
+                self.timed("%s (pipelined)" % (name,),
+                           self.pipelined(operation))
+        finally:
+            self.redis._purge_all()
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    RedisBenchmark(options).run()
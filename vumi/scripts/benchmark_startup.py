@@ -0,0 +1,133 @@
+# -*- test-case-name: vumi.scripts.tests.test_benchmark_startup -*-
+import os
+import sys
+import time
+import subprocess
+
+from twisted.python import usage
+from twisted.internet import reactor
+from twisted.internet.defer import (
+    Deferred, maybeDeferred, inlineCallbacks, returnValue)
+
+from vumi.servicemaker import VumiOptions, read_yaml_config
+from vumi.service import AmqpFactory, SPECS, get_spec
+from vumi.utils import load_class_by_string, vumi_resource_path
+
+
+class Options(VumiOptions):
+    optParameters = [
+        ["worker-class", "w", None, "Class of the worker to start."],
+        ["config", "c", None, "YAML config file for the worker."],
+    ]
+
+    optFlags = [
+        ["fake-amqp", None,
+         "Use an in-memory fake AMQP broker rather than connecting to one."],
+    ]
+
+    longdesc = """Reports how long each stage of starting a vumi worker
+                  takes: importing its module in a new Python process,
+                  loading the AMQP spec, connecting to the AMQP broker and
+                  running the worker's startWorker."""
+
+    def postOptions(self):
+        VumiOptions.postOptions(self)
+        if self['worker-class'] is None:
+            raise usage.UsageError("Please specify a worker class.")
+
+
+class ConnectingAmqpFactory(AmqpFactory):
+    """
+    An AmqpFactory that hands over its connection instead of starting the
+    worker when it's connected.
+    """
+
+    def __init__(self, worker):
+        AmqpFactory.__init__(self, worker)
+        self.connected = Deferred()
+
+    def amqp_connected(self, amqp_client):
+        self.connected.callback(amqp_client)
+
+
+class StartupBenchmark(object):
+    def __init__(self, options):
+        self.options = options
+        self.vumi_options = options.vumi_options
+        self.worker_class_name = options['worker-class']
+        self.config = read_yaml_config(options['config'])
+        self.fake_amqp = options['fake-amqp']
+
+    def emit(self, s):
+        print s
+
+    def report(self, name, start):
+        self.emit("%s: %.3f seconds" % (name, time.time() - start))
+
+    def time_import(self):
+        module_name = self.worker_class_name.rpartition('.')[0]
+        code = ("import time; start = time.time(); import %s;"
+                " print time.time() - start" % (module_name,))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        elapsed = subprocess.check_output(
+            [sys.executable, '-c', code], env=env).strip().split()[-1]
+        self.emit("Import %s: %.3f seconds" % (module_name, float(elapsed)))
+
+    def time_spec_load(self):
+        specfile = vumi_resource_path(self.vumi_options['specfile'])
+        SPECS.pop(specfile, None)
+        start = time.time()
+        get_spec(specfile)
+        self.report("Load AMQP spec", start)
+
+    @inlineCallbacks
+    def connect(self, worker):
+        if self.fake_amqp:
+            from vumi.tests.utils import get_fake_amq_client
+            returnValue(get_fake_amq_client())
+        start = time.time()
+        factory = ConnectingAmqpFactory(worker)
+        reactor.connectTCP(self.vumi_options['hostname'],
+                           self.vumi_options['port'], factory)
+        amqp_client = yield factory.connected
+        factory.stopTrying()
+        self.report("AMQP connect", start)
+        returnValue(amqp_client)
+
+    @inlineCallbacks
+    def run(self):
+        self.time_import()
+        self.time_spec_load()
+        worker_class = load_class_by_string(self.worker_class_name)
+        worker = worker_class(self.vumi_options, self.config)
+        amqp_client = yield self.connect(worker)
+        start = time.time()
+        worker.startService()
+        yield worker._amqp_connected(amqp_client)
+        self.report("Start worker", start)
+        yield worker.stopService()
+        if amqp_client.transport is not None:
+            amqp_client.transport.loseConnection()
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    bench = StartupBenchmark(options)
+
+    def _eb(f):
+        f.printTraceback()
+
+    def _main():
+        d = maybeDeferred(bench.run)
+        d.addErrback(_eb)
+        d.addBoth(lambda _: reactor.stop())
+
+    reactor.callLater(0, _main)
+    reactor.run()
@@ -0,0 +1,101 @@
+# -*- test-case-name: vumi.scripts.tests.test_benchmark_tagpools -*-
+import sys
+import time
+
+import yaml
+from twisted.python import usage
+
+from vumi.components import TagpoolManager
+from vumi.persist.redis_manager import RedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["config", "c", None,
+         "A config file with redis_manager and tagpool_prefix settings, as"
+         " used by vumi_tagpools."],
+        ["tags", "t", "10000",
+         "Number of tags to declare in the benchmark pool."],
+        ["pool", "p", "benchmark_pool",
+         "Name of the tag pool to create. It is purged afterwards."],
+    ]
+
+    optFlags = [
+        ["fake-redis", None, "Use an in-memory fake Redis."],
+    ]
+
+    longdesc = """Benchmarks vumi.components.tagpool.TagpoolManager"""
+
+
+class TagpoolBenchmark(object):
+    """
+    Declares a pool of tags, acquires and releases them all and then purges
+    the pool, reporting the throughput of each step.
+    """
+
+    def __init__(self, options):
+        self.num_tags = int(options['tags'])
+        self.pool = options['pool']
+        config = {}
+        if options['config'] is not None:
+            config = yaml.safe_load(open(options['config'], "rb"))
+        redis_config = config.get('redis_manager', {})
+        if options['fake-redis']:
+            redis_config = {'FAKE_REDIS': True}
+        self.redis = RedisManager.from_config(redis_config)
+        self.tagpool = TagpoolManager(self.redis.sub_manager(
+                config.get('tagpool_prefix', 'vumi')))
+
+    def emit(self, s):
+        print s
+
+    def timed(self, name, count, func, *args):
+        start = time.time()
+        result = func(*args)
+        elapsed = max(time.time() - start, 1e-6)
+        self.emit("%s: %d in %.2f seconds (%.2f/s)" % (
+            name, count, elapsed, count / elapsed))
+        return result
+
+    def acquire_all(self):
+        tags = []
+        for _ in xrange(self.num_tags):
+            tags.append(self.tagpool.acquire_tag(self.pool))
+        return tags
+
+    def acquire_specific(self, tags):
+        for tag in tags:
+            self.tagpool.acquire_specific_tag(tag)
+
+    def release_all(self, tags):
+        for tag in tags:
+            self.tagpool.release_tag(tag)
+
+    def run(self):
+        tags = [(self.pool, u"tag%d" % i) for i in xrange(self.num_tags)]
+        if self.tagpool.inuse_tags(self.pool):
+            raise RuntimeError("Pool %s has tags in use, refusing to"
+                               " benchmark it." % (self.pool,))
+        self.tagpool.purge_pool(self.pool)
+
+        self.timed("Declare tags", len(tags), self.tagpool.declare_tags, tags)
+        acquired = self.timed("Acquire tags", len(tags), self.acquire_all)
+        if None in acquired:
+            raise RuntimeError("Failed to acquire all declared tags.")
+        self.timed("Release tags", len(tags), self.release_all, acquired)
+        self.timed("Acquire specific tags", len(tags),
+                   self.acquire_specific, tags)
+        self.timed("Release tags", len(tags), self.release_all, tags)
+        self.timed("Purge pool", 1, self.tagpool.purge_pool, self.pool)
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    TagpoolBenchmark(options).run()
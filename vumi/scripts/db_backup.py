@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.scripts.tests.test_db_backup -*-
 import sys
+import gzip
 import json
 import pkg_resources
 import traceback
@@ -8,6 +9,8 @@ import time
 import calendar
 import copy
 from datetime import datetime
+from itertools import islice
+from multiprocessing.pool import ThreadPool
 
 import yaml
 from twisted.python import usage
@@ -21,6 +24,50 @@ def vumi_version():
     return str(vumi)
 
 
+def open_backup(filename, mode):
+    """Open a backup file, gzipped if `filename` ends in `.gz`."""
+    if filename.endswith('.gz'):
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def chunks(iterable, size):
+    """Split `iterable` into lists of at most `size` items."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class Throughput(object):
+    """Counts items processed and reports how fast they were processed."""
+
+    def __init__(self, emit, description, report_interval):
+        self.emit = emit
+        self.description = description
+        self.report_interval = report_interval
+        self.count = 0
+        self.start = time.time()
+        self._next_report = report_interval
+
+    def rate(self):
+        return self.count / max(time.time() - self.start, 1e-6)
+
+    def add(self, count):
+        self.count += count
+        if self.report_interval and self.count >= self._next_report:
+            self.emit("  %d keys %s (%.0f keys/s) ..." % (
+                self.count, self.description, self.rate()))
+            while self._next_report <= self.count:
+                self._next_report += self.report_interval
+
+    def summary(self):
+        return "Took %.2f seconds (%.0f keys/s)." % (
+            time.time() - self.start, self.rate())
+
+
 class KeyHandler(object):
 
     REDIS_TYPES = ('string', 'list', 'set', 'zset', 'hash')
@@ -32,17 +79,48 @@ class KeyHandler(object):
                                   for ktype in self.REDIS_TYPES)
 
     def dump_key(self, redis, key):
-        key_type = redis.type(key)
-        record = {
-            'type': key_type,
-            'key': key,
-            'value': self._get_handlers[key_type](redis, key),
-            'ttl': redis.ttl(key),
-        }
+        [record] = self.dump_keys(redis, [key])
         return record
 
+    def dump_keys(self, redis, keys):
+        """Return backup records for `keys`.
+
+        This takes two pipelined round trips, one for the types and TTLs
+        of the keys and one for their values. Keys that are deleted before
+        their values are fetched are skipped.
+        """
+        pipe = redis.pipeline()
+        for key in keys:
+            pipe.type(key).ttl(key)
+        results = pipe.execute()
+        found = [(key, key_type, ttl) for key, key_type, ttl
+                 in zip(keys, results[::2], results[1::2])
+                 if key_type in self._get_handlers]
+
+        pipe = redis.pipeline()
+        for key, key_type, _ttl in found:
+            self._get_handlers[key_type](pipe, key)
+        values = pipe.execute()
+
+        records = []
+        for (key, key_type, ttl), value in zip(found, values):
+            if value is None or (key_type != 'string' and not value):
+                continue
+            if key_type == 'set':
+                value = sorted(value)
+            records.append({
+                'type': key_type,
+                'key': key,
+                'value': value,
+                'ttl': ttl,
+            })
+        return records
+
     def restore_key(self, redis, record, ttl_offset=0):
         key, key_type, ttl = record['key'], record['type'], record['ttl']
+        if key_type != 'string' and not record['value']:
+            # Redis doesn't store empty collections.
+            return
         if ttl is not None:
             ttl -= ttl_offset
             if ttl <= 0:
@@ -69,22 +147,20 @@ class KeyHandler(object):
         return redis.lrange(key, 0, -1)
 
     def list_set(self, redis, key, value):
-        for item in value:
-            redis.rpush(key, item)
+        redis.rpush(key, *value)
 
     def set_get(self, redis, key):
-        return sorted(redis.smembers(key))
+        return redis.smembers(key)
 
     def set_set(self, redis, key, value):
-        for item in value:
-            redis.sadd(key, item)
+        redis.sadd(key, *value)
 
     def zset_get(self, redis, key):
         return redis.zrange(key, 0, -1, withscores=True)
 
     def zset_set(self, redis, key, value):
-        for item, score in value:
-            redis.zadd(key, **{item.encode('utf8'): score})
+        redis.zadd(key, **dict(
+            (item.encode('utf8'), score) for item, score in value))
 
     def hash_get(self, redis, key):
         return redis.hgetall(key)
@@ -101,9 +177,23 @@ class BackupDbsCmd(usage.Options):
         ["not-sorted", None, "Don't sort keys when doing backup."],
     ]
 
+    optParameters = [
+        ["scan-count", None, 1000,
+         "Number of keys to ask Redis for with each SCAN.", int],
+        ["chunk-size", None, 1000,
+         "Number of keys to fetch in each pipelined round trip.", int],
+        ["report-interval", None, 100000,
+         "Report progress after each time this many keys are backed up."
+         " Zero to disable.", int],
+    ]
+
+    longdesc = """Backs up the keys in a Redis database, using SCAN so that
+                  the server isn't blocked while keys are listed. The backup
+                  is gzipped if its file name ends in .gz."""
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "wb")
+        self.db_backup = open_backup(db_backup, "wb")
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def header(self, cfg):
@@ -120,19 +210,37 @@ class BackupDbsCmd(usage.Options):
         self.db_backup.write(json.dumps(data))
         self.db_backup.write("\n")
 
+    def scan_keys(self, redis):
+        """Yield each key in `redis` once.
+
+        SCAN may return a key more than once, so we keep track of the keys
+        we've seen.
+        """
+        seen = set()
+        cursor = None
+        while cursor != 0:
+            cursor, keys = redis.scan(cursor or 0, count=self['scan-count'])
+            for key in keys:
+                if key not in seen:
+                    seen.add(key)
+                    yield key
+
     def run(self, cfg):
         cfg.emit("Backing up dbs ...")
         redis = cfg.get_redis(self.redis_config)
         key_handler = KeyHandler()
-        keys = redis.keys()
+        throughput = Throughput(cfg.emit, "backed up", self['report-interval'])
+        keys = self.scan_keys(redis)
         if not self.opts['not-sorted']:
             keys = sorted(keys)
         self.write_line(self.header(cfg))
-        for key in keys:
-            record = key_handler.dump_key(redis, key)
-            self.write_line(record)
+        for chunk in chunks(keys, self['chunk-size']):
+            for record in key_handler.dump_keys(redis, chunk):
+                self.write_line(record)
+            throughput.add(len(chunk))
         self.db_backup.close()
-        cfg.emit("Backed up %d keys." % (len(keys),))
+        cfg.emit("Backed up %d keys." % (throughput.count,))
+        cfg.emit(throughput.summary())
 
 
 class RestoreDbsCmd(usage.Options):
@@ -150,9 +258,19 @@ class RestoreDbsCmd(usage.Options):
                               "keys whose TTLs are then zero or negative."],
     ]
 
+    optParameters = [
+        ["chunk-size", None, 1000,
+         "Number of keys to restore in each pipelined round trip.", int],
+        ["concurrency", None, 1,
+         "Number of chunks of keys to restore in parallel.", int],
+        ["report-interval", None, 100000,
+         "Report progress after each time this many keys are restored."
+         " Zero to disable.", int],
+    ]
+
     def parseArgs(self, db_config, db_backup):
         self.db_config = yaml.safe_load(open(db_config))
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup, "rb")
         self.redis_config = self.db_config.get('redis_manager', {})
 
     def check_header(self, header):
@@ -198,7 +316,41 @@ class RestoreDbsCmd(usage.Options):
         if self.opts['purge']:
             redis._purge_all()
         key_handler = KeyHandler()
-        keys, skipped = 0, 0
+        throughput = Throughput(cfg.emit, "restored", self['report-interval'])
+        self.skipped = 0
+
+        def restore_chunk(records):
+            pipe = redis.pipeline()
+            for record in records:
+                key_handler.restore_key(pipe, record, ttl_offset)
+            pipe.execute()
+            return len(records)
+
+        record_chunks = chunks(
+            self.read_records(cfg, line_iter, key_handler),
+            self['chunk-size'])
+        concurrency = self['concurrency']
+        if concurrency > 1:
+            pool = ThreadPool(concurrency)
+            try:
+                # We only read as many chunks as we can restore at once so
+                # that we don't read the whole backup into memory.
+                for group in chunks(record_chunks, concurrency):
+                    for restored in pool.map(restore_chunk, group):
+                        throughput.add(restored)
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for records in record_chunks:
+                throughput.add(restore_chunk(records))
+
+        cfg.emit("%d keys successfully restored." % throughput.count)
+        cfg.emit(throughput.summary())
+        if self.skipped != 0:
+            cfg.emit("WARNING: %d bad backup lines skipped." % self.skipped)
+
+    def read_records(self, cfg, line_iter, key_handler):
         for i, line in enumerate(line_iter):
             try:
                 record = json.loads(line)
@@ -206,18 +358,13 @@ class RestoreDbsCmd(usage.Options):
                 excinfo = sys.exc_info()
                 for s in traceback.format_exception(*excinfo):
                     cfg.emit(s)
-                skipped += 1
+                self.skipped += 1
                 continue
             if not key_handler.record_okay(record):
                 cfg.emit("Skipping bad backup record on line %d." % (i + 1,))
-                skipped += 1
+                self.skipped += 1
                 continue
-            key_handler.restore_key(redis, record, ttl_offset)
-            keys += 1
-
-        cfg.emit("%d keys successfully restored." % keys)
-        if skipped != 0:
-            cfg.emit("WARNING: %d bad backup lines skipped." % skipped)
+            yield record
 
 
 class MigrateDbsCmd(usage.Options):
@@ -227,8 +374,8 @@ class MigrateDbsCmd(usage.Options):
 
     def parseArgs(self, migration_config, db_backup, migrated_backup):
         self.migration_config = yaml.safe_load(open(migration_config))
-        self.db_backup = open(db_backup, "rb")
-        self.migrated_backup = open(migrated_backup, "wb")
+        self.db_backup = open_backup(db_backup, "rb")
+        self.migrated_backup = open_backup(migrated_backup, "wb")
 
     def postOptions(self):
         self.rules = self.create_rules(self.migration_config)
@@ -358,7 +505,7 @@ class AnalyzeCmd(usage.Options):
     ]
 
     def parseArgs(self, db_backup):
-        self.db_backup = open(db_backup, "rb")
+        self.db_backup = open_backup(db_backup, "rb")
 
     def run(self, cfg):
         backup_lines = iter(self.db_backup)
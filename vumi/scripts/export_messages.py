@@ -0,0 +1,90 @@
+# -*- test-case-name: vumi.scripts.tests.test_export_messages -*-
+import sys
+
+import yaml
+from twisted.python import usage
+
+from vumi.components.message_store import MessageStore, EXPORT_FORMATTERS
+from vumi.persist.riak_manager import RiakManager
+from vumi.persist.redis_manager import RedisManager
+
+
+class Options(usage.Options):
+    optParameters = [
+        ["config", "c", None,
+         "A config file with riak_manager and redis_manager settings."],
+        ["batch", "b", None, "The batch_id to export messages for."],
+        ["direction", "d", "inbound",
+         "Which messages to export, inbound or outbound."],
+        ["format", "f", "json",
+         "Output format, json (one message per line) or csv."],
+        ["start", "s", "0",
+         "Offset of the first message to export. Use the offset reported by"
+         " a previous export to export only newer messages."],
+        ["output", "o", None,
+         "File to write messages to. Defaults to stdout. When resuming an"
+         " export the file is appended to."],
+    ]
+
+    longdesc = """Exports the messages in a message store batch, oldest
+                  first."""
+
+    def postOptions(self):
+        if self['config'] is None:
+            raise usage.UsageError("Please specify a config file.")
+        if self['batch'] is None:
+            raise usage.UsageError("Please specify a batch.")
+        if self['direction'] not in ('inbound', 'outbound'):
+            raise usage.UsageError(
+                "Direction must be inbound or outbound.")
+        if self['format'] not in EXPORT_FORMATTERS:
+            raise usage.UsageError("Format must be one of: %s." % (
+                ", ".join(sorted(EXPORT_FORMATTERS)),))
+        self['start'] = int(self['start'])
+
+
+class MessageExporter(object):
+    def __init__(self, options):
+        self.options = options
+        config = yaml.safe_load(open(options['config'], "rb"))
+        self.store = MessageStore(
+            RiakManager.from_config(config.get('riak_manager', {})),
+            RedisManager.from_config(config.get('redis_manager', {})))
+
+    def emit(self, s):
+        sys.stderr.write("%s\n" % (s,))
+
+    def open_output(self):
+        if self.options['output'] is None:
+            return sys.stdout
+        mode = "ab" if self.options['start'] else "wb"
+        return open(self.options['output'], mode)
+
+    def run(self):
+        export = {
+            'inbound': self.store.export_inbound_messages,
+            'outbound': self.store.export_outbound_messages,
+        }[self.options['direction']]
+        formatter = EXPORT_FORMATTERS[self.options['format']]()
+        output = self.open_output()
+        try:
+            offset = export(self.options['batch'], output, formatter,
+                            self.options['start'])
+        finally:
+            output.flush()
+            if output is not sys.stdout:
+                output.close()
+        self.emit("Exported up to offset %d." % (offset,))
+        return offset
+
+
+if __name__ == '__main__':
+    try:
+        options = Options()
+        options.parseOptions()
+    except usage.UsageError, errortext:
+        print '%s: %s' % (sys.argv[0], errortext)
+        print '%s: Try --help for usage details.' % (sys.argv[0])
+        sys.exit(1)
+
+    MessageExporter(options).run()
@@ -1,11 +1,14 @@
 # -*- test-case-name: vumi.scripts.tests.test_inject_messages -*-
 import sys
 import json
+from itertools import islice
+
 from twisted.python import usage
 from twisted.internet import reactor, threads
 from twisted.internet.defer import (maybeDeferred, DeferredQueue,
-                                    inlineCallbacks)
-from vumi.message import TransportUserMessage
+                                    DeferredList, inlineCallbacks, succeed)
+from twisted.internet.task import deferLater
+from vumi.message import TransportUserMessage, TransportEvent
 from vumi.service import Worker, WorkerCreator
 from vumi.servicemaker import VumiOptions
 from vumi.utils import to_kwargs
@@ -15,6 +18,15 @@ class InjectorOptions(VumiOptions):
     optParameters = [
         ["transport-name", None, None,
             "Name of the transport to inject messages from"],
+        ["message-type", None, "inbound",
+            "Type of message to inject: inbound, outbound or event"],
+        ["rate", "r", 0,
+            "Target messages per second. 0 (the default) means as fast as"
+            " possible", float],
+        ["chunk-size", None, 100,
+            "Number of lines to read and publish at a time", int],
+        ["concurrency", None, 1,
+            "Number of chunks to publish at the same time", int],
         ["verbose", "v", False, "Output the JSON being injected"],
     ]
 
@@ -23,42 +35,118 @@ class InjectorOptions(VumiOptions):
         if not self['transport-name']:
             raise usage.UsageError("Please provide the "
                                     "transport-name parameter.")
+        if self['message-type'] not in MessageInjector.MESSAGE_CLASSES:
+            raise usage.UsageError("Please provide one of %s as the "
+                                   "message-type parameter." % (", ".join(
+                                       sorted(MessageInjector.MESSAGE_CLASSES)
+                                   ),))
 
 
 class MessageInjector(Worker):
+    """Publishes messages read from a file of JSON lines.
+
+    Lines are read and parsed in a thread a chunk at a time and each chunk
+    is published as a batch, with up to `concurrency` chunks in flight. If
+    `rate` is set, injection is paced to that many messages per second.
+    """
 
     WORKER_QUEUE = DeferredQueue()
 
+    MESSAGE_CLASSES = {
+        'inbound': TransportUserMessage,
+        'outbound': TransportUserMessage,
+        'event': TransportEvent,
+    }
+
+    clock = reactor
+
     @inlineCallbacks
     def startWorker(self):
         self.transport_name = self.config['transport-name']
-        self.publisher = yield self.publish_to('%s.inbound' %
-                                                self.transport_name)
+        self.message_type = self.config.get('message-type') or 'inbound'
+        self.message_class = self.MESSAGE_CLASSES[self.message_type]
+        self.rate = float(self.config.get('rate') or 0)
+        self.chunk_size = int(self.config.get('chunk-size') or 100)
+        self.concurrency = int(self.config.get('concurrency') or 1)
+        self.injected = 0
+        self.start_time = None
+        self.publisher = yield self.publish_to('%s.%s' % (
+            self.transport_name, self.message_type))
         self.publisher.require_bind = False
         self.WORKER_QUEUE.put(self)
 
+    @inlineCallbacks
     def process_file(self, in_file, out_file=None):
-        return threads.deferToThread(self._process_file_in_thread,
-                                     in_file, out_file)
-
-    def _process_file_in_thread(self, in_file, out_file):
-        for line in in_file:
-            line = line.strip()
-            self.emit(out_file, line)
-            threads.blockingCallFromThread(reactor, self.process_line, line)
+        self.injected = 0
+        self.start_time = self.clock.seconds()
+        in_flight = set()
+        while True:
+            lines = yield threads.deferToThread(self.read_chunk, in_file)
+            if not lines:
+                break
+            for line, _data in lines:
+                self.emit(out_file, line)
+            d = self.publish_chunk([data for _line, data in lines])
+            in_flight.add(d)
+            d.addBoth(self._chunk_done, in_flight, d)
+            if len(in_flight) >= self.concurrency:
+                yield DeferredList(list(in_flight), fireOnOneCallback=True,
+                                   fireOnOneErrback=True, consumeErrors=True)
+            yield self.throttle()
+        yield DeferredList(list(in_flight), fireOnOneErrback=True,
+                           consumeErrors=True)
+
+    def _chunk_done(self, result, in_flight, d):
+        in_flight.discard(d)
+        return result
+
+    def read_chunk(self, in_file):
+        """
+        Read up to `chunk_size` non-blank lines from `in_file` and parse
+        them. Called in a thread.
+        """
+        lines = (line.strip() for line in in_file)
+        return [(line, json.loads(line)) for line in
+                islice((line for line in lines if line), self.chunk_size)]
+
+    def throttle(self):
+        """
+        Return a deferred that fires once injecting at `rate` would have
+        caught up with the messages injected so far.
+        """
+        if not self.rate:
+            return succeed(None)
+        delay = (self.start_time + self.injected / self.rate
+                 - self.clock.seconds())
+        if delay <= 0:
+            return succeed(None)
+        return deferLater(self.clock, delay, lambda: None)
 
     def emit(self, out_file, obj):
         if out_file is not None:
             out_file.write('%s\n' % (obj,))
 
-    def process_line(self, line):
-        data = {
+    def make_message(self, data):
+        fields = {
             'transport_name': self.transport_name,
             'transport_metadata': {},
         }
-        data.update(json.loads(line))
-        self.publisher.publish_message(
-            TransportUserMessage(**to_kwargs(data)))
+        fields.update(data)
+        return self.message_class(**to_kwargs(fields))
+
+    def publish_chunk(self, chunk):
+        messages = [self.make_message(data) for data in chunk]
+        self.injected += len(messages)
+        return self.publisher.publish_messages(messages)
+
+    def process_line(self, line):
+        return self.publish_chunk([json.loads(line)])
+
+    def throughput_summary(self):
+        elapsed = self.clock.seconds() - self.start_time
+        rate = self.injected / elapsed if elapsed else 0
+        return "Injected %d messages in %.2f seconds (%.0f messages/s)." % (
+            self.injected, elapsed, rate)
 
 
 @inlineCallbacks
@@ -74,6 +162,7 @@ def main(options):
 
     worker = yield MessageInjector.WORKER_QUEUE.get()
     yield worker.process_file(in_file, out_file)
+    sys.stderr.write('%s\n' % (worker.throughput_summary(),))
     reactor.stop()
 
 
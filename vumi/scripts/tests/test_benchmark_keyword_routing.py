@@ -0,0 +1,26 @@
+"""Tests for vumi.scripts.benchmark_keyword_routing."""
+
+from twisted.trial.unittest import TestCase
+
+from vumi.scripts.benchmark_keyword_routing import (
+    Options, KeywordRoutingBenchmark)
+
+
+class TestKeywordRoutingBenchmark(TestCase):
+
+    def make_benchmark(self, args):
+        options = Options()
+        options.parseOptions(args)
+        bench = KeywordRoutingBenchmark(options)
+        bench.output = []
+        bench.emit = bench.output.append
+        return bench
+
+    def test_run(self):
+        bench = self.make_benchmark(["--rules", "100", "--messages", "100"])
+        bench.run()
+        self.assertEqual([line.split(':')[0] for line in bench.output], [
+            "Index 100 rules",
+            "Indexed",
+            "Linear",
+            ])
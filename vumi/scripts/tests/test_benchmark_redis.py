@@ -0,0 +1,39 @@
+"""Tests for vumi.scripts.benchmark_redis."""
+
+from twisted.trial.unittest import TestCase
+
+from vumi.scripts.benchmark_redis import Options, RedisBenchmark
+
+
+class TestRedisBenchmark(TestCase):
+
+    def make_benchmark(self, args):
+        options = Options()
+        options.parseOptions(["--fake-redis"] + args)
+        bench = RedisBenchmark(options)
+        bench.output = []
+        bench.emit = bench.output.append
+        return bench
+
+    def test_run(self):
+        bench = self.make_benchmark(["--count", "10"])
+        bench.run()
+        self.assertEqual([line.split(':')[0] for line in bench.output], [
+            "Save session",
+            "Save session (pipelined)",
+            "Store tag reason",
+            "Store tag reason (pipelined)",
+            "Count message",
+            "Count message (pipelined)",
+            "Store return route",
+            "Store return route (pipelined)",
+            "Store return route (session)",
+            "Store return route (session) (pipelined)",
+            ])
+        self.assertEqual(bench.redis.keys(), [])
+
+    def test_run_refuses_existing_keys(self):
+        bench = self.make_benchmark(["--count", "10"])
+        bench.redis.set("foo", "bar")
+        self.assertRaises(RuntimeError, bench.run)
+        self.assertEqual(bench.redis.get("foo"), "bar")
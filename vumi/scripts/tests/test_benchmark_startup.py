@@ -0,0 +1,41 @@
+"""Tests for vumi.scripts.benchmark_startup."""
+
+from twisted.trial.unittest import TestCase
+from twisted.internet.defer import inlineCallbacks
+from twisted.python.usage import UsageError
+
+from vumi.service import Worker
+from vumi.scripts.benchmark_startup import Options, StartupBenchmark
+
+
+class ToyWorker(Worker):
+    @inlineCallbacks
+    def startWorker(self):
+        self.publisher = yield self.publish_to("toy.outbound")
+        yield self.consume("toy.inbound", lambda msg: None)
+
+
+class TestStartupBenchmark(TestCase):
+
+    def make_benchmark(self, args):
+        options = Options()
+        options.parseOptions(["--fake-amqp"] + args)
+        bench = StartupBenchmark(options)
+        bench.output = []
+        bench.emit = bench.output.append
+        return bench
+
+    @inlineCallbacks
+    def test_run(self):
+        bench = self.make_benchmark([
+            "--worker-class", "%s.ToyWorker" % (__name__,)])
+        yield bench.run()
+        self.assertEqual([line.split(':')[0] for line in bench.output], [
+            "Import %s" % (__name__,),
+            "Load AMQP spec",
+            "Start worker",
+            ])
+
+    def test_worker_class_required(self):
+        options = Options()
+        self.assertRaises(UsageError, options.parseOptions, [])
@@ -0,0 +1,35 @@
+"""Tests for vumi.scripts.benchmark_tagpools."""
+
+from twisted.trial.unittest import TestCase
+
+from vumi.scripts.benchmark_tagpools import Options, TagpoolBenchmark
+
+
+class TestTagpoolBenchmark(TestCase):
+
+    def make_benchmark(self, args):
+        options = Options()
+        options.parseOptions(["--fake-redis"] + args)
+        bench = TagpoolBenchmark(options)
+        bench.output = []
+        bench.emit = bench.output.append
+        return bench
+
+    def test_run(self):
+        bench = self.make_benchmark(["--tags", "10"])
+        bench.run()
+        self.assertEqual([line.split(':')[0] for line in bench.output], [
+            "Declare tags",
+            "Acquire tags",
+            "Release tags",
+            "Acquire specific tags",
+            "Release tags",
+            "Purge pool",
+            ])
+        self.assertEqual(bench.tagpool.list_pools(), set())
+
+    def test_run_refuses_pool_in_use(self):
+        bench = self.make_benchmark(["--tags", "10", "--pool", "busy"])
+        bench.tagpool.declare_tags([("busy", "tag1")])
+        bench.tagpool.acquire_tag("busy")
+        self.assertRaises(RuntimeError, bench.run)
@@ -1,5 +1,6 @@
 """Tests for vumi.scripts.db_backup."""
 
+import gzip
 import json
 import datetime
 
@@ -84,10 +85,11 @@ class BackupDbCmdTestCase(DbBackupBaseTestCase):
         db_backup = self.mktemp()
         cfg = self.make_cfg(["backup", self.mkdbconfig("bar"), db_backup])
         cfg.run()
-        self.assertEqual(cfg.output, [
+        self.assertEqual(cfg.output[:2], [
             'Backing up dbs ...',
             'Backed up 2 keys.',
         ])
+        self.assertTrue(cfg.output[2].startswith('Took '))
         with open(db_backup) as backup:
             self.assertEqual([json.loads(x) for x in backup], [
                 {"vumi_version": vumi_version(),
@@ -101,13 +103,57 @@ class BackupDbCmdTestCase(DbBackupBaseTestCase):
                 {'key': 'baz', 'type': 'string', 'value': 'bar', 'ttl': None},
             ])
 
-    def check_backup(self, key_prefix, expected):
+    def check_backup(self, key_prefix, expected, args=()):
         db_backup = self.mktemp()
-        cfg = self.make_cfg(["backup", self.mkdbconfig(key_prefix), db_backup])
+        cfg = self.make_cfg(["backup"] + list(args) +
+                            [self.mkdbconfig(key_prefix), db_backup])
         cfg.run()
         with open(db_backup) as backup:
             self.assertEqual([json.loads(x) for x in backup][1:], expected)
 
+    def test_backup_in_chunks(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % i, str(i))
+        self.check_backup("bar", [
+            {'key': 's%d' % i, 'type': 'string', 'value': str(i), 'ttl': None}
+            for i in range(5)], args=["--chunk-size", "2"])
+
+    def test_backup_not_sorted(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % i, str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--not-sorted", "--scan-count", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        with open(db_backup) as backup:
+            records = [json.loads(x) for x in backup]
+        self.assertEqual(records[0]['sorted'], False)
+        self.assertEqual(sorted(r['key'] for r in records[1:]),
+                         ['s%d' % i for i in range(5)])
+
+    def test_backup_gzip(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp() + ".gz"
+        cfg = self.make_cfg(["backup", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        backup = gzip.open(db_backup)
+        self.assertEqual([json.loads(x) for x in backup][1:], [
+            {'key': 's', 'type': 'string', 'value': 'foo', 'ttl': None}])
+        backup.close()
+
+    def test_backup_progress(self):
+        for i in range(5):
+            self.redis.set("bar:s%d" % i, str(i))
+        db_backup = self.mktemp()
+        cfg = self.make_cfg(["backup", "--chunk-size", "2",
+                             "--report-interval", "2",
+                             self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual([line.split(' (')[0] for line in cfg.output[1:3]], [
+            '  2 keys backed up',
+            '  4 keys backed up',
+        ])
+
     def test_backup_string(self):
         self.redis.set("bar:s", "foo")
         self.check_backup("bar", [{'key': 's', 'type': 'string',
@@ -207,10 +253,11 @@ class RestoreDbCmdTestCase(DbBackupBaseTestCase):
         cfg = self.make_cfg(["restore", self.mkdbconfig("bar"),
                              self.mkdbbackup()])
         cfg.run()
-        self.assertEqual(cfg.output, [
+        self.assertEqual(cfg.output[:2], [
             'Restoring dbs ...',
             '2 keys successfully restored.',
         ])
+        self.assertTrue(cfg.output[2].startswith('Took '))
         redis_data = sorted(
             (key, self.redis.get(key)) for key in self.redis.keys())
         expected_data = [tuple(x.items()[0]) for x in self.RESTORED_DATA]
@@ -225,6 +272,31 @@ class RestoreDbCmdTestCase(DbBackupBaseTestCase):
         cfg.run()
         self.assertEqual(redis.get("foo"), None)
 
+    def test_restore_gzip_backup(self):
+        self.redis.set("bar:s", "foo")
+        db_backup = self.mktemp() + ".gz"
+        self.make_cfg(["backup", self.mkdbconfig("bar"), db_backup]).run()
+        self.redis._purge_all()
+        cfg = self.make_cfg(["restore", self.mkdbconfig("bar"), db_backup])
+        cfg.run()
+        self.assertEqual(cfg.output[1], '1 keys successfully restored.')
+        self.assertEqual(self.redis.get("bar:s"), "foo")
+
+    def test_restore_concurrently(self):
+        backup_data = [{'key': 's%d' % i, 'type': 'string', 'value': str(i),
+                        'ttl': None} for i in range(5)]
+        self.check_restore(backup_data,
+                           dict(('s%d' % i, str(i)) for i in range(5)),
+                           self.redis.get,
+                           args=["--concurrency", "2", "--chunk-size", "1"])
+
+    def test_restore_skips_empty_values(self):
+        self.check_restore([{'key': 'l', 'type': 'list', 'value': [],
+                             'ttl': None},
+                            {'key': 's', 'type': 'string', 'value': '',
+                             'ttl': None}],
+                           {'s': ''}, self.redis.get)
+
     def check_restore(self, backup_data, restored_data, redis_get,
                       timestamp=None, args=(), key_prefix="bar"):
         if timestamp is None:
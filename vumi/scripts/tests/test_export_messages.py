@@ -0,0 +1,84 @@
+"""Tests for vumi.scripts.export_messages."""
+
+import json
+
+from twisted.python import usage
+from twisted.trial.unittest import TestCase
+
+from vumi.scripts.export_messages import Options, MessageExporter
+from vumi.components.message_store import MessageStore
+from vumi.message import TransportUserMessage
+from vumi.tests.utils import PersistenceMixin
+
+
+class TestOptions(TestCase):
+
+    def parse(self, *args):
+        options = Options()
+        options.parseOptions(list(args))
+        return options
+
+    def test_defaults(self):
+        options = self.parse("--config", "cfg.yaml", "--batch", "batch-1")
+        self.assertEqual(options['direction'], 'inbound')
+        self.assertEqual(options['format'], 'json')
+        self.assertEqual(options['start'], 0)
+        self.assertEqual(options['output'], None)
+
+    def test_batch_required(self):
+        self.assertRaises(usage.UsageError, self.parse,
+                          "--config", "cfg.yaml")
+
+    def test_unknown_format(self):
+        self.assertRaises(usage.UsageError, self.parse,
+                          "--config", "cfg.yaml", "--batch", "batch-1",
+                          "--format", "xml")
+
+    def test_unknown_direction(self):
+        self.assertRaises(usage.UsageError, self.parse,
+                          "--config", "cfg.yaml", "--batch", "batch-1",
+                          "--direction", "sideways")
+
+
+class TestMessageExporter(MessageExporter):
+    def __init__(self, store, options):
+        self.store = store
+        self.options = options
+        self.output = []
+
+    def emit(self, s):
+        self.output.append(s)
+
+
+class TestMessageExport(PersistenceMixin, TestCase):
+    sync_persistence = True
+    use_riak = True
+
+    def setUp(self):
+        self._persist_setUp()
+        self.store = MessageStore(self.get_riak_manager(),
+                                  self.get_redis_manager())
+
+    def tearDown(self):
+        return self._persist_tearDown()
+
+    def mkmsg(self, **kw):
+        kw.setdefault("transport_name", "sphex")
+        kw.setdefault("transport_type", "sms")
+        kw.setdefault("to_addr", "1234")
+        kw.setdefault("from_addr", "5678")
+        return TransportUserMessage(**kw)
+
+    def test_export(self):
+        batch_id = self.store.batch_start([])
+        msg = self.mkmsg(content=u"hello")
+        self.store.add_inbound_message(msg, batch_id=batch_id)
+        output_file = self.mktemp()
+        options = Options()
+        options.parseOptions(["--config", "cfg.yaml", "--batch", batch_id,
+                              "--output", output_file])
+        exporter = TestMessageExporter(self.store, options)
+        self.assertEqual(exporter.run(), 1)
+        self.assertEqual(exporter.output, ["Exported up to offset 1."])
+        [line] = open(output_file).read().splitlines()
+        self.assertEqual(json.loads(line)['message_id'], msg['message_id'])
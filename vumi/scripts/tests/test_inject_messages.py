@@ -1,6 +1,8 @@
 from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import Clock
+from twisted.python.usage import UsageError
 from vumi.transports.tests.utils import TransportTestCase
-from vumi.scripts.inject_messages import MessageInjector
+from vumi.scripts.inject_messages import MessageInjector, InjectorOptions
 import json
 import StringIO
 
@@ -49,3 +51,87 @@ class MessageInjectorTestCase(TransportTestCase):
         for msg, datum in zip(msgs, data):
             self.check_msg(msg, datum)
         self.assertEqual(out_file.getvalue(), data_string + "\n")
+
+    @inlineCallbacks
+    def test_process_file_in_chunks(self):
+        transport = yield self.get_transport({
+            'transport-name': 'test_transport',
+            'chunk-size': 3,
+            'concurrency': 2,
+        })
+        data = [dict(self.DEFAULT_DATA, message_id=str(i)) for i in range(10)]
+        in_file = StringIO.StringIO(
+            "\n".join(json.dumps(datum) for datum in data) + "\n\n")
+        yield transport.process_file(in_file)
+        msgs = self._amqp.get_messages('vumi', 'test_transport.inbound')
+        self.assertEqual([msg['message_id'] for msg in msgs],
+                         [str(i) for i in range(10)])
+        self.assertEqual(transport.injected, 10)
+
+    @inlineCallbacks
+    def test_process_file_outbound(self):
+        transport = yield self.get_transport({
+            'transport-name': 'test_transport',
+            'message-type': 'outbound',
+        })
+        data = self.make_data()
+        yield transport.process_file(StringIO.StringIO(json.dumps(data)))
+        [msg] = self._amqp.get_messages('vumi', 'test_transport.outbound')
+        self.check_msg(msg, data)
+
+    @inlineCallbacks
+    def test_process_file_events(self):
+        transport = yield self.get_transport({
+            'transport-name': 'test_transport',
+            'message-type': 'event',
+        })
+        data = {'event_type': 'ack', 'user_message_id': '1',
+                'sent_message_id': 'abc'}
+        yield transport.process_file(StringIO.StringIO(json.dumps(data)))
+        [msg] = self._amqp.get_messages('vumi', 'test_transport.event')
+        self.check_msg(msg, data)
+
+    def test_throttle(self):
+        self.transport.clock = Clock()
+        self.transport.rate = 5.0
+        self.transport.start_time = 0
+        self.transport.injected = 10
+        d = self.transport.throttle()
+        self.transport.clock.advance(1.9)
+        self.assertFalse(d.called)
+        self.transport.clock.advance(0.1)
+        self.assertTrue(d.called)
+        self.assertTrue(self.transport.throttle().called)
+
+    def test_no_throttle_without_rate(self):
+        self.transport.clock = Clock()
+        self.transport.start_time = 0
+        self.transport.injected = 10
+        self.assertTrue(self.transport.throttle().called)
+
+    def test_throughput_summary(self):
+        self.transport.clock = Clock()
+        self.transport.start_time = 0
+        self.transport.injected = 50
+        self.transport.clock.advance(2)
+        self.assertEqual(self.transport.throughput_summary(),
+                         "Injected 50 messages in 2.00 seconds"
+                         " (25 messages/s).")
+
+
+class InjectorOptionsTestCase(TransportTestCase):
+
+    transport_class = MessageInjector
+
+    def test_message_type(self):
+        options = InjectorOptions()
+        options.parseOptions(['--transport-name', 'foo',
+                              '--message-type', 'event', '--rate', '10'])
+        self.assertEqual(options['message-type'], 'event')
+        self.assertEqual(options['rate'], 10.0)
+
+    def test_unknown_message_type(self):
+        options = InjectorOptions()
+        self.assertRaises(UsageError, options.parseOptions,
+                          ['--transport-name', 'foo',
+                           '--message-type', 'foo'])
@@ -4,9 +4,10 @@ import json
 from copy import deepcopy
 
 from twisted.python import log
-from twisted.application.service import MultiService
+from twisted.application.service import Service, MultiService
 from twisted.application.internet import TCPClient
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import (
+    inlineCallbacks, returnValue, gatherResults, maybeDeferred, DeferredLock)
 from twisted.internet import protocol, reactor
 from twisted.web.resource import Resource
 import txamqp
@@ -52,10 +53,13 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self.spec, self.options.get('heartbeat', 0))
         self.amqp_client.factory = self
         self.amqp_client.vumi_options = self.options
-        self.amqp_client.connected_callback = self.worker._amqp_connected
+        self.amqp_client.connected_callback = self.amqp_connected
         self.resetDelay()
         return self.amqp_client
 
+    def amqp_connected(self, amqp_client):
+        return self.worker._amqp_connected(amqp_client)
+
     def clientConnectionFailed(self, connector, reason):
         log.err("Connection failed: %r" % (reason,))
         self.worker._amqp_connection_failed()
@@ -74,7 +78,142 @@ class AmqpFactory(protocol.ReconnectingClientFactory):
             self, connector, reason)
 
 
+class SharedAmqpFactory(AmqpFactory):
+    """
+    An AmqpFactory for a connection shared by the workers of an
+    :class:`AmqpConnectionPool`.
+
+    Workers added before the connection is made are connected once it is
+    made and workers added afterwards are connected immediately. All of
+    the workers are reconnected if the connection is lost. Publishers
+    share a single channel on the connection.
+    """
+
+    def __init__(self, pool):
+        self.options = pool.options
+        self.config = {}
+        self.spec = get_spec(vumi_resource_path(self.options['specfile']))
+        self.delegate = TwistedDelegate()
+        self.pool = pool
+        self.workers = []
+        self.amqp_client = None
+        self.connected_client = None
+
+    def buildProtocol(self, addr):
+        amqp_client = AmqpFactory.buildProtocol(self, addr)
+        amqp_client.share_publisher_channel = True
+        return amqp_client
+
+    def add_worker(self, worker):
+        self.workers.append(worker)
+        if self.connected_client is not None:
+            return worker._amqp_connected(self.connected_client)
+
+    def remove_worker(self, worker):
+        self.workers.remove(worker)
+
+    def amqp_connected(self, amqp_client):
+        self.connected_client = amqp_client
+        return gatherResults([
+            maybeDeferred(worker._amqp_connected, amqp_client)
+            for worker in list(self.workers)])
+
+    def _connection_failed(self):
+        self.connected_client = None
+        self.amqp_client = None
+        for worker in self.workers:
+            worker._amqp_connection_failed()
+
+    def clientConnectionFailed(self, connector, reason):
+        log.err("Connection failed: %r" % (reason,))
+        self._connection_failed()
+        protocol.ReconnectingClientFactory.clientConnectionFailed(
+            self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        if not self.pool.running:
+            # We've specifically asked for this disconnect.
+            return
+        log.err("Client connection lost: %r" % (reason,))
+        self._connection_failed()
+        protocol.ReconnectingClientFactory.clientConnectionLost(
+            self, connector, reason)
+
+
+class AmqpConnectionPool(MultiService, object):
+    """
+    A fixed number of AMQP connections shared by workers in one process.
+
+    Workers are spread across the connections in the order they start.
+
+    :param dict options:
+        Vumi options with the AMQP connection details.
+    :param int size:
+        Number of connections to open.
+    """
+
+    FACTORY_CLASS = SharedAmqpFactory
+
+    def __init__(self, options, size=1, timeout=30, bindAddress=None):
+        super(AmqpConnectionPool, self).__init__()
+        self.options = options
+        self.factories = []
+        self._assigned = {}
+        self._next_factory = 0
+        for _ in range(size):
+            factory = self.FACTORY_CLASS(self)
+            self.factories.append(factory)
+            self.connect(factory, timeout, bindAddress)
+
+    def connect(self, factory, timeout, bindAddress):
+        service = TCPClient(self.options['hostname'], self.options['port'],
+                            factory, timeout, bindAddress)
+        service.setServiceParent(self)
+
+    def add_worker(self, worker):
+        factory = self.factories[self._next_factory]
+        self._next_factory = (self._next_factory + 1) % len(self.factories)
+        self._assigned[worker] = factory
+        return factory.add_worker(worker)
+
+    def remove_worker(self, worker):
+        factory = self._assigned.pop(worker, None)
+        if factory is not None:
+            factory.remove_worker(worker)
+
+
+class SharedAmqpConnection(Service, object):
+    """
+    Connects a worker to an :class:`AmqpConnectionPool` while the worker is
+    running. Used in place of a per-worker TCPClient.
+    """
+
+    def __init__(self, pool, worker):
+        self.pool = pool
+        self.worker = worker
+
+    def startService(self):
+        super(SharedAmqpConnection, self).startService()
+        return self.pool.add_worker(self.worker)
+
+    def stopService(self):
+        super(SharedAmqpConnection, self).stopService()
+        self.pool.remove_worker(self.worker)
+        # The connection stays open for the other workers, so anything still
+        # consuming on the worker's behalf has to be stopped here.
+        return self.worker._stop_consumers()
+
+
 class WorkerAMQClient(AMQClient):
+    # Set on connections shared by several workers so that publishers
+    # don't each open their own channel.
+    share_publisher_channel = False
+
+    def __init__(self, *args, **kwargs):
+        AMQClient.__init__(self, *args, **kwargs)
+        self._publisher_channel = None
+        self._publisher_channel_lock = DeferredLock()
+
     @inlineCallbacks
     def connectionMade(self):
         AMQClient.connectionMade(self)
@@ -136,17 +275,35 @@ class WorkerAMQClient(AMQClient):
                                  routing_key=routing_key)
         # register the consumer
         reply = yield channel.basic_consume(queue=queue_name)
+        consumer.consumer_tag = reply.consumer_tag
         queue = yield self.queue(reply.consumer_tag)
         # start consuming! nom nom nom
         consumer.start(channel, queue)
         # return the newly created & consuming consumer
         returnValue(consumer)
 
+    @inlineCallbacks
+    def get_publisher_channel(self):
+        """
+        Return a new channel, or the shared publisher channel if
+        `share_publisher_channel` is set.
+        """
+        if not self.share_publisher_channel:
+            channel = yield self.get_channel()
+            returnValue(channel)
+        yield self._publisher_channel_lock.acquire()
+        try:
+            if self._publisher_channel is None:
+                self._publisher_channel = yield self.get_channel()
+        finally:
+            self._publisher_channel_lock.release()
+        returnValue(self._publisher_channel)
+
     @inlineCallbacks
     def start_publisher(self, publisher_class, *args, **kwargs):
         # much more braindead than start_consumer
         # get a channel
-        channel = yield self.get_channel()
+        channel = yield self.get_publisher_channel()
         # start the publisher
         publisher = publisher_class(*args, **kwargs)
         publisher.vumi_options = self.vumi_options
@@ -173,9 +330,11 @@ class Worker(MultiService, object):
             config = {}
         self.config = config
         self._amqp_client = None
+        self._consumers = []
 
     def _amqp_connected(self, amqp_client):
         self._amqp_client = amqp_client
+        self._consumers = []
         return self.startWorker()
 
     def _amqp_connection_failed(self):
@@ -225,7 +384,17 @@ class Worker(MultiService, object):
         return self.start_consumer(klass, callback)
 
     def start_consumer(self, consumer_class, *args, **kw):
-        return self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        d = self._amqp_client.start_consumer(consumer_class, *args, **kw)
+        return d.addCallback(self._consumer_started)
+
+    def _consumer_started(self, consumer):
+        self._consumers.append(consumer)
+        return consumer
+
+    def _stop_consumers(self):
+        consumers, self._consumers = self._consumers, []
+        return gatherResults([consumer.stop() for consumer in consumers
+                              if consumer.keep_consuming])
 
     def publish_to(self, routing_key,
                    exchange_name='vumi', exchange_type='direct', durable=True,
@@ -286,6 +455,7 @@ class Consumer(object):
 
     message_class = Message
     start_paused = False
+    consumer_tag = None
 
     @inlineCallbacks
     def start(self, channel, queue):
@@ -343,6 +513,9 @@ class Consumer(object):
     def stop(self):
         log.msg("Consumer stopping...")
         self.keep_consuming = False
+        if self.consumer_tag is not None:
+            # Stop the server delivering to us before the channel goes away
+            yield self.channel.basic_cancel(self.consumer_tag)
         # This actually closes the channel on the server
         yield self.channel.channel_close()
         # This just marks the channel as closed on the client
@@ -464,6 +637,30 @@ class Publisher(object):
         d.addCallback(lambda r: message)
         return d
 
+    @inlineCallbacks
+    def publish_messages(self, messages, **kwargs):
+        """
+        Publish a batch of messages.
+
+        The routing key is checked once for the whole batch and the
+        messages are all written to the channel before waiting on any of
+        them.
+        """
+        exchange_name = kwargs.get('exchange_name') or self.exchange_name
+        routing_key = kwargs.get('routing_key') or self.routing_key
+        require_bind = kwargs.get('require_bind', self.require_bind)
+        delivery_mode = kwargs.get('delivery_mode', self.delivery_mode)
+        yield self.check_routing_key(routing_key, require_bind)
+        published = []
+        for message in messages:
+            amq_message = Content(message.to_json())
+            amq_message['delivery mode'] = delivery_mode
+            published.append(maybeDeferred(
+                self.channel.basic_publish, exchange=exchange_name,
+                content=amq_message, routing_key=routing_key))
+        yield gatherResults(published)
+        returnValue(messages)
+
     def publish_json(self, data, **kw):
         """helper method"""
         return self.publish_raw(json.dumps(data, cls=json.JSONEncoder), **kw)
@@ -480,8 +677,9 @@ class WorkerCreator(object):
     Creates workers
     """
 
-    def __init__(self, vumi_options):
+    def __init__(self, vumi_options, connection_pool=None):
         self.options = vumi_options
+        self.connection_pool = connection_pool
 
     def create_worker(self, worker_class, config, timeout=30,
                       bindAddress=None):
@@ -501,6 +699,9 @@ class WorkerCreator(object):
         return worker
 
     def _connect(self, worker, timeout, bindAddress):
-        service = TCPClient(self.options['hostname'], self.options['port'],
-                            AmqpFactory(worker), timeout, bindAddress)
+        if self.connection_pool is not None:
+            service = SharedAmqpConnection(self.connection_pool, worker)
+        else:
+            service = TCPClient(self.options['hostname'], self.options['port'],
+                                AmqpFactory(worker), timeout, bindAddress)
         service.setServiceParent(worker)
@@ -13,6 +13,7 @@ from vumi.service import WorkerCreator
 from vumi.utils import load_class_by_string
 from vumi.errors import VumiError
 from vumi.sentry import SentryLoggerService
+from vumi import log
 
 
 def overlay_configs(*configs):
@@ -51,6 +52,8 @@ class VumiOptions(usage.Options):
         ["vhost", None, None, "AMQP virtual host (*)"],
         ["specfile", None, None, "AMQP spec file (*)"],
         ["sentry", None, None, "Sentry DSN (*)"],
+        ["log-level", None, None,
+         "Discard log messages below this level, e.g. info (*)"],
         ["vumi-config", None, None,
          "YAML config file for setting core vumi options (any command-line"
          " parameter marked with an asterisk)"],
@@ -64,6 +67,7 @@ class VumiOptions(usage.Options):
         "vhost": "/develop",
         "specfile": "amqp-spec-0-8.xml",
         "sentry": None,
+        "log-level": None,
         }
 
     def get_vumi_options(self):
@@ -180,6 +184,9 @@ class VumiWorkerServiceMaker(object):
 
     def makeService(self, options):
         sentry_dsn = options.vumi_options.pop('sentry', None)
+        log_level = options.vumi_options.pop('log-level', None)
+        if log_level is not None:
+            log.set_level(log_level)
         class_name = options.worker_class.rpartition('.')[2].lower()
         logger_name = options.worker_config.get('worker_name', class_name)
 
@@ -1,6 +1,7 @@
 import logging
 
 from twisted.trial.unittest import TestCase
+from twisted.python.log import textFromEventDict
 
 from vumi.tests.utils import LogCatcher
 from vumi import log
@@ -12,6 +13,9 @@ class TestException(Exception):
 
 class VumiLogTestCase(TestCase):
 
+    def setUp(self):
+        self.patch(log, '_level', logging.NOTSET)
+
     def tearDown(self):
         self.flushLoggedErrors(TestException)
 
@@ -48,3 +52,44 @@ class VumiLogTestCase(TestCase):
             failure = entry['failure']
             exception = failure.trap(TestException)
             self.assertEqual(exception, TestException)
+
+    def test_set_level(self):
+        log.set_level(logging.WARNING)
+        self.assertEqual(log.get_level(), logging.WARNING)
+        log.set_level('info')
+        self.assertEqual(log.get_level(), logging.INFO)
+        self.assertRaises(ValueError, log.set_level, 'loud')
+
+    def test_is_enabled_for(self):
+        self.assertTrue(log.is_enabled_for(logging.DEBUG))
+        log.set_level(logging.INFO)
+        self.assertFalse(log.is_enabled_for(logging.DEBUG))
+        self.assertTrue(log.is_enabled_for(logging.INFO))
+        self.assertTrue(log.is_enabled_for(logging.ERROR))
+
+    def test_discard_below_level(self):
+        log.set_level(logging.WARNING)
+        with LogCatcher() as lc:
+            log.debug('foo')
+            log.info('foo')
+            log.warning('bar')
+            log.error(TestException('baz'))
+            log.msg('qux', logLevel=logging.CRITICAL)
+        self.assertEqual(lc.messages(), ['bar', 'qux'])
+        self.assertEqual(len(lc.errors), 1)
+
+    def test_format_not_rendered(self):
+        class Unrenderable(object):
+            def __repr__(self):
+                raise AssertionError("Rendered log argument")
+
+        log.set_level(logging.INFO)
+        with LogCatcher() as lc:
+            log.debug(format="%(value)r", value=Unrenderable())
+        self.assertEqual(lc.logs, [])
+
+    def test_format_rendered(self):
+        with LogCatcher() as lc:
+            log.debug(format="Sending %(msg)r", msg='X')
+        [event] = lc.logs
+        self.assertEqual(textFromEventDict(event), "Sending 'X'")
@@ -1,10 +1,21 @@
+import os
+import logging
+
+import yaml
 from twisted.internet.defer import (Deferred, DeferredList, inlineCallbacks,
                                     returnValue)
+from twisted.internet.error import ProcessTerminated
+from twisted.internet.task import Clock
+from twisted.application.service import Service
+from twisted.python.failure import Failure
 
 from vumi.tests.utils import StubbedWorkerCreator, VumiWorkerTestCase
 from vumi.service import Worker
 from vumi.message import TransportUserMessage
 from vumi.multiworker import MultiWorker
+from vumi.errors import ConfigError
+from vumi.sentry import SentryLoggerService
+from vumi import log
 
 
 class ToyWorker(Worker):
@@ -40,6 +51,47 @@ class StubbedMultiWorker(MultiWorker):
         return DeferredList([w._d for w in self.workers])
 
 
+class FakeProcess(object):
+    def __init__(self, protocol, args, pid):
+        self.protocol = protocol
+        self.args = args
+        self.pid = pid
+        self.signals = []
+
+    def signalProcess(self, signal):
+        self.signals.append(signal)
+
+    def end(self, exit_code=1):
+        self.protocol.processEnded(Failure(
+            ProcessTerminated(exitCode=exit_code)))
+
+
+class SupervisingMultiWorker(MultiWorker):
+    def get_clock(self):
+        if not hasattr(self, 'clock'):
+            self.clock = Clock()
+        return self.clock
+
+    def spawn_process(self, protocol, args):
+        if not hasattr(self, 'spawned'):
+            self.spawned = []
+        process = FakeProcess(protocol, args, len(self.spawned) + 1)
+        self.spawned.append(process)
+        return process
+
+
+class FakeSentryLoggerService(SentryLoggerService):
+    def __init__(self, dsn):
+        self.setName('Sentry Logger')
+        self.dsn = dsn
+
+    def startService(self):
+        return Service.startService(self)
+
+    def stopService(self):
+        return Service.stopService(self)
+
+
 def mkmsg(content):
     return TransportUserMessage(
         from_addr='from',
@@ -127,3 +179,175 @@ class MultiWorkerTestCase(VumiWorkerTestCase):
         worker2 = worker.getServiceNamed("worker2")
         self.assertEqual({'foo': 'bar'}, worker1.config)
         self.assertEqual({'foo': 'baz'}, worker2.config)
+
+
+class MultiWorkerSupervisorTestCase(VumiWorkerTestCase):
+
+    base_config = {
+        'processes': 2,
+        'restart_delay': 1,
+        'max_restart_delay': 10,
+        'workers': {
+            'worker1': "%s.ToyWorker" % (__name__,),
+            'worker2': "%s.ToyWorker" % (__name__,),
+            'worker3': "%s.ToyWorker" % (__name__,),
+            'other': "%s.StubbedMultiWorker" % (__name__,),
+            },
+        'worker1': {
+            'foo': 'bar',
+            },
+        }
+
+    @inlineCallbacks
+    def get_supervisor(self, services=(), **config):
+        cfg = dict(self.base_config, **config)
+        self.worker = yield self.get_worker(
+            cfg, SupervisingMultiWorker, start=False)
+        for service in services:
+            self.worker.addService(service)
+        self.worker.startService()
+        self.addCleanup(self.stop_supervisor, self.worker)
+        returnValue(self.worker)
+
+    def stop_supervisor(self, worker):
+        d = worker.stop_child_processes()
+        for child in worker.child_processes:
+            if child.is_running():
+                child.process.end(0)
+        return d
+
+    def get_child_config(self, process):
+        config_path = process.args[process.args.index('--config') + 1]
+        return yaml.safe_load(open(config_path))
+
+    @inlineCallbacks
+    def test_start_processes_by_instance(self):
+        worker = yield self.get_supervisor()
+        self.assertEqual(len(worker.spawned), 2)
+        self.assertEqual([sorted(p.workers) for p in worker.child_processes],
+                         [['other', 'worker2'], ['worker1', 'worker3']])
+        self.assertEqual(ToyWorker.events, [])
+
+    @inlineCallbacks
+    def test_start_processes_by_class(self):
+        worker = yield self.get_supervisor(process_grouping='class')
+        self.assertEqual([sorted(p.workers) for p in worker.child_processes],
+                         [['other'], ['worker1', 'worker2', 'worker3']])
+
+    @inlineCallbacks
+    def test_fewer_groups_than_processes(self):
+        worker = yield self.get_supervisor(
+            processes=4, process_grouping='class')
+        self.assertEqual(len(worker.spawned), 2)
+
+    @inlineCallbacks
+    def test_unknown_process_grouping(self):
+        worker = yield self.get_worker(
+            dict(self.base_config, process_grouping='foo'),
+            SupervisingMultiWorker, start=False)
+        self.assertRaises(ConfigError, worker.startService)
+
+    @inlineCallbacks
+    def test_child_process_config(self):
+        worker = yield self.get_supervisor()
+        process = worker.spawned[1]
+        config = self.get_child_config(process)
+        self.assertEqual(config['workers'], {
+            'worker1': "%s.ToyWorker" % (__name__,),
+            'worker3': "%s.ToyWorker" % (__name__,),
+            })
+        self.assertEqual(config['worker1'], {'foo': 'bar'})
+        self.assertFalse('processes' in config)
+        self.assertFalse('restart_delay' in config)
+        self.assertTrue('vumi.multiworker.MultiWorker' in process.args)
+        options_path = process.args[process.args.index('--vumi-config') + 1]
+        self.assertEqual(yaml.safe_load(open(options_path)), worker.options)
+
+    @inlineCallbacks
+    def test_child_process_sentry_and_log_level(self):
+        self.patch(log, '_level', logging.WARNING)
+        worker = yield self.get_supervisor(services=[
+            FakeSentryLoggerService('http://1:2@example.com/2/')])
+        args = worker.spawned[0].args
+        self.assertEqual(args[args.index('--sentry') + 1],
+                         'http://1:2@example.com/2/')
+        self.assertEqual(args[args.index('--log-level') + 1], 'WARNING')
+
+    @inlineCallbacks
+    def test_child_process_default_logging(self):
+        self.patch(log, '_level', logging.NOTSET)
+        worker = yield self.get_supervisor()
+        self.assertFalse('--sentry' in worker.spawned[0].args)
+        self.assertFalse('--log-level' in worker.spawned[0].args)
+
+    @inlineCallbacks
+    def test_restart_with_backoff(self):
+        worker = yield self.get_supervisor()
+        child = worker.child_processes[0]
+        worker.spawned[0].end()
+        self.assertFalse(child.is_running())
+        self.assertEqual(len(worker.spawned), 2)
+        worker.clock.advance(1)
+        self.assertEqual(len(worker.spawned), 3)
+        self.assertTrue(child.process is worker.spawned[2])
+
+        worker.spawned[2].end()
+        worker.clock.advance(1)
+        self.assertEqual(len(worker.spawned), 3)
+        worker.clock.advance(1)
+        self.assertEqual(len(worker.spawned), 4)
+
+        worker.spawned[3].end()
+        worker.clock.advance(3)
+        self.assertEqual(len(worker.spawned), 4)
+        worker.clock.advance(1)
+        self.assertEqual(len(worker.spawned), 5)
+        self.assertEqual(child.restarts, 3)
+
+    @inlineCallbacks
+    def test_restart_delay_capped(self):
+        worker = yield self.get_supervisor()
+        child = worker.child_processes[0]
+        child.failures = 10
+        worker.spawned[0].end()
+        self.assertEqual(
+            [call.getTime() for call in worker.clock.getDelayedCalls()],
+            [10])
+
+    @inlineCallbacks
+    def test_backoff_reset_after_uptime(self):
+        worker = yield self.get_supervisor()
+        child = worker.child_processes[0]
+        child.failures = 3
+        worker.clock.advance(10)
+        worker.spawned[0].end()
+        worker.clock.advance(1)
+        self.assertEqual(len(worker.spawned), 3)
+        self.assertEqual(child.failures, 1)
+
+    @inlineCallbacks
+    def test_process_status(self):
+        worker = yield self.get_supervisor()
+        worker.clock.advance(5)
+        worker.spawned[1].end()
+        self.assertEqual(worker.get_process_status(), [
+            {'name': 'multiworker-0', 'workers': ['other', 'worker2'],
+             'pid': 1, 'running': True, 'uptime': 5, 'restarts': 0},
+            {'name': 'multiworker-1', 'workers': ['worker1', 'worker3'],
+             'pid': None, 'running': False, 'uptime': 0, 'restarts': 1},
+            ])
+
+    @inlineCallbacks
+    def test_stop_processes(self):
+        worker = yield self.get_supervisor()
+        config_dir = worker.config_dir
+        worker.spawned[1].end()
+        d = worker.stopService()
+        self.assertEqual(worker.clock.getDelayedCalls(), [])
+        self.assertEqual(worker.spawned[0].signals, ['TERM'])
+        self.assertEqual(worker.spawned[1].signals, [])
+        self.assertFalse(d.called)
+        worker.spawned[0].end(0)
+        yield d
+        self.assertEqual(len(worker.spawned), 2)
+        self.assertFalse(os.path.exists(config_dir))
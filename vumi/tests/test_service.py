@@ -1,8 +1,10 @@
 from twisted.trial.unittest import TestCase
 from twisted.internet.defer import inlineCallbacks
 
-from vumi.service import Worker, WorkerCreator
-from vumi.tests.utils import (fake_amq_message, get_stubbed_worker)
+from vumi.service import (
+    Worker, WorkerCreator, AmqpConnectionPool, SharedAmqpConnection)
+from vumi.tests.utils import (
+    fake_amq_message, get_stubbed_worker, get_fake_amq_client)
 from vumi.message import Message
 
 
@@ -46,12 +48,71 @@ class ServiceTestCase(TestCase):
         self.assertEquals(published_msg.body, '{"key": "value"}')
         self.assertEquals(published_msg.properties, {'delivery mode': 2})
 
+    @inlineCallbacks
+    def test_publish_messages(self):
+        worker = get_stubbed_worker(Worker)
+        publisher = yield worker.publish_to('test.routing.key')
+        messages = [Message(key=i) for i in range(3)]
+        result = yield publisher.publish_messages(messages)
+        self.assertEqual(result, messages)
+        published = publisher.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key')
+        self.assertEqual([msg.body for msg in published],
+                         ['{"key": %d}' % i for i in range(3)])
+        self.assertEqual([msg.properties for msg in published],
+                         [{'delivery mode': 2}] * 3)
+
+    @inlineCallbacks
+    def test_publishers_use_own_channels(self):
+        worker = get_stubbed_worker(Worker)
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertNotEqual(publisher1.channel, publisher2.channel)
+
+    @inlineCallbacks
+    def test_publishers_share_channel(self):
+        worker = get_stubbed_worker(Worker)
+        worker._amqp_client.share_publisher_channel = True
+        publisher1 = yield worker.publish_to('test.routing.key1')
+        publisher2 = yield worker.publish_to('test.routing.key2')
+        self.assertEqual(publisher1.channel, publisher2.channel)
+        yield worker.consume('test.routing.key3', lambda msg: None)
+        self.assertEqual(len(worker._amqp_client.channels), 2)
+        publisher2.publish_message(Message(key="value"))
+        [published_msg] = publisher2.channel.broker.get_dispatched(
+            'vumi', 'test.routing.key2')
+        self.assertEquals(published_msg.body, '{"key": "value"}')
+
 
 class LoadableTestWorker(Worker):
     def poke(self):
         return "poke"
 
 
+class ConnectionRecordingWorker(Worker):
+    def __init__(self, *args, **kw):
+        super(ConnectionRecordingWorker, self).__init__(*args, **kw)
+        self.connections = []
+
+    def startWorker(self):
+        self.connections.append(self._amqp_client)
+
+
+class ConsumingWorker(ConnectionRecordingWorker):
+    def __init__(self, *args, **kw):
+        super(ConsumingWorker, self).__init__(*args, **kw)
+        self.received = []
+
+    def startWorker(self):
+        super(ConsumingWorker, self).startWorker()
+        return self.consume(self.config['routing_key'], self.received.append)
+
+
+class UnconnectedAmqpConnectionPool(AmqpConnectionPool):
+    def connect(self, factory, timeout, bindAddress):
+        pass
+
+
 class NoQueueWorkerCreator(WorkerCreator):
     def _connect(self, *_args, **_kw):
         pass
@@ -80,3 +141,107 @@ class TestWorkerCreator(TestCase):
                                   LoadableTestWorker.__name__)
         worker = creator.create_worker(worker_class, {})
         self.assertEquals("poke", worker.poke())
+
+
+class TestAmqpConnectionPool(TestCase):
+    def get_pool(self, size=1):
+        pool = UnconnectedAmqpConnectionPool({
+            "specfile": "amqp-spec-0-8.xml",
+            "vhost": "/test",
+            }, size)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        return pool
+
+    def get_worker(self):
+        return ConnectionRecordingWorker({}, {})
+
+    def test_workers_connected_when_connection_made(self):
+        pool = self.get_pool()
+        worker1, worker2 = self.get_worker(), self.get_worker()
+        pool.add_worker(worker1)
+        pool.add_worker(worker2)
+        self.assertEqual(worker1.connections, [])
+        client = get_fake_amq_client()
+        [factory] = pool.factories
+        factory.amqp_connected(client)
+        self.assertEqual(worker1.connections, [client])
+        self.assertEqual(worker2.connections, [client])
+
+    def test_worker_connected_immediately(self):
+        pool = self.get_pool()
+        client = get_fake_amq_client()
+        pool.factories[0].amqp_connected(client)
+        worker = self.get_worker()
+        pool.add_worker(worker)
+        self.assertEqual(worker.connections, [client])
+
+    def test_workers_spread_across_connections(self):
+        pool = self.get_pool(2)
+        clients = [get_fake_amq_client(), get_fake_amq_client()]
+        for factory, client in zip(pool.factories, clients):
+            factory.amqp_connected(client)
+        workers = [self.get_worker() for _ in range(3)]
+        for worker in workers:
+            pool.add_worker(worker)
+        self.assertEqual([w.connections for w in workers],
+                         [[clients[0]], [clients[1]], [clients[0]]])
+
+    def test_remove_worker(self):
+        pool = self.get_pool()
+        worker = self.get_worker()
+        pool.add_worker(worker)
+        pool.remove_worker(worker)
+        pool.factories[0].amqp_connected(get_fake_amq_client())
+        self.assertEqual(worker.connections, [])
+
+    def test_connection_lost(self):
+        pool = self.get_pool()
+        [factory] = pool.factories
+        factory.amqp_connected(get_fake_amq_client())
+        factory._connection_failed()
+        worker = self.get_worker()
+        pool.add_worker(worker)
+        self.assertEqual(worker.connections, [])
+        client = get_fake_amq_client()
+        factory.amqp_connected(client)
+        self.assertEqual(worker.connections, [client])
+
+    def test_shared_publisher_channel(self):
+        pool = self.get_pool()
+        client = pool.factories[0].buildProtocol(None)
+        self.assertTrue(client.share_publisher_channel)
+
+    def test_create_worker_with_pool(self):
+        pool = self.get_pool()
+        creator = WorkerCreator({}, pool)
+        worker = creator.create_worker_by_class(ConnectionRecordingWorker, {})
+        [service] = list(worker)
+        self.assertTrue(isinstance(service, SharedAmqpConnection))
+        client = get_fake_amq_client()
+        pool.factories[0].amqp_connected(client)
+        worker.startService()
+        self.assertEqual(worker.connections, [client])
+        worker.stopService()
+        self.assertEqual(pool.factories[0].workers, [])
+
+    @inlineCallbacks
+    def test_stopped_worker_stops_consuming(self):
+        pool = self.get_pool()
+        client = get_fake_amq_client()
+        pool.factories[0].amqp_connected(client)
+        connections = []
+        for routing_key in ['worker1.inbound', 'worker2.inbound']:
+            worker = ConsumingWorker({}, {'routing_key': routing_key})
+            connection = SharedAmqpConnection(pool, worker)
+            yield connection.startService()
+            connections.append(connection)
+        worker1, worker2 = [c.worker for c in connections]
+        yield connections[0].stopService()
+        for routing_key in ['worker1.inbound', 'worker2.inbound']:
+            client.broker.publish_message(
+                'vumi', routing_key, Message(key=routing_key))
+        yield client.broker.wait_delivery()
+        self.assertEqual(worker1.received, [])
+        self.assertEqual([m['key'] for m in worker2.received],
+                         ['worker2.inbound'])
@@ -1,8 +1,10 @@
+import logging
+
 from twisted.trial.unittest import TestCase
 
 from vumi.servicemaker import (
     VumiOptions, StartWorkerOptions, VumiWorkerServiceMaker)
-from vumi import servicemaker
+from vumi import servicemaker, log
 
 
 class OptionsTestCase(TestCase):
@@ -197,3 +199,15 @@ class VumiWorkerServiceMakerTestCase(OptionsTestCase):
                 (('http://1:2@example.com/2/', 'echoworker'), {})
         ])
         self.assertTrue(dummy_service in worker.services)
+
+    def test_make_worker_with_log_level(self):
+        self.patch(log, '_level', log.get_level())
+        self.mk_config_file('worker', ["transport_name: sphex"])
+        options = StartWorkerOptions()
+        options.parseOptions(['--worker-class', 'vumi.demos.words.EchoWorker',
+                              '--config', self.config_file['worker'],
+                              '--log-level', 'warning',
+                              ])
+        maker = VumiWorkerServiceMaker()
+        maker.makeService(options)
+        self.assertEqual(log.get_level(), logging.WARNING)
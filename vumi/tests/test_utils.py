@@ -2,7 +2,7 @@ import os.path
 
 from twisted.trial.unittest import TestCase
 from twisted.internet import reactor
-from twisted.internet.defer import Deferred, inlineCallbacks
+from twisted.internet.defer import Deferred, DeferredQueue, inlineCallbacks
 from twisted.web.server import Site, NOT_DONE_YET
 from twisted.web.resource import Resource
 from twisted.web import http
@@ -11,7 +11,7 @@ from twisted.internet.protocol import Protocol, Factory
 
 from vumi.utils import (normalize_msisdn, vumi_resource_path, cleanup_msisdn,
                         get_operator_name, http_request, http_request_full,
-                        get_first_word, redis_from_config)
+                        get_first_word, redis_from_config, HttpClientPool)
 from vumi.persist.fake_redis import FakeRedis
 from vumi.tests.utils import import_skip
 
@@ -43,6 +43,13 @@ class UtilsTestCase(TestCase):
         self.assertEqual(os.path.join(vumi_path, 'vumi/resources/foo/bar'),
                          vumi_resource_path('foo/bar'))
 
+    def test_vumi_resource_path_existing_file(self):
+        import pkg_resources
+        self.assertEqual(
+            pkg_resources.resource_filename(
+                "vumi.resources", "amqp-spec-0-8.xml"),
+            vumi_resource_path("amqp-spec-0-8.xml"))
+
     def test_cleanup_msisdn(self):
         self.assertEqual('27761234567', cleanup_msisdn('27761234567', '27'))
         self.assertEqual('27761234567', cleanup_msisdn('+27761234567', '27'))
@@ -285,3 +292,43 @@ class HttpUtilsTestCase(TestCase):
             self.assertTrue(reason.check('vumi.utils.HttpTimeoutError'))
         client_done.addBoth(check_client_response)
         yield client_done
+
+    @inlineCallbacks
+    def test_http_request_full_pool_reuses_connections(self):
+        self.set_render(lambda r: "Yay")
+        pool = HttpClientPool()
+        self.addCleanup(pool.close)
+        for _ in range(3):
+            request = yield http_request_full(self.url, '', pool=pool)
+            self.assertEqual(request.delivered_body, "Yay")
+        stats = pool.get_stats()
+        self.assertEqual(stats['requests'], 3)
+        self.assertEqual(stats['new_connections'], 1)
+        self.assertEqual(stats['reused_connections'], 2)
+
+    @inlineCallbacks
+    def test_http_request_full_pool_max_concurrent_per_host(self):
+        requests = DeferredQueue()
+
+        def render(request):
+            requests.put(request)
+            return NOT_DONE_YET
+        self.root.render = render
+        pool = HttpClientPool(max_concurrent_per_host=1)
+        self.addCleanup(pool.close)
+
+        first = http_request_full(self.url, '', pool=pool)
+        second = http_request_full(self.url, '', pool=pool)
+        request = yield requests.get()
+        self.assertEqual(requests.pending, [])
+
+        request.write("first")
+        request.finish()
+        response = yield first
+        self.assertEqual(response.delivered_body, "first")
+
+        request = yield requests.get()
+        request.write("second")
+        request.finish()
+        response = yield second
+        self.assertEqual(response.delivered_body, "second")
@@ -5,6 +5,7 @@ from vumi.worker import BaseConfig, BaseWorker
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
 from vumi.tests.utils import VumiWorkerTestCase, LogCatcher, get_stubbed_worker
 from vumi.middleware.base import BaseMiddleware
+from vumi.message import Message
 
 
 class DummyWorker(BaseWorker):
@@ -101,6 +102,25 @@ class TestBaseWorker(VumiWorkerTestCase):
             ('teardown_heartbeat', (), {}),
         ])
 
+    def test_get_http_pool(self):
+        worker = get_stubbed_worker(DummyWorker, {
+            'http_max_persistent_per_host': 5,
+            'http_idle_timeout': 30,
+            'http_max_concurrent_per_host': 10,
+        })
+        pool = worker.get_http_pool()
+        self.assertTrue(worker.get_http_pool() is pool)
+        self.assertEqual(pool.connection_pool.maxPersistentPerHost, 5)
+        self.assertEqual(pool.connection_pool.cachedConnectionTimeout, 30)
+        self.assertEqual(pool.max_concurrent_per_host, 10)
+
+    @inlineCallbacks
+    def test_teardown_http_pool(self):
+        pool = self.worker.get_http_pool()
+        yield self.worker.teardown_http_pool()
+        self.assertTrue(self.worker.get_http_pool() is not pool)
+        yield self.worker.teardown_http_pool()
+
     def test_setup_connectors_raises(self):
         worker = get_stubbed_worker(BaseWorker, {}, None)  # None -> dummy AMQP
         self.assertRaises(NotImplementedError, worker.setup_connectors)
@@ -140,16 +160,51 @@ class TestBaseWorker(VumiWorkerTestCase):
         yield worker.teardown_middleware()
         self.assertTrue(worker.middlewares[0].teardown_called)
 
+    @inlineCallbacks
+    def test_middleware_timing_metrics(self):
+        worker = get_stubbed_worker(DummyWorker, {
+            'middleware': [{'mw': 'vumi.tests.test_worker'
+                                  '.DummyMiddleware'}],
+            'middleware_metrics_prefix': 'vumi.test.',
+        }, self._amqp)
+        yield worker.setup_middleware()
+        connector = yield worker.setup_ri_connector('foo')
+        msgs = []
+        connector.set_inbound_handler(msgs.append)
+        connector.unpause()
+        yield self.dispatch_inbound(self.mkmsg_in(), 'foo')
+        self.assertEqual(len(msgs), 1)
+
+        metric_manager = worker.middleware_timing_hook.metric_manager
+        metric_manager._publish_metrics()
+        [content] = self._amqp.get_dispatched('vumi.metrics', 'vumi.metrics')
+        [datapoint] = Message.from_json(content.body)['datapoints']
+        self.assertEqual(datapoint[0], 'vumi.test.middleware.mw.inbound')
+        self.assertEqual(len(datapoint[2]), 1)
+
+        yield worker.teardown_connectors()
+        yield worker.teardown_middleware()
+        self.assertEqual(metric_manager._task, None)
+
+    def test_middleware_timing_disabled(self):
+        self.assertEqual(self.worker.middleware_timing_hook, None)
+
     def test_get_static_config(self):
         cfg = self.worker.get_static_config()
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'http_max_persistent_per_host',
+            'http_idle_timeout', 'http_max_concurrent_per_host',
+            'middleware_metrics_prefix'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     @inlineCallbacks
     def test_get_config(self):
         msg = self.mkmsg_in()
         cfg = yield self.worker.get_config(msg)
-        self.assertEqual([f.name for f in cfg.fields], ['amqp_prefetch_count'])
+        self.assertEqual([f.name for f in cfg.fields], [
+            'amqp_prefetch_count', 'http_max_persistent_per_host',
+            'http_idle_timeout', 'http_max_concurrent_per_host',
+            'middleware_metrics_prefix'])
         self.assertEqual(cfg.amqp_prefetch_count, 20)
 
     def test__validate_config(self):
@@ -288,6 +288,8 @@ class RiakDisabledForTest(object):
 class PersistenceMixin(object):
     sync_persistence = False
     use_riak = False
+    # Set to a number of shards to test against a sharded Redis manager.
+    redis_shards = None
 
     sync_or_async = staticmethod(maybe_async('sync_persistence'))
 
@@ -305,6 +307,11 @@ class PersistenceMixin(object):
             }
         if not self.use_riak:
             self._persist_config['riak_manager'] = RiakDisabledForTest()
+        if self.redis_shards:
+            redis_config = self._persist_config['redis_manager']
+            del redis_config['FAKE_REDIS']
+            redis_config['shards'] = [
+                {'FAKE_REDIS': 'yes'} for _ in range(self.redis_shards)]
 
     def mk_config(self, config):
         return dict(self._persist_config, **config)
@@ -216,12 +216,12 @@ class HttpRpcTransport(Transport):
     def remove_request(self, request_id):
         del self._requests[request_id]
 
-    def emit(self, msg):
+    def emit(self, *args, **kw):
         if self.noisy:
-            log.debug(msg)
+            log.debug(*args, **kw)
 
     def handle_outbound_message(self, message):
-        self.emit("HttpRpcTransport consuming %s" % (message))
+        self.emit(format="HttpRpcTransport consuming %(msg)s", msg=message)
         missing_fields = self.ensure_message_values(message,
                             ['in_reply_to', 'content'])
         if missing_fields:
@@ -2,11 +2,13 @@ import json
 
 from twisted.internet.defer import inlineCallbacks
 from twisted.internet.task import Clock
+from twisted.python.log import textFromEventDict
 
 from vumi.utils import http_request, http_request_full
 from vumi.transports.tests.test_base import TransportTestCase
 from vumi.transports.httprpc import HttpRpcTransport
 from vumi.message import TransportUserMessage
+from vumi.tests.utils import LogCatcher
 
 
 class OkTransport(HttpRpcTransport):
@@ -77,6 +79,17 @@ class TestTransport(TransportTestCase):
         self.assertEqual(nack['sent_message_id'], msg['message_id'])
         self.assertEqual(nack['nack_reason'], 'Missing fields: in_reply_to')
 
+    @inlineCallbacks
+    def test_noisy_outbound_logging(self):
+        self.transport.noisy = True
+        msg = self.mkmsg_out()
+        with LogCatcher() as lc:
+            yield self.dispatch(msg)
+            yield self.wait_for_dispatched_events(1)
+        [logged] = [text for text in map(textFromEventDict, lc.logs)
+                    if text.startswith("HttpRpcTransport consuming ")]
+        self.assertTrue(msg['message_id'] in logged)
+
     @inlineCallbacks
     def test_timeout(self):
         d = http_request_full(self.transport_url + "foo", '', method='GET')
@@ -2,6 +2,7 @@ import binascii
 
 from twisted.internet.defer import Deferred, inlineCallbacks, succeed
 from twisted.internet.task import Clock
+from twisted.python.log import textFromEventDict
 from smpp.pdu_builder import SubmitSMResp, DeliverSM
 
 from vumi.message import TransportUserMessage
@@ -834,6 +835,31 @@ class TxEsmeToSmscTestCase(TransportTestCase):
         dispatched_failures = self.get_dispatched_failures()
         self.assertEqual(dispatched_failures, [])
 
+    @inlineCallbacks
+    def test_submit_logging(self):
+        yield self.startTransport()
+        yield self.transport._block_till_bind
+        msg = TransportUserMessage(
+                to_addr="2772222222",
+                from_addr="2772000000",
+                content='hello world',
+                transport_name=self.transport_name,
+                transport_type='smpp',
+                transport_metadata={},
+                rkey='%s.outbound' % self.transport_name,
+                timestamp='0',
+                )
+        with LogCatcher() as lc:
+            yield self.dispatch(msg)
+            yield self.wait_for_dispatched_events(1)
+        logged = map(textFromEventDict, lc.logs)
+        [consumed] = [text for text in logged
+                      if text.startswith("Consumed outgoing message ")]
+        self.assertTrue(msg['message_id'] in consumed)
+        [sending] = [text for text in logged
+                     if text.startswith("Sending SMPP message: ")]
+        self.assertTrue(msg['message_id'] in sending)
+
 
 class RxEsmeToSmscTestCase(TransportTestCase):
 
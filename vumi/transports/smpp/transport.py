@@ -1,5 +1,6 @@
 # -*- test-case-name: vumi.transports.smpp.tests.test_smpp -*-
 
+import logging
 from datetime import datetime
 
 from twisted.internet import reactor
@@ -187,9 +188,10 @@ class SmppTransport(Transport):
 
     @inlineCallbacks
     def handle_outbound_message(self, message):
-        log.debug("Consumed outgoing message %r" % (message,))
-        log.debug("Unacknowledged message count: %s" % (
-                (yield self.esme_client.get_unacked_count()),))
+        log.debug(format="Consumed outgoing message %(msg)r", msg=message)
+        if log.is_enabled_for(logging.DEBUG):
+            log.debug("Unacknowledged message count: %s" % (
+                    (yield self.esme_client.get_unacked_count()),))
         yield self.r_set_message(message)
         yield self._submit_outbound_message(message)
 
@@ -299,10 +301,12 @@ class SmppTransport(Transport):
     @inlineCallbacks
     def submit_sm_success(self, sent_sms_id, transport_msg_id):
         yield self.r_delete_message(sent_sms_id)
-        log.debug("Mapping transport_msg_id=%s to sent_sms_id=%s" % (
-            transport_msg_id, sent_sms_id))
-        log.debug("PUBLISHING ACK: (%s -> %s)" % (
-            sent_sms_id, transport_msg_id))
+        log.debug(format="Mapping transport_msg_id=%(transport_msg_id)s to"
+                  " sent_sms_id=%(sent_sms_id)s",
+                  transport_msg_id=transport_msg_id, sent_sms_id=sent_sms_id)
+        log.debug(format="PUBLISHING ACK: (%(sent_sms_id)s ->"
+                  " %(transport_msg_id)s)",
+                  transport_msg_id=transport_msg_id, sent_sms_id=sent_sms_id)
         self.publish_ack(
             user_message_id=sent_sms_id,
             sent_message_id=transport_msg_id)
@@ -396,7 +400,7 @@ class SmppTransport(Transport):
         return self.publish_message(**message).addErrback(log.err)
 
     def send_smpp(self, message):
-        log.debug("Sending SMPP message: %s" % (message))
+        log.debug(format="Sending SMPP message: %(msg)s", msg=message)
         # first do a lookup in our YAML to see if we've got a source_addr
         # defined for the given MT number, if not, trust the from_addr
         # in the message
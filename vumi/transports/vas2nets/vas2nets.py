@@ -260,7 +260,7 @@ class Vas2NetsTransport(Transport):
                 self.config['url'], urlencode(params), {
                     'User-Agent': ['Vumi Vas2Net Transport'],
                     'Content-Type': ['application/x-www-form-urlencoded'],
-                    }, 'POST')
+                    }, 'POST', pool=self.get_http_pool())
         except ConnectionRefusedError:
             log.msg("Connection failed sending message:", message)
             raise TemporaryFailure('connection refused')
@@ -123,7 +123,8 @@ class GoConversationTransport(Transport):
             self.get_url('messages.json'),
             data=json.dumps(params).encode('utf-8'),
             headers=headers,
-            method='PUT')
+            method='PUT',
+            pool=self.get_http_pool())
 
         if resp.code != http.OK:
             log.warning('Unexpected status code: %s, body: %s' % (
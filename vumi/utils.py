@@ -4,8 +4,8 @@ import os.path
 import re
 import sys
 import base64
-import pkg_resources
 import warnings
+import urlparse
 from functools import wraps
 
 from zope.interface import implements
@@ -13,7 +13,7 @@ from twisted.internet import defer
 from twisted.internet import reactor, protocol
 from twisted.internet.defer import succeed
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, ResponseDone
+from twisted.web.client import Agent, ResponseDone, HTTPConnectionPool
 from twisted.web.server import Site
 from twisted.web.http_headers import Headers
 from twisted.web.iweb import IBodyProducer
@@ -112,9 +112,124 @@ class SimplishReceiver(protocol.Protocol):
             self.deferred.errback(reason)
 
 
+class MeteredHTTPConnectionPool(HTTPConnectionPool):
+    """An HTTPConnectionPool that counts new and reused connections."""
+
+    def __init__(self, reactor, persistent=True):
+        HTTPConnectionPool.__init__(self, reactor, persistent=persistent)
+        self.connection_requests = 0
+        self.new_connections = 0
+
+    @property
+    def reused_connections(self):
+        return self.connection_requests - self.new_connections
+
+    def getConnection(self, key, endpoint):
+        self.connection_requests += 1
+        return HTTPConnectionPool.getConnection(self, key, endpoint)
+
+    def _newConnection(self, key, endpoint):
+        self.new_connections += 1
+        return HTTPConnectionPool._newConnection(self, key, endpoint)
+
+
+class HttpClientPool(object):
+    """A pool of persistent HTTP connections for :func:`http_request_full`.
+
+    Idle connections are kept open and reused for later requests to the same
+    host, saving a TCP (and TLS) handshake per request.
+
+    :param int max_persistent_per_host:
+        Maximum number of idle connections kept open per host.
+    :param float idle_timeout:
+        Seconds an idle connection is kept open before being closed.
+    :param int max_concurrent_per_host:
+        Maximum number of requests in flight to a host at once. Further
+        requests wait for an earlier one to finish. Default is None
+        (unlimited).
+    """
+
+    def __init__(self, max_persistent_per_host=2, idle_timeout=240,
+                 max_concurrent_per_host=None, persistent=True):
+        self.connection_pool = MeteredHTTPConnectionPool(
+            reactor, persistent=persistent)
+        self.connection_pool.maxPersistentPerHost = max_persistent_per_host
+        self.connection_pool.cachedConnectionTimeout = idle_timeout
+        self.max_concurrent_per_host = max_concurrent_per_host
+        self.agent = Agent(reactor, pool=self.connection_pool)
+        self._semaphores = {}
+        self.requests = 0
+        self.request_time = 0.0
+
+    @property
+    def new_connections(self):
+        return self.connection_pool.new_connections
+
+    @property
+    def reused_connections(self):
+        return self.connection_pool.reused_connections
+
+    def get_stats(self):
+        """Return a dict of request and connection reuse statistics."""
+        return {
+            'requests': self.requests,
+            'new_connections': self.new_connections,
+            'reused_connections': self.reused_connections,
+            'average_latency': (self.request_time / self.requests
+                                if self.requests else 0.0),
+        }
+
+    def _get_semaphore(self, url):
+        if self.max_concurrent_per_host is None:
+            return None
+        parsed = urlparse.urlparse(url)
+        key = (parsed.scheme, parsed.hostname, parsed.port)
+        if key not in self._semaphores:
+            self._semaphores[key] = defer.DeferredSemaphore(
+                self.max_concurrent_per_host)
+        return self._semaphores[key]
+
+    def run_request(self, url, func, *args, **kw):
+        """Call `func(agent, *args, **kw)` within this pool's per-host
+        concurrency limit and record how long it took.
+        """
+        start = reactor.seconds()
+
+        def record(result):
+            self.requests += 1
+            self.request_time += reactor.seconds() - start
+            return result
+
+        semaphore = self._get_semaphore(url)
+        if semaphore is None:
+            d = defer.maybeDeferred(func, self.agent, *args, **kw)
+        else:
+            d = semaphore.run(func, self.agent, *args, **kw)
+        return d.addBoth(record)
+
+    def close(self):
+        """Close all idle connections."""
+        return self.connection_pool.closeCachedConnections()
+
+
 def http_request_full(url, data=None, headers={}, method='POST',
-                      timeout=None, data_limit=None):
-    agent = Agent(reactor)
+                      timeout=None, data_limit=None, pool=None):
+    """Make an HTTP request and return a deferred that fires with the
+    response, with the body available as `response.delivered_body`.
+
+    If an :class:`HttpClientPool` is given as `pool`, its connections are
+    reused and its per-host concurrency limit applies. Otherwise a new
+    connection is made for the request.
+    """
+    if pool is not None:
+        return pool.run_request(url, _http_request_full, url, data, headers,
+                                method, timeout, data_limit)
+    return _http_request_full(Agent(reactor), url, data, headers, method,
+                              timeout, data_limit)
+
+
+def _http_request_full(agent, url, data, headers, method, timeout,
+                       data_limit):
     d = agent.request(method,
                       url,
                       mkheaders(headers),
@@ -219,6 +334,10 @@ class LogFilterSite(Site):
         return Site.log(self, request)
 
 
+VUMI_RESOURCES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'resources')
+
+
 def vumi_resource_path(path):
     """
     Return an absolute path to a Vumi package resource.
@@ -228,6 +347,13 @@ def vumi_resource_path(path):
     """
     if os.path.isabs(path):
         return path
+    # Importing pkg_resources is slow, so we only do it if vumi is
+    # installed somewhere that the resource isn't a plain file (such as a
+    # zipped egg).
+    resource_path = os.path.join(VUMI_RESOURCES_DIR, path)
+    if os.path.exists(resource_path):
+        return resource_path
+    import pkg_resources
     return pkg_resources.resource_filename("vumi.resources", path)
 
 
@@ -6,12 +6,14 @@ from twisted.internet.defer import inlineCallbacks, succeed, maybeDeferred
 from twisted.python import log
 
 from vumi.service import Worker
-from vumi.middleware import setup_middlewares_from_config
+from vumi.middleware import (
+    setup_middlewares_from_config, setup_middleware_timing_from_config)
 from vumi.connectors import ReceiveInboundConnector, ReceiveOutboundConnector
-from vumi.config import Config, ConfigInt
+from vumi.config import Config, ConfigInt, ConfigFloat, ConfigText
 from vumi.errors import DuplicateConnectorError
 from vumi.blinkenlights.heartbeat import (HeartBeatPublisher,
                                           HeartBeatMessage)
+from vumi.utils import HttpClientPool
 
 import time
 import os
@@ -32,6 +34,22 @@ class BaseConfig(Config):
         "The number of messages fetched concurrently from each AMQP queue"
         " by each worker instance.",
         default=20, static=True)
+    http_max_persistent_per_host = ConfigInt(
+        "The maximum number of idle HTTP connections per host kept open by"
+        " the worker's HTTP client pool.",
+        default=2, static=True)
+    http_idle_timeout = ConfigFloat(
+        "The number of seconds an idle HTTP connection is kept open by the"
+        " worker's HTTP client pool.",
+        default=240, static=True)
+    http_max_concurrent_per_host = ConfigInt(
+        "The maximum number of concurrent HTTP requests the worker makes to"
+        " a single host. Unlimited if not set.",
+        static=True)
+    middleware_metrics_prefix = ConfigText(
+        "If set, the time each middleware handler takes is published as a"
+        " metric named `<prefix>middleware.<middleware name>.<handler>`.",
+        static=True)
 
 
 class BaseWorker(Worker):
@@ -48,8 +66,10 @@ class BaseWorker(Worker):
         super(BaseWorker, self).__init__(options, config=config)
         self.connectors = {}
         self.middlewares = []
+        self.middleware_timing_hook = None
         self._static_config = self.CONFIG_CLASS(self.config, static=True)
         self._hb_pub = None
+        self._http_pool = None
 
     def startWorker(self):
         log.msg('Starting a %s worker with config: %s'
@@ -68,6 +88,7 @@ class BaseWorker(Worker):
         then_call(d, self.teardown_connectors)
         then_call(d, self.teardown_middleware)
         then_call(d, self.teardown_heartbeat)
+        then_call(d, self.teardown_http_pool)
         return d
 
     def setup_connectors(self):
@@ -103,6 +124,26 @@ class BaseWorker(Worker):
         }
         return attrs
 
+    def get_http_pool(self):
+        """Return this worker's pool of persistent HTTP connections.
+
+        It should be passed as the `pool` argument to
+        :func:`vumi.utils.http_request_full`.
+        """
+        if self._http_pool is None:
+            config = self.get_static_config()
+            self._http_pool = HttpClientPool(
+                max_persistent_per_host=config.http_max_persistent_per_host,
+                idle_timeout=config.http_idle_timeout,
+                max_concurrent_per_host=config.http_max_concurrent_per_host)
+        return self._http_pool
+
+    def teardown_http_pool(self):
+        if self._http_pool is not None:
+            d = self._http_pool.close()
+            self._http_pool = None
+            return d
+
     def teardown_connectors(self):
         d = succeed(None)
         for connector_name in self.connectors.keys():
@@ -119,13 +160,20 @@ class BaseWorker(Worker):
         """Create middlewares from config."""
         d = setup_middlewares_from_config(self, self.config)
         d.addCallback(self.middlewares.extend)
+        then_call(d, setup_middleware_timing_from_config, self, self.config)
+        d.addCallback(self._set_middleware_timing_hook)
         return d
 
+    def _set_middleware_timing_hook(self, timing_hook):
+        self.middleware_timing_hook = timing_hook
+
     def teardown_middleware(self):
         """Teardown middlewares."""
         d = succeed(None)
         for mw in reversed(self.middlewares):
             then_call(d, mw.teardown_middleware)
+        if self.middleware_timing_hook is not None:
+            then_call(d, self.middleware_timing_hook.stop)
         return d
 
     def get_static_config(self):
@@ -165,10 +213,12 @@ class BaseWorker(Worker):
                                           " with name %r" % (connector_name,))
         prefetch_count = self.get_static_config().amqp_prefetch_count
         middlewares = self.middlewares if middleware else None
+        timing_hook = self.middleware_timing_hook if middleware else None
 
         connector = connector_cls(self, connector_name,
                                   prefetch_count=prefetch_count,
-                                  middlewares=middlewares)
+                                  middlewares=middlewares,
+                                  timing_hook=timing_hook)
         self.connectors[connector_name] = connector
 
         d = connector.setup()